@@ -0,0 +1,60 @@
+"""
+Files per second written through Tagdir under each durability mode, doing
+create + write + flush + release per file like an untar or a checkout.
+The batched mode includes the final sync at unmount.
+
+Usage: python benchmarks/bench_durability.py [files] [KiB per file]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from tagdir.db import session_scope, setup_db
+from tagdir.fusepy.loopback import DURABILITY_MODES
+from tagdir.models import Attr, Entity, Tag
+from tagdir.tagdir import Tagdir
+
+
+def setup(workdir):
+    entity_path = os.path.join(workdir, "out")
+    os.mkdir(entity_path)
+
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        tag_attr = Attr.new_tag_attr()
+        ent_attr = Attr.new_entity_attr()
+        tag = Tag("bench", tag_attr)
+        session.add_all([tag_attr, ent_attr, tag,
+                         Entity("out", ent_attr, entity_path, [tag])])
+
+
+def run(tagdir, durability, nfiles, data):
+    start = time.perf_counter()
+    for i in range(nfiles):
+        path = "/@bench/out/{}-{}".format(durability, i)
+        fh = tagdir("create", path, 0o644)
+        tagdir("write", path, data, 0, fh)
+        tagdir("flush", path, fh)
+        tagdir("release", path, fh)
+    tagdir("destroy", "/")
+    return nfiles / (time.perf_counter() - start)
+
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 4) * 1024
+    data = os.urandom(size)
+
+    # Under the current directory, as /tmp is often a tmpfs
+    with tempfile.TemporaryDirectory(dir=".") as workdir:
+        setup(workdir)
+
+        for durability in DURABILITY_MODES:
+            tagdir = Tagdir(durability)
+            files_s = run(tagdir, durability, nfiles, data)
+            print("{:>8}: {:8.1f} files/s".format(durability, files_s))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Throughput of N threads reading different files through Tagdir.__call__.
+
+Compares the former Loopback.read, which serialized every read of the
+mount behind one lock around lseek + read, with lock-free os.pread.
+
+Usage: python benchmarks/bench_parallel_read.py [threads] [files per thread]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from tagdir.db import session_scope, setup_db
+from tagdir.fusepy.loopback import Loopback
+from tagdir.models import Attr, Entity, Tag
+from tagdir.tagdir import Tagdir
+
+FILE_SIZE = 64 * 1024
+CHUNK = 4 * 1024
+
+
+def setup(workdir, nfiles):
+    entity_path = os.path.join(workdir, "src")
+    os.mkdir(entity_path)
+    for i in range(nfiles):
+        with open(os.path.join(entity_path, str(i)), "wb") as f:
+            f.write(os.urandom(FILE_SIZE))
+
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        tag_attr = Attr.new_tag_attr()
+        ent_attr = Attr.new_entity_attr()
+        tag = Tag("bench", tag_attr)
+        session.add_all([tag_attr, ent_attr, tag,
+                         Entity("src", ent_attr, entity_path, [tag])])
+
+
+def reader(tagdir, files):
+    for name in files:
+        path = "/@bench/src/" + name
+        fh = tagdir("open", path, os.O_RDONLY)
+        for offset in range(0, FILE_SIZE, CHUNK):
+            tagdir("read", path, CHUNK, offset, fh)
+        tagdir("release", path, fh)
+
+
+def run(label, nthreads, files_per_thread):
+    tagdir = Tagdir()
+    threads = [threading.Thread(
+        target=reader,
+        args=(tagdir, [str(t * files_per_thread + i)
+                       for i in range(files_per_thread)]))
+        for t in range(nthreads)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    nbytes = nthreads * files_per_thread * FILE_SIZE
+    print("{:>8}: {:8.1f} MiB/s, {:8.0f} files/s".format(
+        label, nbytes / elapsed / 2 ** 20,
+        nthreads * files_per_thread / elapsed))
+
+
+def locked_read(lock):
+    def read(self, path, size, offset, fh):
+        with lock:
+            os.lseek(fh, offset, 0)
+            return os.read(fh, size)
+    return read
+
+
+def main():
+    nthreads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    files_per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir, nthreads * files_per_thread)
+
+        pread = Loopback.read
+        Loopback.read = locked_read(threading.Lock())  # type: ignore
+        run("locked", nthreads, files_per_thread)
+
+        Loopback.read = pread  # type: ignore
+        run("pread", nthreads, files_per_thread)
+
+
+if __name__ == "__main__":
+    main()
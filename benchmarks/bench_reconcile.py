@@ -0,0 +1,61 @@
+"""
+Seconds taken by the reconciliation at mount time with many entities: on
+the first mount after upgrading, which records every fingerprint, on a
+mount with nothing changed, and after a project root containing 1% of the
+entities is renamed and another 1% deleted while not mounted.
+
+Usage: python benchmarks/bench_reconcile.py [entities] [threads]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from tagdir.db import session_scope, setup_db
+from tagdir.models import Attr, Entity
+from tagdir.reconcile import reconcile
+from tagdir.watch import EntityPathChangeObserver, INOTIFY
+
+
+def setup(workdir, nentities):
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        for i in range(nentities):
+            path = os.path.join(workdir, "root{}".format(i % 100),
+                                "d{}".format(i % 1000), "e{}".format(i))
+            os.makedirs(path)
+            attr = Attr.new_entity_attr()
+            session.add_all([attr,
+                             Entity("e{}".format(i), attr, path, [])])
+
+
+def measure(nthreads):
+    start = time.perf_counter()
+    moves = reconcile(nthreads)
+    return time.perf_counter() - start, len(moves)
+
+
+def main():
+    nentities = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nthreads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir, nentities)
+        # Watching the entities at mount time is not measured
+        EntityPathChangeObserver(INOTIFY)
+
+        print("{:>10}: {:6.2f} s".format("first", measure(nthreads)[0]))
+        print("{:>10}: {:6.2f} s".format("unchanged", measure(nthreads)[0]))
+
+        os.rename(os.path.join(workdir, "root0"),
+                  os.path.join(workdir, "renamed"))
+        for name in os.listdir(os.path.join(workdir, "root1")):
+            for entity in os.listdir(os.path.join(workdir, "root1", name)):
+                os.rmdir(os.path.join(workdir, "root1", name, entity))
+        seconds, moves = measure(nthreads)
+        print("{:>10}: {:6.2f} s, {} entities moved".format(
+            "changed", seconds, moves))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Per-op overhead of Tagdir.__call__ for a read-heavy workload.
+
+Compares eager sessions (a transaction for every op, as before) with lazy
+sessions (a transaction only when a query is issued). The workload mimics
+reading files through a tagged path: getattr, open, read chunks, release.
+
+Usage: python benchmarks/bench_session_overhead.py [iterations]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from tagdir import tagdir as tagdir_module
+from tagdir.db import session_scope, setup_db
+from tagdir.models import Attr, Entity, Tag
+from tagdir.tagdir import Tagdir
+
+CHUNK = 128 * 1024
+CHUNKS = 8
+
+
+def setup(workdir):
+    entity_path = os.path.join(workdir, "entity")
+    os.mkdir(entity_path)
+    with open(os.path.join(entity_path, "file"), "wb") as f:
+        f.write(os.urandom(CHUNK * CHUNKS))
+
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        tag_attr = Attr.new_tag_attr()
+        ent_attr = Attr.new_entity_attr()
+        tag = Tag("bench", tag_attr)
+        session.add_all([tag_attr, ent_attr, tag,
+                         Entity("entity", ent_attr, entity_path, [tag])])
+
+
+def workload(tagdir, iterations):
+    path = "/@bench/entity/file"
+    ops = 0
+    for _ in range(iterations):
+        tagdir("getattr", path, None)
+        fh = tagdir("open", path, os.O_RDONLY)
+        for i in range(CHUNKS):
+            tagdir("read", path, CHUNK, i * CHUNK, fh)
+        tagdir("release", path, fh)
+        ops += CHUNKS + 3
+    return ops
+
+
+def run(label, iterations):
+    tagdir = Tagdir()
+    workload(tagdir, 10)  # warm up the path cache
+
+    start = time.perf_counter()
+    ops = workload(tagdir, iterations)
+    elapsed = time.perf_counter() - start
+
+    print("{:>6}: {:8.2f} us/op ({} ops)".format(
+        label, elapsed / ops * 10 ** 6, ops))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir)
+
+        lazy_session_scope = tagdir_module.lazy_session_scope
+        tagdir_module.lazy_session_scope = session_scope  # type: ignore
+        run("eager", iterations)
+
+        tagdir_module.lazy_session_scope = lazy_session_scope
+        run("lazy", iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Directories per second tagged through Tagdir with each tagging committed
+by its caller, versus by the writer in group commits, from one caller and
+from concurrent callers like FUSE worker threads serving `xargs -P`.
+Committing by concurrent callers is not measured, since they fail with
+"database is locked" when one upgrades its read transaction to write.
+
+Usage: python benchmarks/bench_tagging.py [directories] [threads]
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import tempfile
+import time
+
+from tagdir.db import session_scope, setup_db, Writer
+from tagdir.models import Attr, Tag
+from tagdir.tagdir import encode_path, Tagdir
+
+
+NAMES = ["inline", "writer", "threads"]
+
+
+def setup(workdir, ndirs):
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        for name in NAMES:
+            attr = Attr.new_tag_attr()
+            session.add_all([attr, Tag(name, attr)])
+
+    for name in NAMES:
+        for i in range(ndirs):
+            # Distinct parents, as the watcher has a thread per parent
+            os.makedirs(os.path.join(workdir, name, str(i % 16),
+                                     "{}{}".format(name, i)))
+
+
+def run(tagdir, workdir, name, ndirs, nthreads):
+    paths = ["/@{}/{}".format(name, encode_path(os.path.join(
+        workdir, name, str(i % 16), "{}{}".format(name, i))))
+        for i in range(ndirs)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(nthreads) as executor:
+        list(executor.map(lambda path: tagdir("mkdir", path, 0o755), paths))
+    return ndirs / (time.perf_counter() - start)
+
+
+def main():
+    ndirs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nthreads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir, ndirs)
+        tagdir = Tagdir()
+
+        writer = Writer.get_instance()
+        for name, threads in zip(NAMES, [1, 1, nthreads]):
+            if name != "inline":
+                writer.start()
+            rate = run(tagdir, workdir, name, ndirs, threads)
+            print("{:>7} {:>2} threads: {:8.1f} dirs/s".format(
+                name, threads, rate))
+        writer.stop()
+
+
+if __name__ == "__main__":
+    main()
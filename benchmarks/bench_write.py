@@ -0,0 +1,75 @@
+"""
+Throughput of FUSE.write into a file opened through Tagdir, copying the
+kernel buffer into bytes (string_at) versus passing a memoryview over it.
+
+Usage: python benchmarks/bench_write.py [MiB per run]
+"""
+import ctypes
+import os
+import sys
+import tempfile
+import time
+
+from tagdir.db import session_scope, setup_db
+from tagdir.fusepy.fuse import FUSE, fuse_file_info
+from tagdir.models import Attr, Entity, Tag
+from tagdir.tagdir import Tagdir
+
+
+def setup(workdir):
+    entity_path = os.path.join(workdir, "out")
+    os.mkdir(entity_path)
+
+    setup_db("sqlite:///" + os.path.join(workdir, "tagdir.db"))
+    with session_scope() as session:
+        tag_attr = Attr.new_tag_attr()
+        ent_attr = Attr.new_entity_attr()
+        tag = Tag("bench", tag_attr)
+        session.add_all([tag_attr, ent_attr, tag,
+                         Entity("out", ent_attr, entity_path, [tag])])
+
+
+def new_fuse(operations, use_write_memoryview):
+    # Only the attributes used by FUSE.write, without mounting anything
+    fuse = FUSE.__new__(FUSE)
+    fuse.operations = operations
+    fuse.raw_fi = False
+    fuse.encoding = "utf-8"
+    fuse.use_write_memoryview = use_write_memoryview
+    return fuse
+
+
+def run(fuse, tagdir, size, total):
+    path = "/@bench/out/file"
+    fi = fuse_file_info()
+    fi.fh = tagdir("create", path, 0o644)
+    fip = ctypes.pointer(fi)
+    buf = (ctypes.c_byte * size)()
+    ctypes.memmove(buf, os.urandom(size), size)
+    bufp = ctypes.cast(buf, ctypes.POINTER(ctypes.c_byte))
+
+    start = time.perf_counter()
+    for offset in range(0, total, size):
+        fuse.write(path.encode(), bufp, size, offset, fip)
+    elapsed = time.perf_counter() - start
+
+    tagdir("release", path, fi.fh)
+    return total / elapsed / 2 ** 20
+
+
+def main():
+    total = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 2 ** 20
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir)
+        tagdir = Tagdir()
+
+        for size in [4 * 1024, 1024 * 1024]:
+            for label, use_view in [("bytes", False), ("memoryview", True)]:
+                mib_s = run(new_fuse(tagdir, use_view), tagdir, size, total)
+                print("{:>4} KiB {:>10}: {:8.1f} MiB/s".format(
+                    size // 1024, label, mib_s))
+
+
+if __name__ == "__main__":
+    main()
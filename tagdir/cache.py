@@ -0,0 +1,340 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import math
+import os
+import threading
+import time
+from typing import (Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Set, Tuple)
+
+from .db import after_commit
+from .singleton import Singleton
+
+
+class ResolvedPath(NamedTuple):
+    tag_ids: Tuple[int, ...]
+    entity_id: int
+    entity_path: str
+
+
+# (tag names, entity name) of /@tag_1/.../@tag_n/ent_name
+CacheKey = Tuple[Tuple[str, ...], str]
+
+
+class ResolvedPathCache(metaclass=Singleton):
+    """
+    Bounded LRU cache of /@tag_1/.../@tag_n/ent_name -> ResolvedPath.
+
+    Only successful resolutions are stored, so creating tags or entities
+    never makes an entry stale. Entries are dropped by tag id or entity id
+    when a tag is removed, an entity is untagged, or its path changes.
+    """
+    DEFAULT_MAXSIZE = 4096
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._keys_by_tag: Dict[int, Set[CacheKey]] = {}
+        self._keys_by_entity: Dict[int, Set[CacheKey]] = {}
+        # Bumped by every invalidation. A resolver reads it before querying
+        # the database and put() discards results computed across a bump.
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: CacheKey) -> Optional[ResolvedPath]:
+        with self._lock:
+            resolved = self._entries.get(key)
+            if resolved is not None:
+                self._entries.move_to_end(key)
+            return resolved
+
+    def put(self, key: CacheKey, resolved: ResolvedPath,
+            generation: int) -> None:
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = resolved
+            for tag_id in resolved.tag_ids:
+                self._keys_by_tag.setdefault(tag_id, set()).add(key)
+            self._keys_by_entity.setdefault(
+                resolved.entity_id, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tag_ids: Iterable[int] = (),
+                   entity_ids: Iterable[int] = ()) -> None:
+        with self._lock:
+            self.generation += 1
+            keys: Set[CacheKey] = set()
+            for tag_id in tag_ids:
+                keys |= self._keys_by_tag.get(tag_id, set())
+            for entity_id in entity_ids:
+                keys |= self._keys_by_entity.get(entity_id, set())
+            for key in keys:
+                self._remove(key)
+
+    def invalidate_on_commit(self, session, tag_ids: Iterable[int] = (),
+                             entity_ids: Iterable[int] = ()) -> None:
+        """
+        Invalidate now and again after session commits, so that a resolver
+        running concurrently cannot cache the state before the commit.
+        """
+        tag_ids = list(tag_ids)
+        entity_ids = list(entity_ids)
+        self.invalidate(tag_ids, entity_ids)
+        after_commit(session, lambda: self.invalidate(tag_ids, entity_ids))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._keys_by_entity.clear()
+
+    def _remove(self, key: CacheKey) -> None:
+        resolved = self._entries.pop(key)
+        for tag_id in resolved.tag_ids:
+            self._discard(self._keys_by_tag, tag_id, key)
+        self._discard(self._keys_by_entity, resolved.entity_id, key)
+
+    @staticmethod
+    def _discard(index: Dict[int, Set[CacheKey]], id_: int,
+                 key: CacheKey) -> None:
+        keys = index.get(id_)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del index[id_]
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings. False positives occur with about error_rate
+    while at most capacity strings are added, and there are no false
+    negatives. Hashes are only stable in a process, which is enough here.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        nbits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.nbits = max(8, int(nbits))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self._bits = bytearray((self.nbits + 7) // 8)
+
+    def _positions(self, s: str) -> Iterable[int]:
+        # Double hashing: h1 + i * h2
+        h1 = hash(s)
+        h2 = hash(s + "\0") | 1
+        return ((h1 + i * h2) % self.nbits for i in range(self.nhashes))
+
+    def add(self, s: str) -> None:
+        for pos in self._positions(s):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, s: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(s))
+
+
+class NegativeCache(metaclass=Singleton):
+    """
+    Answer "this tag or entity does not exist" without the database.
+
+    Keys are "@" + tag name for tags and entity names for entities. A Bloom
+    filter holds every existing key, and names it cannot rule out are
+    remembered as misses for a short time after the database says so.
+    Nothing is filtered until the filter is loaded at mount time.
+    """
+    MIN_CAPACITY = 4096
+    MISS_TTL = 5.0
+    MAX_MISSES = 10000
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._bloom: Optional[BloomFilter] = None
+        self._misses: OrderedDict = OrderedDict()
+        # Keys added while loading, which the new filter has to include
+        self._added: Optional[List[str]] = None
+        # Bumped whenever keys are added. A resolver reads it before querying
+        # the database and record_miss() discards misses older than that.
+        self.generation = 0
+
+    @staticmethod
+    def tag_key(tag_name: str) -> str:
+        return "@" + tag_name
+
+    def clear(self) -> None:
+        with self._lock:
+            self._bloom = None
+            self._misses.clear()
+
+    def load(self, keys: Iterable[str]) -> None:
+        with self._lock:
+            self._added = []
+
+        keys = list(keys)
+        # Leave room for keys added until the next mount
+        bloom = BloomFilter(max(2 * len(keys), self.MIN_CAPACITY))
+        for key in keys:
+            bloom.add(key)
+
+        with self._lock:
+            for key in self._added:
+                bloom.add(key)
+            self._added = None
+            self._bloom = bloom
+
+    def might_exist(self, key: str) -> bool:
+        with self._lock:
+            if self._bloom is None:
+                return True
+
+            if key not in self._bloom:
+                return False
+
+            expiry = self._misses.get(key)
+            if expiry is None:
+                return True
+            if expiry > time.monotonic():
+                return False
+            del self._misses[key]
+            return True
+
+    def record_miss(self, key: str, generation: int) -> None:
+        with self._lock:
+            if self._bloom is None or generation != self.generation:
+                return
+            self._misses.pop(key, None)
+            self._misses[key] = time.monotonic() + self.MISS_TTL
+            while len(self._misses) > self.MAX_MISSES:
+                self._misses.popitem(last=False)
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self.generation += 1
+            if self._added is not None:
+                self._added.append(key)
+            if self._bloom is not None:
+                self._bloom.add(key)
+            self._misses.pop(key, None)
+
+    def add_on_commit(self, session, keys: Iterable[str]) -> None:
+        """
+        Add keys now, so that they are never reported missing once committed,
+        and forget misses recorded concurrently again after the commit.
+        """
+        keys = list(keys)
+        for key in keys:
+            self.add(key)
+
+        def forget_misses():
+            with self._lock:
+                self.generation += 1
+                for key in keys:
+                    self._misses.pop(key, None)
+        after_commit(session, forget_misses)
+
+
+class _Anchor:
+    def __init__(self, path: str, fd: int) -> None:
+        self.path = path
+        self.fd = fd
+        self.refs = 0
+        self.evicted = False
+
+
+class DirFdCache(metaclass=Singleton):
+    """
+    Bounded LRU cache of entity id -> open fd of the entity directory.
+
+    Passthrough operations are performed relative to the fd with dir_fd=,
+    so the kernel does not walk the whole real path every time, and keep
+    working on the same directory even if one of its ancestors is renamed.
+    An fd is reopened when the path of the entity changes, and an evicted
+    fd is closed once the last operation using it is done.
+    """
+    DEFAULT_MAXSIZE = 128
+    # O_PATH needs no permission to read the directory itself
+    FLAGS = os.O_DIRECTORY | getattr(os, "O_PATH", os.O_RDONLY)
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._anchors: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._anchors)
+
+    @contextmanager
+    def acquire(self, entity_id: int,
+                path: str) -> Iterator[Optional[int]]:
+        """
+        Yield an fd of the directory at path, or None if it cannot be opened.
+        """
+        try:
+            anchor = self._get(entity_id, path)
+        except OSError:
+            yield None
+            return
+
+        try:
+            yield anchor.fd
+        finally:
+            with self._lock:
+                anchor.refs -= 1
+                self._close_if_unused(anchor)
+
+    def _get(self, entity_id: int, path: str) -> _Anchor:
+        with self._lock:
+            anchor = self._anchors.get(entity_id)
+            if anchor is not None and anchor.path == path:
+                anchor.refs += 1
+                self._anchors.move_to_end(entity_id)
+                return anchor
+
+        # Open outside the lock, which would otherwise serialize path walks
+        fd = os.open(path, self.FLAGS)
+
+        with self._lock:
+            anchor = self._anchors.get(entity_id)
+            if anchor is not None and anchor.path == path:
+                # Opened concurrently by another operation
+                os.close(fd)
+            else:
+                if anchor is not None:
+                    self._evict(entity_id)
+                anchor = self._anchors[entity_id] = _Anchor(path, fd)
+                while len(self._anchors) > self.maxsize:
+                    self._evict(next(iter(self._anchors)))
+            anchor.refs += 1
+            self._anchors.move_to_end(entity_id)
+            return anchor
+
+    def invalidate(self, entity_ids: Iterable[int]) -> None:
+        with self._lock:
+            for entity_id in entity_ids:
+                if entity_id in self._anchors:
+                    self._evict(entity_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            for entity_id in list(self._anchors):
+                self._evict(entity_id)
+
+    def _evict(self, entity_id: int) -> None:
+        anchor = self._anchors.pop(entity_id)
+        anchor.evicted = True
+        self._close_if_unused(anchor)
+
+    @staticmethod
+    def _close_if_unused(anchor: _Anchor) -> None:
+        if anchor.evicted and anchor.refs == 0:
+            os.close(anchor.fd)
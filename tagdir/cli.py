@@ -9,10 +9,15 @@ from typing import Optional
 import psutil
 import xattr
 
-from .db import setup_db
+from .config import load_cache_config
+from .db import setup_db, Writer
 from .fusepy.fuse import FUSE
+from .fusepy.fusell import FUSELL
+from .fusepy.loopback import DURABILITY_MODES, STRICT
+from .lowlevel import TagdirLL
+from .reconcile import reconcile
 from .tagdir import ENTINFO_PATH, Tagdir, encode_path
-from .watch import EntityPathChangeObserver
+from .watch import EntityPathChangeObserver, WATCHDOG, WATCHERS
 
 
 def is_tagdir(disk) -> bool:
@@ -57,6 +62,11 @@ def mount(args: argparse.Namespace, mountpoint: Optional[str]) -> int:
         print("{} already exists.".format(args.name))
         return 0
 
+    cache_config = load_cache_config(
+        args.config, root=args.root_timeout, tag=args.tag_timeout,
+        entity=args.entity_timeout, content=args.content_timeout,
+        negative=args.negative_timeout, kernel_cache=args.kernel_cache)
+
     setup_db("sqlite:///" + args.db)
 
     import logging
@@ -76,13 +86,28 @@ def mount(args: argparse.Namespace, mountpoint: Optional[str]) -> int:
             "/var/log/tagdir.log", maxBytes=10 ** 8, backupCount=5)
 
     logging.basicConfig(format=format, level=level, handlers=[handler])
-
-    observer = EntityPathChangeObserver.get_instance()
+    if cache_config.kernel_cache and not args.lowlevel:
+        logging.getLogger(__name__).warning(
+            "Cached entries of entities are not invalidated without "
+            "--lowlevel, but time out")
+
+    writer = Writer.get_instance()
+    writer.start()
+    observer = EntityPathChangeObserver(args.watcher)
+    reconcile()
     observer.start()
-    FUSE(Tagdir(), args.mountpoint, foreground=True,
-         allow_other=True, fsname="Tagdir_" + args.name)
+    tagdir = Tagdir(args.durability, args.fsync_interval)
+    if args.lowlevel:
+        # Timeouts are given per node by TagdirLL
+        FUSELL(TagdirLL(tagdir, cache_config), args.mountpoint,
+               allow_other=True, fsname="Tagdir_" + args.name)
+    else:
+        FUSE(tagdir, args.mountpoint, foreground=True,
+             allow_other=True, use_ino=True, fsname="Tagdir_" + args.name,
+             **cache_config.fuse_options())
     observer.stop()
     observer.join()
+    writer.stop()
     return 0
 
 
@@ -166,6 +191,30 @@ def _main() -> int:
     parser_mount.add_argument("-i", action="store_true", default=False)
     parser_mount.add_argument("--level", choices=["debug", "error"],
                               default="error")
+    parser_mount.add_argument("--config", type=str, default=None)
+    # Kernel cache timeouts in seconds, which override the config file
+    for kind in ["root", "tag", "entity", "content", "negative"]:
+        parser_mount.add_argument("--{}-timeout".format(kind), type=float,
+                                  default=None)
+    # Either overrides kernel_cache of the config file
+    parser_mount.add_argument(
+        "--kernel-cache", action="store_const", const=True, default=None,
+        help="keep file contents cached by the kernel across opens; "
+             "changes of entities are only invalidated with --lowlevel, "
+             "and otherwise time out")
+    parser_mount.add_argument("--no-kernel-cache", action="store_const",
+                              const=False, dest="kernel_cache")
+    # When files written through the mount are synced to disk
+    parser_mount.add_argument("--durability", choices=DURABILITY_MODES,
+                              default=STRICT)
+    # Seconds between background syncs of the batched durability
+    parser_mount.add_argument("--fsync-interval", type=float, default=1.0)
+    # How moves and deletions of tagged directories are watched, where
+    # inotify watches all of them on one fd and thread on Linux
+    parser_mount.add_argument("--watcher", choices=WATCHERS, default=WATCHDOG)
+    # Mount with the low-level API of libfuse, which is Linux only
+    parser_mount.add_argument("--lowlevel", action="store_true",
+                              default=False)
     parser_mount.add_argument("name", type=name_validator)
     parser_mount.add_argument("db", type=str)
     parser_mount.add_argument("mountpoint", type=str)
@@ -191,6 +240,14 @@ def _main() -> int:
     parser_tag.set_defaults(func=listag)
 
     args = parser.parse_args()
+    if args.subparser_name == "mount" and not args.lowlevel:
+        # The high-level API times every node out after the shortest
+        # timeout, which only timeouts per node can make longer
+        for kind in ["root", "tag"]:
+            if getattr(args, kind + "_timeout") is not None:
+                parser_mount.error(
+                    "--{}-timeout requires --lowlevel".format(kind))
+
     mountpoint = get_mountpoint(args.name)
 
     if args.subparser_name == "mount":
@@ -0,0 +1,61 @@
+import configparser
+from typing import Any, Dict, NamedTuple, Optional
+
+TIMEOUTS_SECTION = "timeouts"
+
+
+class CacheConfig(NamedTuple):
+    """
+    Seconds for which the kernel may cache entries and attributes of each
+    class of node.
+
+    The root, tag directories and entity directories have attributes which
+    never change after creation, and entries which only change through the
+    mount itself, except for entities moved or deleted behind our back.
+    Passthrough content can be changed by anyone at any time.
+    """
+    root: float = 60.0
+    tag: float = 60.0
+    entity: float = 5.0
+    content: float = 1.0
+    negative: float = 0.0
+    kernel_cache: bool = False
+
+    def fuse_options(self) -> Dict[str, Any]:
+        """
+        Return mount options for the high-level API, which only supports
+        global timeouts, so the shortest one is used for every node.
+        """
+        timeout = min(self.root, self.tag, self.entity, self.content)
+        return {"entry_timeout": timeout, "attr_timeout": timeout,
+                "negative_timeout": self.negative,
+                "kernel_cache": self.kernel_cache}
+
+
+def load_cache_config(path: Optional[str] = None,
+                      **overrides: Any) -> CacheConfig:
+    """
+    Read the [timeouts] section of the config file at path, if any.
+    Values in overrides which are not None take precedence over the file.
+    """
+    values: Dict[str, Any] = {}
+
+    if path is not None:
+        parser = configparser.ConfigParser()
+        with open(path) as f:
+            parser.read_file(f)
+
+        if parser.has_section(TIMEOUTS_SECTION):
+            section = parser[TIMEOUTS_SECTION]
+            for key in section:
+                if key not in CacheConfig._fields:
+                    raise ValueError("Unknown key {} in [{}]".format(
+                        key, TIMEOUTS_SECTION))
+                if key == "kernel_cache":
+                    values[key] = section.getboolean(key)
+                else:
+                    values[key] = section.getfloat(key)
+
+    values.update((key, value) for key, value in overrides.items()
+                  if value is not None)
+    return CacheConfig(**values)
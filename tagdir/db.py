@@ -1,18 +1,106 @@
+from concurrent.futures import Future
 from contextlib import contextmanager
+import logging
+import queue
+import threading
+from typing import Callable, List, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .models import Base
+from .singleton import Singleton
+
+# Set on every connection to a database file
+SQLITE_PRAGMAS = [
+    # Readers and the writer never block each other
+    ("journal_mode", "WAL"),
+    # Commits are not synced until a checkpoint, which is still safe in WAL
+    ("synchronous", "NORMAL"),
+    # In KiB if negative, per connection
+    ("cache_size", -16 * 1024),
+    ("mmap_size", 256 * 2 ** 20),
+    # Milliseconds to wait for another writer instead of failing with
+    # "database is locked"
+    ("busy_timeout", 5000),
+]
+
+# Connections kept open for sessions of FUSE workers and the other threads.
+# Sessions may nest in a thread, so connections are never shared by thread.
+POOL_SIZE = 16
+# Connections opened beyond POOL_SIZE, which are closed once returned
+MAX_OVERFLOW = 64
+
+
+def set_pragmas(dbapi_conn, _):
+    # Let SQLAlchemy emit BEGIN, since pysqlite begins transactions only
+    # before DML and thus breaks SAVEPOINT
+    dbapi_conn.isolation_level = None
+    cursor = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+    cursor.close()
 
 
 def setup_db(path):
-    engine = create_engine(path, echo=False)
+    if make_url(path).database in (None, "", ":memory:"):
+        engine = create_engine(path, echo=False)
+    else:
+        # Every session uses a connection of its own, without connecting
+        # for every operation
+        engine = create_engine(path, echo=False, poolclass=QueuePool,
+                               pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                               connect_args={"check_same_thread": False})
+        event.listen(engine, "connect", set_pragmas)
+        event.listen(engine, "begin", lambda conn: conn.execute("BEGIN"))
     Base.metadata.create_all(engine)
+    ensure_schema(engine)
     from . import session
     session.Session = sessionmaker(bind=engine)  # type: ignore
 
 
+def ensure_schema(engine) -> List[str]:
+    """
+    Add columns and create indexes missing in a database made by an older
+    version, which create_all leaves as they are since their tables exist.
+    Return names of added columns as "table.column" and created indexes.
+    """
+    logger = logging.getLogger(__name__)
+    inspector = inspect(engine)
+    created = []
+
+    for table in Base.metadata.sorted_tables:
+        existing = set(column["name"]
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                name = "{}.{}".format(table.name, column.name)
+                logger.info("Adding column {}".format(name))
+                with engine.connect() as conn:
+                    conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        table.name, column.name,
+                        column.type.compile(engine.dialect)))
+                created.append(name)
+
+    indexes = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index["name"]
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index {}".format(index.name))
+                index.create(engine)
+                indexes.append(index.name)
+
+    if indexes:
+        # Let the planner know the new indexes are selective
+        with engine.connect() as conn:
+            conn.execute("ANALYZE")
+    return created + indexes
+
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
@@ -26,3 +114,191 @@ def session_scope():
         raise
     finally:
         session.close()
+
+
+class LazySession:
+    """
+    Proxy of Session which begins a session only when it is actually used.
+    """
+    def __init__(self):
+        self._session = None
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None
+
+    @property
+    def session(self):
+        if self._session is None:
+            from .session import Session
+            self._session = Session()
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+@contextmanager
+def lazy_session_scope():
+    """
+    Same as session_scope, but nothing is done if the session is not used.
+    """
+    lazy_session = LazySession()
+    try:
+        yield lazy_session
+        if lazy_session.started:
+            lazy_session.commit()
+    except:  # noqa: E722
+        if lazy_session.started:
+            lazy_session.rollback()
+        raise
+    finally:
+        if lazy_session.started:
+            lazy_session.close()
+
+
+def after_commit(session, callback):
+    """
+    Call callback() once the current transaction of session is committed.
+    """
+    if isinstance(session, LazySession):
+        session = session.session
+    # Callbacks of a write in a group commit of Writer
+    pending = session.info.get("pending_callbacks")
+    if pending is not None:
+        pending.append(callback)
+        return
+    event.listen(session, "after_commit", lambda _: callback(), once=True)
+
+
+class Writer(metaclass=Singleton):
+    """
+    Single thread applying metadata mutations, which commits the writes
+    queued while the previous commit was running together, so that a burst
+    of them costs one commit instead of one each, and a lone write is never
+    delayed.
+
+    Each write runs in a savepoint, so a failing one is rolled back alone,
+    and callbacks which it registered by after_commit are called only if
+    it succeeded. Until started, writes run in the transaction of the
+    caller as they did without the writer.
+    """
+
+    # Writes committed together at most
+    MAX_BATCH = 256
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def started(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Commit the writes queued so far and stop the thread
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, func: Callable, *args) -> Future:
+        """
+        Queue func(session, *args), whose result the future gets once it is
+        committed. Unless the writer is started, it is called at once in a
+        transaction of its own.
+        """
+        future: Future = Future()
+        if self._thread is None:
+            try:
+                with session_scope() as session:
+                    result = func(session, *args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            return future
+
+        self._queue.put((future, func, args))
+        return future
+
+    def run(self, session, func: Callable, *args):
+        """
+        Call func(session, *args) in the writer and return its result once
+        committed, or call it in session unless the writer is started.
+        """
+        if self._thread is None:
+            return func(session, *args)
+        return self.submit(func, *args).result()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+    def _commit(self, batch) -> None:
+        from .session import Session
+        session = Session()
+        done = []
+        callbacks: List[Callable[[], None]] = []
+
+        try:
+            for future, func, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                pending: List[Callable[[], None]] = []
+                session.info["pending_callbacks"] = pending
+                savepoint = session.begin_nested()
+                try:
+                    result = func(session, *args)
+                    savepoint.commit()
+                except BaseException as e:
+                    savepoint.rollback()
+                    future.set_exception(e)
+                    continue
+                finally:
+                    del session.info["pending_callbacks"]
+                callbacks.extend(pending)
+                done.append((future, result))
+
+            session.commit()
+        except BaseException as e:
+            self.logger.exception("Failed to commit {} writes".format(
+                len(done)))
+            session.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+            return
+        finally:
+            session.close()
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                self.logger.exception("Failed to call a commit callback")
+        for future, result in done:
+            future.set_result(result)
@@ -610,6 +610,68 @@ def fuse_exit():
     _libfuse.fuse_exit(fuse_ptr)
 
 
+_has_notify = all(hasattr(_libfuse, name) for name in (
+    'fuse_get_session', 'fuse_session_next_chan',
+    'fuse_lowlevel_notify_inval_entry', 'fuse_lowlevel_notify_inval_inode'))
+
+if _has_notify:
+    _libfuse.fuse_get_session.argtypes = (ctypes.c_void_p,)
+    _libfuse.fuse_get_session.restype = ctypes.c_void_p
+    _libfuse.fuse_session_next_chan.argtypes = (
+        ctypes.c_void_p, ctypes.c_void_p)
+    _libfuse.fuse_session_next_chan.restype = ctypes.c_void_p
+    _libfuse.fuse_lowlevel_notify_inval_entry.argtypes = (
+        ctypes.c_void_p, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_size_t)
+    _libfuse.fuse_lowlevel_notify_inval_inode.argtypes = (
+        ctypes.c_void_p, ctypes.c_ulong, c_off_t, c_off_t)
+
+
+class KernelNotifier(object):
+    '''
+    Invalidates entries and inodes cached by the kernel through
+    fuse_lowlevel_notify_inval_entry/inode (libfuse >= 2.8).
+
+    The channel is taken from the fuse context, so attach() must be called
+    from inside an operation, e.g. init. Do not call inval_* while the
+    kernel waits for an operation on the same directory: it may deadlock.
+    '''
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self._chan = None
+
+    @property
+    def attached(self):
+        return self._chan is not None
+
+    def attach(self, chan=None):
+        if chan is None:
+            if not _has_notify:
+                return
+            fuse_ptr = ctypes.c_void_p(
+                _libfuse.fuse_get_context().contents.fuse)
+            session = _libfuse.fuse_get_session(fuse_ptr)
+            chan = _libfuse.fuse_session_next_chan(session, None)
+        self._chan = ctypes.c_void_p(chan)
+
+    def inval_entry(self, parent, name):
+        'Returns -ENOENT if the kernel does not cache the entry.'
+
+        if self._chan is None:
+            return -errno.ENOSYS
+        name = name.encode(self.encoding)
+        return _libfuse.fuse_lowlevel_notify_inval_entry(
+            self._chan, parent, name, len(name))
+
+    def inval_inode(self, ino, offset=0, length=0):
+        'Invalidates attributes, and cached data unless offset < 0.'
+
+        if self._chan is None:
+            return -errno.ENOSYS
+        return _libfuse.fuse_lowlevel_notify_inval_inode(
+            self._chan, ino, offset, length)
+
+
 class FUSE(object):
     '''
     This class is the lower level interface and should not be subclassed under
@@ -639,6 +701,22 @@ class FUSE(object):
         self.encoding = encoding
         self.__critical_exception = None
 
+        # If the operations implement readinto, read fills the kernel
+        # buffer directly instead of copying the bytes returned by read
+        self.use_readinto = getattr(operations, 'readinto', None) is not None
+
+        # If set, write receives a memoryview over the kernel buffer
+        # instead of a copy of it as bytes. It must not be kept after write
+        # returns.
+        self.use_write_memoryview = getattr(
+            operations, 'use_write_memoryview', False)
+
+        # If set, readdir also receives the offset the kernel resumes from,
+        # and returns entries with nonzero offsets from there on, so that a
+        # large directory is listed in chunks instead of all at once.
+        self.use_readdir_offset = getattr(
+            operations, 'use_readdir_offset', False)
+
         self.use_ns = getattr(operations, 'use_ns', False)
         if not self.use_ns:
             warnings.warn(
@@ -837,6 +915,19 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
+        if self.use_readinto:
+            array = (ctypes.c_ubyte * size).from_address(
+                ctypes.addressof(buf.contents))
+            # The buffer is only valid during this call
+            with memoryview(array) as view:
+                retsize = self.operations(
+                    'readinto', self._decode_optional_path(path), view,
+                    offset, fh)
+
+            assert retsize <= size, \
+                'actual amount read %d greater than expected %d' % (retsize, size)
+            return retsize
+
         ret = self.operations('read', self._decode_optional_path(path), size,
                                       offset, fh)
 
@@ -851,13 +942,22 @@ class FUSE(object):
         return retsize
 
     def write(self, path, buf, size, offset, fip):
-        data = ctypes.string_at(buf, size)
-
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
+        if self.use_write_memoryview:
+            array = (ctypes.c_ubyte * size).from_address(
+                ctypes.addressof(buf.contents))
+            # The buffer is only valid during this call
+            with memoryview(array) as data:
+                return self.operations(
+                    'write', self._decode_optional_path(path), data, offset,
+                    fh)
+
+        data = ctypes.string_at(buf, size)
+
         return self.operations('write', self._decode_optional_path(path), data,
                                         offset, fh)
 
@@ -952,8 +1052,16 @@ class FUSE(object):
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', self._decode_optional_path(path),
-                                               fip.contents.fh):
+        if self.use_readdir_offset:
+            items = self.operations('readdir',
+                                    self._decode_optional_path(path),
+                                    fip.contents.fh, offset)
+        else:
+            items = self.operations('readdir',
+                                    self._decode_optional_path(path),
+                                    fip.contents.fh)
+
+        for item in items:
 
             if isinstance(item, basestring):
                 name, st, offset = item, None, 0
@@ -1176,10 +1284,20 @@ class Operations(object):
 
         raise FuseOSError(errno.EIO)
 
+    # readinto(self, path, buf, offset, fh) may be implemented instead of
+    # read. It fills the writable memoryview buf, whose length is the size
+    # requested, and returns the number of bytes read.
+    readinto = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
         tuples. attrs is a dict as in getattr.
+
+        If use_readdir_offset is set, it is called as readdir(path, fh,
+        offset) and returns entries following the one with the offset.
+        The offset of each entry must then be nonzero. Returning no entries
+        ends the listing.
         '''
 
         return ['.', '..']
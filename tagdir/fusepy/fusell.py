@@ -0,0 +1,658 @@
+# Copyright (c) 2012 Terence Honles <terence@honles.com> (maintainer)
+# Copyright (c) 2008 Giorgos Verigakis <verigak@gmail.com> (author)
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''
+Bindings of the low-level API of libfuse 2, where the kernel identifies
+nodes by inode numbers returned from lookup instead of passing full paths.
+
+Only Linux is supported.
+'''
+
+import ctypes
+import errno
+import logging
+
+from functools import partial
+from signal import signal, SIGINT, SIG_DFL
+from typing import Any, Callable, Optional
+
+from .exceptions import FuseOSError
+from .fuse import (_libfuse, c_dev_t, c_mode_t, c_off_t, c_stat, c_statvfs,
+                   fuse_file_info, set_st_attrs)
+
+log = logging.getLogger("fuse.ll")
+
+FUSE_ROOT_ID = 1
+
+# Bits of to_set of setattr
+FUSE_SET_ATTR_MODE = 1 << 0
+FUSE_SET_ATTR_UID = 1 << 1
+FUSE_SET_ATTR_GID = 1 << 2
+FUSE_SET_ATTR_SIZE = 1 << 3
+FUSE_SET_ATTR_ATIME = 1 << 4
+FUSE_SET_ATTR_MTIME = 1 << 5
+FUSE_SET_ATTR_ATIME_NOW = 1 << 7
+FUSE_SET_ATTR_MTIME_NOW = 1 << 8
+
+fuse_ino_t = ctypes.c_ulong
+fuse_req_t = ctypes.c_void_p
+fuse_file_info_p = ctypes.POINTER(fuse_file_info)
+
+
+class fuse_entry_param(ctypes.Structure):
+    _fields_ = [
+        ('ino', fuse_ino_t),
+        ('generation', ctypes.c_ulong),
+        ('attr', c_stat),
+        ('attr_timeout', ctypes.c_double),
+        ('entry_timeout', ctypes.c_double)]
+
+
+class fuse_args(ctypes.Structure):
+    _fields_ = [
+        ('argc', ctypes.c_int),
+        ('argv', ctypes.POINTER(ctypes.c_char_p)),
+        ('allocated', ctypes.c_int)]
+
+
+def _reply_t(*argtypes):
+    return ctypes.CFUNCTYPE(None, fuse_req_t, *argtypes)
+
+
+class fuse_lowlevel_ops(ctypes.Structure):
+    _fields_ = [
+        ('init', ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)),
+        ('destroy', ctypes.CFUNCTYPE(None, ctypes.c_void_p)),
+        ('lookup', _reply_t(fuse_ino_t, ctypes.c_char_p)),
+        ('forget', _reply_t(fuse_ino_t, ctypes.c_ulong)),
+        ('getattr', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('setattr', _reply_t(fuse_ino_t, ctypes.POINTER(c_stat),
+                             ctypes.c_int, fuse_file_info_p)),
+        ('readlink', _reply_t(fuse_ino_t)),
+        ('mknod', _reply_t(fuse_ino_t, ctypes.c_char_p, c_mode_t, c_dev_t)),
+        ('mkdir', _reply_t(fuse_ino_t, ctypes.c_char_p, c_mode_t)),
+        ('unlink', _reply_t(fuse_ino_t, ctypes.c_char_p)),
+        ('rmdir', _reply_t(fuse_ino_t, ctypes.c_char_p)),
+        ('symlink', _reply_t(ctypes.c_char_p, fuse_ino_t, ctypes.c_char_p)),
+        ('rename', _reply_t(fuse_ino_t, ctypes.c_char_p,
+                            fuse_ino_t, ctypes.c_char_p)),
+        ('link', _reply_t(fuse_ino_t, fuse_ino_t, ctypes.c_char_p)),
+        ('open', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('read', _reply_t(fuse_ino_t, ctypes.c_size_t, c_off_t,
+                          fuse_file_info_p)),
+        ('write', _reply_t(fuse_ino_t, ctypes.POINTER(ctypes.c_byte),
+                           ctypes.c_size_t, c_off_t, fuse_file_info_p)),
+        ('flush', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('release', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('fsync', _reply_t(fuse_ino_t, ctypes.c_int, fuse_file_info_p)),
+        ('opendir', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('readdir', _reply_t(fuse_ino_t, ctypes.c_size_t, c_off_t,
+                             fuse_file_info_p)),
+        ('releasedir', _reply_t(fuse_ino_t, fuse_file_info_p)),
+        ('fsyncdir', _reply_t(fuse_ino_t, ctypes.c_int, fuse_file_info_p)),
+        ('statfs', _reply_t(fuse_ino_t)),
+        ('setxattr', _reply_t(fuse_ino_t, ctypes.c_char_p,
+                              ctypes.POINTER(ctypes.c_byte), ctypes.c_size_t,
+                              ctypes.c_int)),
+        ('getxattr', _reply_t(fuse_ino_t, ctypes.c_char_p, ctypes.c_size_t)),
+        ('listxattr', _reply_t(fuse_ino_t, ctypes.c_size_t)),
+        ('removexattr', _reply_t(fuse_ino_t, ctypes.c_char_p)),
+        ('access', _reply_t(fuse_ino_t, ctypes.c_int)),
+        ('create', _reply_t(fuse_ino_t, ctypes.c_char_p, c_mode_t,
+                            fuse_file_info_p)),
+        # Not supported, left NULL
+        ('getlk', ctypes.c_void_p),
+        ('setlk', ctypes.c_void_p),
+        ('bmap', ctypes.c_void_p),
+        ('ioctl', ctypes.c_void_p),
+        ('poll', ctypes.c_void_p),
+        ('write_buf', ctypes.c_void_p),
+        ('retrieve_reply', ctypes.c_void_p),
+        ('forget_multi', ctypes.c_void_p),
+        ('flock', ctypes.c_void_p),
+        ('fallocate', ctypes.c_void_p)]
+
+
+_has_lowlevel = hasattr(_libfuse, 'fuse_lowlevel_new')
+
+if _has_lowlevel:
+    def _declare(name, restype, *argtypes):
+        func = getattr(_libfuse, name)
+        func.restype = restype
+        func.argtypes = argtypes
+
+    _args_p = ctypes.POINTER(fuse_args)
+    _entry_p = ctypes.POINTER(fuse_entry_param)
+    _void_p = ctypes.c_void_p
+
+    _declare('fuse_mount', _void_p, ctypes.c_char_p, _args_p)
+    _declare('fuse_unmount', None, ctypes.c_char_p, _void_p)
+    _declare('fuse_lowlevel_new', _void_p, _args_p,
+             ctypes.POINTER(fuse_lowlevel_ops), ctypes.c_size_t, _void_p)
+    _declare('fuse_set_signal_handlers', ctypes.c_int, _void_p)
+    _declare('fuse_remove_signal_handlers', None, _void_p)
+    _declare('fuse_session_add_chan', None, _void_p, _void_p)
+    _declare('fuse_session_remove_chan', None, _void_p)
+    _declare('fuse_session_loop', ctypes.c_int, _void_p)
+    _declare('fuse_session_loop_mt', ctypes.c_int, _void_p)
+    _declare('fuse_session_exit', None, _void_p)
+    _declare('fuse_session_destroy', None, _void_p)
+
+    _declare('fuse_reply_err', ctypes.c_int, fuse_req_t, ctypes.c_int)
+    _declare('fuse_reply_none', None, fuse_req_t)
+    _declare('fuse_reply_entry', ctypes.c_int, fuse_req_t, _entry_p)
+    _declare('fuse_reply_create', ctypes.c_int, fuse_req_t, _entry_p,
+             fuse_file_info_p)
+    _declare('fuse_reply_attr', ctypes.c_int, fuse_req_t,
+             ctypes.POINTER(c_stat), ctypes.c_double)
+    _declare('fuse_reply_readlink', ctypes.c_int, fuse_req_t,
+             ctypes.c_char_p)
+    _declare('fuse_reply_open', ctypes.c_int, fuse_req_t, fuse_file_info_p)
+    _declare('fuse_reply_write', ctypes.c_int, fuse_req_t, ctypes.c_size_t)
+    _declare('fuse_reply_buf', ctypes.c_int, fuse_req_t, _void_p,
+             ctypes.c_size_t)
+    _declare('fuse_reply_statfs', ctypes.c_int, fuse_req_t,
+             ctypes.POINTER(c_statvfs))
+    _declare('fuse_reply_xattr', ctypes.c_int, fuse_req_t, ctypes.c_size_t)
+    _declare('fuse_add_direntry', ctypes.c_size_t, fuse_req_t, _void_p,
+             ctypes.c_size_t, ctypes.c_char_p, ctypes.POINTER(c_stat),
+             c_off_t)
+
+
+def _time_ns(ts):
+    return ts.tv_sec * 10 ** 9 + ts.tv_nsec
+
+
+class FUSELL(object):
+    '''
+    Mounts operations implementing LLOperations with the low-level API.
+    It runs in the foreground until unmounted.
+    '''
+
+    OPTIONS = (
+        ('debug', '-d'),
+    )
+
+    def __init__(self, operations, mountpoint, encoding='utf-8',
+                 nothreads=False, **kwargs):
+        if not _has_lowlevel:
+            raise EnvironmentError('libfuse has no low-level API')
+
+        self.operations = operations
+        self.encoding = encoding
+        self.chan = None
+        self.session = None
+        self.__critical_exception = None
+
+        # As for FUSE, see there
+        self.use_readinto = getattr(operations, 'readinto', None) is not None
+        self.use_write_memoryview = getattr(
+            operations, 'use_write_memoryview', False)
+        self.keep_cache = getattr(operations, 'keep_cache', False)
+
+        args = ['fuse']
+        args.extend(flag for arg, flag in self.OPTIONS
+                    if kwargs.pop(arg, False))
+        kwargs.setdefault('fsname', operations.__class__.__name__)
+        args.append('-o')
+        args.append(','.join(self._normalize_fuse_options(**kwargs)))
+
+        args = [arg.encode(encoding) for arg in args]
+        argv = (ctypes.c_char_p * len(args))(*args)
+        fargs = fuse_args(len(args), argv, 0)
+
+        ll_ops = fuse_lowlevel_ops()
+        for name, prototype in fuse_lowlevel_ops._fields_:
+            if prototype is ctypes.c_void_p:
+                continue
+            if getattr(operations, name, None) is None:
+                continue
+            if name in ('init', 'destroy'):
+                wrapper = self._wrapper_noreq
+            elif name == 'forget':
+                wrapper = self._wrapper_forget
+            else:
+                wrapper = self._wrapper
+            setattr(ll_ops, name,
+                    prototype(partial(wrapper, getattr(self, name))))
+
+        try:
+            old_handler = signal(SIGINT, SIG_DFL)
+        except ValueError:
+            old_handler = SIG_DFL
+
+        mountpoint = mountpoint.encode(encoding)
+        chan = _libfuse.fuse_mount(mountpoint, ctypes.byref(fargs))
+        if not chan:
+            raise RuntimeError('fuse_mount failed')
+
+        err = -1
+        try:
+            session = _libfuse.fuse_lowlevel_new(
+                ctypes.byref(fargs), ctypes.byref(ll_ops),
+                ctypes.sizeof(ll_ops), None)
+            if session:
+                if _libfuse.fuse_set_signal_handlers(session) != -1:
+                    _libfuse.fuse_session_add_chan(session, chan)
+                    self.chan = chan
+                    self.session = session
+                    if nothreads:
+                        err = _libfuse.fuse_session_loop(session)
+                    else:
+                        err = _libfuse.fuse_session_loop_mt(session)
+                    _libfuse.fuse_remove_signal_handlers(session)
+                    _libfuse.fuse_session_remove_chan(chan)
+                _libfuse.fuse_session_destroy(session)
+        finally:
+            _libfuse.fuse_unmount(mountpoint, chan)
+
+        try:
+            signal(SIGINT, old_handler)
+        except ValueError:
+            pass
+
+        del self.operations     # Invoke the destructor
+        if self.__critical_exception:
+            raise self.__critical_exception
+        if err:
+            raise RuntimeError(err)
+
+    _normalize_fuse_options = staticmethod(
+        lambda **kargs: (key if value is True else '%s=%s' % (key, value)
+                         for key, value in kargs.items()
+                         if value is not False))
+
+    def _critical(self, func, e):
+        self.__critical_exception = e
+        log.critical(
+            "Uncaught critical exception from FUSE operation %s, aborting.",
+            func.__name__, exc_info=True)
+        if self.session:
+            _libfuse.fuse_session_exit(self.session)
+
+    def _wrapper(self, func, req, *args):
+        'Replies an error unless func replied'
+
+        try:
+            try:
+                func(req, *args)
+
+            except OSError as e:
+                if e.errno and e.errno > 0:
+                    log.debug(
+                        "FUSE operation %s raised a %s, returning errno %s.",
+                        func.__name__, type(e), e.errno, exc_info=True)
+                    _libfuse.fuse_reply_err(req, e.errno)
+                else:
+                    log.error(
+                        "FUSE operation %s raised an OSError with negative "
+                        "errno %s, returning errno.EINVAL.",
+                        func.__name__, e.errno, exc_info=True)
+                    _libfuse.fuse_reply_err(req, errno.EINVAL)
+
+            except Exception:
+                log.error("Uncaught exception from FUSE operation %s, "
+                          "returning errno.EIO.",
+                          func.__name__, exc_info=True)
+                _libfuse.fuse_reply_err(req, errno.EIO)
+
+        except BaseException as e:
+            self._critical(func, e)
+            _libfuse.fuse_reply_err(req, errno.EIO)
+
+    def _wrapper_forget(self, func, req, *args):
+        'forget never replies an error'
+
+        try:
+            func(*args)
+        except Exception:
+            log.error("Uncaught exception from FUSE operation forget",
+                      exc_info=True)
+        except BaseException as e:
+            self._critical(func, e)
+        _libfuse.fuse_reply_none(req)
+
+    def _wrapper_noreq(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            log.error("Uncaught exception from FUSE operation %s",
+                      func.__name__, exc_info=True)
+        except BaseException as e:
+            self._critical(func, e)
+
+    def _decode(self, name):
+        return name.decode(self.encoding)
+
+    def _fill_entry(self, entry):
+        e = fuse_entry_param()
+        e.ino = entry['ino']
+        e.generation = entry.get('generation', 0)
+        set_st_attrs(e.attr, entry.get('attr', {}))
+        e.attr_timeout = entry.get('attr_timeout', 0.0)
+        e.entry_timeout = entry.get('entry_timeout', 0.0)
+        return e
+
+    def _reply_entry(self, req, entry):
+        _libfuse.fuse_reply_entry(req, ctypes.byref(self._fill_entry(entry)))
+
+    def _reply_attr(self, req, attr, timeout):
+        st = c_stat()
+        set_st_attrs(st, attr)
+        _libfuse.fuse_reply_attr(req, ctypes.byref(st), timeout)
+
+    def _reply_sized(self, req, data, size):
+        'Replies data, or its size when asked with size 0'
+
+        if size == 0:
+            _libfuse.fuse_reply_xattr(req, len(data))
+        elif len(data) > size:
+            _libfuse.fuse_reply_err(req, errno.ERANGE)
+        else:
+            _libfuse.fuse_reply_buf(req, data, len(data))
+
+    def init(self, userdata, conn):
+        self.operations.init(self.chan)
+
+    def destroy(self, userdata):
+        self.operations.destroy()
+
+    def lookup(self, req, parent, name):
+        self._reply_entry(req, self.operations.lookup(
+            parent, self._decode(name)))
+
+    def forget(self, ino, nlookup):
+        self.operations.forget(ino, nlookup)
+
+    def getattr(self, req, ino, fip):
+        fh = fip.contents.fh if fip else None
+        attr, timeout = self.operations.getattr(ino, fh)
+        self._reply_attr(req, attr, timeout)
+
+    def setattr(self, req, ino, attrp, to_set, fip):
+        st = attrp.contents
+        changes = {}
+        if to_set & FUSE_SET_ATTR_MODE:
+            changes['st_mode'] = st.st_mode
+        if to_set & FUSE_SET_ATTR_UID:
+            changes['st_uid'] = st.st_uid
+        if to_set & FUSE_SET_ATTR_GID:
+            changes['st_gid'] = st.st_gid
+        if to_set & FUSE_SET_ATTR_SIZE:
+            changes['st_size'] = st.st_size
+        # Times in nanoseconds, or None for now
+        if to_set & FUSE_SET_ATTR_ATIME_NOW:
+            changes['st_atime'] = None
+        elif to_set & FUSE_SET_ATTR_ATIME:
+            changes['st_atime'] = _time_ns(st.st_atimespec)
+        if to_set & FUSE_SET_ATTR_MTIME_NOW:
+            changes['st_mtime'] = None
+        elif to_set & FUSE_SET_ATTR_MTIME:
+            changes['st_mtime'] = _time_ns(st.st_mtimespec)
+
+        fh = fip.contents.fh if fip else None
+        attr, timeout = self.operations.setattr(ino, changes, fh)
+        self._reply_attr(req, attr, timeout)
+
+    def readlink(self, req, ino):
+        _libfuse.fuse_reply_readlink(
+            req, self.operations.readlink(ino).encode(self.encoding))
+
+    def mknod(self, req, parent, name, mode, rdev):
+        self._reply_entry(req, self.operations.mknod(
+            parent, self._decode(name), mode, rdev))
+
+    def mkdir(self, req, parent, name, mode):
+        self._reply_entry(req, self.operations.mkdir(
+            parent, self._decode(name), mode))
+
+    def unlink(self, req, parent, name):
+        self.operations.unlink(parent, self._decode(name))
+        _libfuse.fuse_reply_err(req, 0)
+
+    def rmdir(self, req, parent, name):
+        self.operations.rmdir(parent, self._decode(name))
+        _libfuse.fuse_reply_err(req, 0)
+
+    def symlink(self, req, link, parent, name):
+        self._reply_entry(req, self.operations.symlink(
+            self._decode(link), parent, self._decode(name)))
+
+    def rename(self, req, parent, name, newparent, newname):
+        self.operations.rename(parent, self._decode(name),
+                               newparent, self._decode(newname))
+        _libfuse.fuse_reply_err(req, 0)
+
+    def link(self, req, ino, newparent, newname):
+        self._reply_entry(req, self.operations.link(
+            ino, newparent, self._decode(newname)))
+
+    def open(self, req, ino, fip):
+        fi = fip.contents
+        fi.fh = self.operations.open(ino, fi.flags)
+        fi.keep_cache = self.keep_cache
+        _libfuse.fuse_reply_open(req, fip)
+
+    def read(self, req, ino, size, offset, fip):
+        fh = fip.contents.fh
+        if self.use_readinto:
+            buf = (ctypes.c_ubyte * size)()
+            with memoryview(buf) as view:
+                ret = self.operations.readinto(ino, view, offset, fh)
+            _libfuse.fuse_reply_buf(req, buf, ret)
+        else:
+            data = self.operations.read(ino, size, offset, fh)
+            _libfuse.fuse_reply_buf(req, data, len(data))
+
+    def write(self, req, ino, buf, size, offset, fip):
+        fh = fip.contents.fh
+        if self.use_write_memoryview:
+            array = (ctypes.c_ubyte * size).from_address(
+                ctypes.addressof(buf.contents))
+            # The buffer is only valid during this call
+            with memoryview(array) as data:
+                ret = self.operations.write(ino, data, offset, fh)
+        else:
+            data = ctypes.string_at(buf, size)
+            ret = self.operations.write(ino, data, offset, fh)
+        _libfuse.fuse_reply_write(req, ret)
+
+    def flush(self, req, ino, fip):
+        self.operations.flush(ino, fip.contents.fh)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def release(self, req, ino, fip):
+        self.operations.release(ino, fip.contents.fh)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def fsync(self, req, ino, datasync, fip):
+        self.operations.fsync(ino, datasync, fip.contents.fh)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def opendir(self, req, ino, fip):
+        fip.contents.fh = self.operations.opendir(ino)
+        _libfuse.fuse_reply_open(req, fip)
+
+    def readdir(self, req, ino, size, offset, fip):
+        buf = ctypes.create_string_buffer(size)
+        base = ctypes.addressof(buf)
+        pos = 0
+        st = c_stat()
+        for name, attr, next_offset in self.operations.readdir(
+                ino, offset, fip.contents.fh):
+            ctypes.memset(ctypes.byref(st), 0, ctypes.sizeof(st))
+            if attr:
+                set_st_attrs(st, attr)
+            needed = _libfuse.fuse_add_direntry(
+                req, base + pos, size - pos, name.encode(self.encoding),
+                ctypes.byref(st), next_offset)
+            if needed > size - pos:
+                break
+            pos += needed
+        _libfuse.fuse_reply_buf(req, buf, pos)
+
+    def releasedir(self, req, ino, fip):
+        self.operations.releasedir(ino, fip.contents.fh)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def fsyncdir(self, req, ino, datasync, fip):
+        self.operations.fsyncdir(ino, datasync, fip.contents.fh)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def statfs(self, req, ino):
+        stv = c_statvfs()
+        attrs = self.operations.statfs(ino)
+        for key, val in attrs.items():
+            if hasattr(stv, key):
+                setattr(stv, key, val)
+        _libfuse.fuse_reply_statfs(req, ctypes.byref(stv))
+
+    def setxattr(self, req, ino, name, value, size, flags):
+        self.operations.setxattr(ino, self._decode(name),
+                                 ctypes.string_at(value, size), flags)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def getxattr(self, req, ino, name, size):
+        self._reply_sized(
+            req, self.operations.getxattr(ino, self._decode(name)), size)
+
+    def listxattr(self, req, ino, size):
+        names = self.operations.listxattr(ino)
+        data = b''.join(name.encode(self.encoding) + b'\0' for name in names)
+        self._reply_sized(req, data, size)
+
+    def removexattr(self, req, ino, name):
+        self.operations.removexattr(ino, self._decode(name))
+        _libfuse.fuse_reply_err(req, 0)
+
+    def access(self, req, ino, mask):
+        self.operations.access(ino, mask)
+        _libfuse.fuse_reply_err(req, 0)
+
+    def create(self, req, parent, name, mode, fip):
+        fi = fip.contents
+        entry, fi.fh = self.operations.create(
+            parent, self._decode(name), mode, fi.flags)
+        fi.keep_cache = self.keep_cache
+        _libfuse.fuse_reply_create(
+            req, ctypes.byref(self._fill_entry(entry)), fip)
+
+
+# Type of operations which may be left None, so that subclasses may define
+# them as methods
+OptionalOperation = Optional[Callable[..., Any]]
+
+
+class LLOperations(object):
+    '''
+    Operations of the low-level API. Nodes are identified by inode numbers,
+    FUSE_ROOT_ID being the root.
+
+    Operations creating a node and lookup return an entry dict with keys
+    ino, attr (a dict as in Operations.getattr), and optionally generation,
+    attr_timeout and entry_timeout. Each of them increments the lookup count
+    of the node, which forget decrements.
+
+    Errors are raised as FuseOSError. An operation left None is not called
+    at all and the kernel sees ENOSYS.
+    '''
+
+    def init(self, chan):
+        'chan is the channel, which KernelNotifier.attach takes'
+        pass
+
+    def destroy(self):
+        pass
+
+    def lookup(self, parent, name):
+        'An entry with ino 0 caches the absence for entry_timeout'
+        raise FuseOSError(errno.ENOENT)
+
+    def forget(self, ino, nlookup):
+        pass
+
+    def getattr(self, ino, fh):
+        'Returns (attr, attr_timeout)'
+        raise FuseOSError(errno.ENOSYS)
+
+    def setattr(self, ino, changes, fh):
+        '''
+        changes has the keys which are set out of st_mode, st_uid, st_gid,
+        st_size, st_atime and st_mtime. Times are in nanoseconds, or None
+        for now. Returns (attr, attr_timeout).
+        '''
+        raise FuseOSError(errno.ENOSYS)
+
+    readlink = None  # type: OptionalOperation
+    mknod = None  # type: OptionalOperation
+    mkdir = None  # type: OptionalOperation
+    unlink = None  # type: OptionalOperation
+    rmdir = None  # type: OptionalOperation
+    symlink = None  # type: OptionalOperation
+    rename = None  # type: OptionalOperation
+    link = None  # type: OptionalOperation
+
+    def open(self, ino, flags):
+        'Returns a numerical file handle'
+        raise FuseOSError(errno.ENOSYS)
+
+    def read(self, ino, size, offset, fh):
+        raise FuseOSError(errno.EIO)
+
+    # If not None, called as readinto(ino, buf, offset, fh) instead of read
+    readinto = None  # type: OptionalOperation
+
+    def write(self, ino, data, offset, fh):
+        raise FuseOSError(errno.EROFS)
+
+    def flush(self, ino, fh):
+        pass
+
+    def release(self, ino, fh):
+        pass
+
+    def fsync(self, ino, datasync, fh):
+        pass
+
+    def opendir(self, ino):
+        'Returns a numerical directory handle'
+        return 0
+
+    def readdir(self, ino, offset, fh):
+        '''
+        Returns (name, attr, offset) of entries following the one with the
+        offset, including . and .., where each offset is nonzero. Only
+        st_ino and the type in st_mode of attr are used.
+        '''
+        raise FuseOSError(errno.ENOSYS)
+
+    def releasedir(self, ino, fh):
+        pass
+
+    def fsyncdir(self, ino, datasync, fh):
+        pass
+
+    def statfs(self, ino):
+        return {}
+
+    setxattr = None  # type: OptionalOperation
+    getxattr = None  # type: OptionalOperation
+    listxattr = None  # type: OptionalOperation
+    removexattr = None  # type: OptionalOperation
+
+    def access(self, ino, mask):
+        pass
+
+    create = None  # type: OptionalOperation
@@ -13,42 +13,176 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import logging
 import os
+import threading
 from errno import EACCES
-from threading import Lock
+from stat import S_IFDIR, S_IFLNK, S_IFREG
 
 from .exceptions import FuseOSError
 from .fuse import Operations
 
+# When data written through the mount is synced to disk:
+# STRICT on every flush (close), EXPLICIT only on fsync, and BATCHED on fsync
+# and periodically in the background for files written and flushed since the
+# last round.
+STRICT = 'strict'
+EXPLICIT = 'explicit'
+BATCHED = 'batched'
+DURABILITY_MODES = (STRICT, EXPLICIT, BATCHED)
+
+
+class FsyncBatcher(object):
+    '''
+    Syncs files written and then flushed every interval seconds from a
+    background thread.
+
+    A file released before it is synced stays open until the thread has
+    synced it, so that its descriptor is never reused in the meantime.
+    '''
+
+    # Sync early when this many files are waiting, to bound open descriptors
+    MAX_PENDING = 1024
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # Written since the last flush
+        self._written = set()
+        self._dirty = set()
+        self._syncing = set()
+        # Released files to be closed once synced
+        self._released = set()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def mark_written(self, fh):
+        with self._lock:
+            self._written.add(fh)
+
+    def flush(self, fh):
+        'Sync fh in the next round if it is written, or do nothing'
+        with self._lock:
+            if fh not in self._written:
+                return
+        self.mark_dirty(fh)
+
+    def mark_dirty(self, fh):
+        with self._lock:
+            self._written.discard(fh)
+            self._dirty.add(fh)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if len(self._dirty) >= self.MAX_PENDING:
+                self._wakeup.set()
+
+    def forget(self, fh):
+        'Called when fh is synced explicitly'
+        with self._lock:
+            self._written.discard(fh)
+            self._dirty.discard(fh)
+
+    def release(self, fh):
+        # Written, but released without a flush
+        self.flush(fh)
+        with self._lock:
+            if fh in self._dirty or fh in self._syncing:
+                self._released.add(fh)
+                return
+        os.close(fh)
+
+    def sync(self):
+        'Sync files flushed so far and close the released ones'
+        with self._sync_lock:
+            with self._lock:
+                batch = self._syncing = self._dirty
+                self._dirty = set()
+
+            for fh in batch:
+                try:
+                    os.fsync(fh)
+                except OSError:
+                    self.logger.exception('Failed to fsync %d', fh)
+
+            with self._lock:
+                self._syncing = set()
+                closing = self._released - self._dirty
+                self._released -= closing
+
+            for fh in closing:
+                os.close(fh)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sync()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.sync()
+
+
+def stat_to_attrs(st):
+    return dict((key, getattr(st, key)) for key in (
+        'st_atime', 'st_ctime', 'st_dev', 'st_gid', 'st_ino', 'st_mode',
+        'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+
 
 class Loopback(Operations):
-    def __init__(self):
-        self.rwlock = Lock()
+    '''
+    Operations taking a path also take dir_fd, which the path is relative to
+    unless it is None, as for the functions of os.
+    '''
 
-    def access(self, path, mode):
-        if not os.access(path, mode):
+    # os.pwrite takes any bytes-like object
+    use_write_memoryview = True
+
+    def __init__(self, durability=STRICT, fsync_interval=1.0):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability {}'.format(durability))
+        self.durability = durability
+        self.batcher = FsyncBatcher(fsync_interval) \
+            if durability == BATCHED else None
+
+    def access(self, path, mode, dir_fd=None):
+        if not os.access(path, mode, dir_fd=dir_fd):
             raise FuseOSError(EACCES)
 
     chmod = os.chmod
     chown = os.chown
 
-    def create(self, path, mode):
-        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    def create(self, path, mode, dir_fd=None):
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode,
+                       dir_fd=dir_fd)
+
+    def destroy(self, path):
+        if self.batcher is not None:
+            self.batcher.stop()
 
     def flush(self, path, fh):
-        return os.fsync(fh)
+        if self.durability == STRICT:
+            return os.fsync(fh)
+        if self.batcher is not None:
+            self.batcher.flush(fh)
 
     def fsync(self, path, datasync, fh):
+        if self.batcher is not None:
+            self.batcher.forget(fh)
         if datasync != 0:
             return os.fdatasync(fh)
         else:
             return os.fsync(fh)
 
-    def getattr(self, path, fh=None):
-        st = os.lstat(path)
-        return dict((key, getattr(st, key)) for key in (
-            'st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
-            'st_nlink', 'st_size', 'st_uid'))
+    def getattr(self, path, fh=None, dir_fd=None):
+        return stat_to_attrs(os.lstat(path, dir_fd=dir_fd))
 
     getxattr = None
 
@@ -57,31 +191,79 @@ class Loopback(Operations):
 
     listxattr = None
 
-    def mkdir(self, path, mode):
-        os.mkdir(path, mode)
+    def mkdir(self, path, mode, dir_fd=None):
+        os.mkdir(path, mode, dir_fd=dir_fd)
 
     mknod = os.mknod
     open = os.open
 
     def read(self, path, size, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.read(fh, size)
+        # pread/pwrite do not move the file offset, so no lock is needed
+        return os.pread(fh, size, offset)
+
+    if hasattr(os, 'preadv'):
+        def readinto(self, path, buf, offset, fh):
+            return os.preadv(fh, [buf], offset)
+    else:
+        def readinto(self, path, buf, offset, fh):
+            data = os.pread(fh, len(buf), offset)
+            buf[:len(data)] = data
+            return len(data)
+
+    def readdir(self, path, fh, dir_fd=None):
+        '''
+        Return (name, attrs, 0) of every entry, where attrs only have the
+        st_dev, st_ino and file type of st_mode which the listing gives, as
+        readdir of libfuse 2 keeps no other attributes.
+        '''
+        if dir_fd is None:
+            return ['.', '..'] + self._scandir(path)
+        # scandir takes no dir_fd
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
+        try:
+            return ['.', '..'] + self._scandir(fd)
+        finally:
+            os.close(fd)
 
-    def readdir(self, path, fh):
-        return ['.', '..'] + os.listdir(path)
+    @staticmethod
+    def _scandir(path):
+        # Entries are on the device of the directory but mount points
+        dev = os.stat(path).st_dev
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                # Stat-ed only if the filesystem gives no file type
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        mode = S_IFDIR
+                    elif entry.is_symlink():
+                        mode = S_IFLNK
+                    elif entry.is_file(follow_symlinks=False):
+                        mode = S_IFREG
+                    else:
+                        # Unknown type, which readers stat
+                        mode = 0
+                    attrs = {'st_dev': dev, 'st_ino': entry.inode(),
+                             'st_mode': mode}
+                except OSError:
+                    # Removed since listed
+                    attrs = None
+                entries.append((entry.name, attrs, 0))
+        return entries
 
-    def readlink(self, path):
-        os.readlink(path)
+    def readlink(self, path, dir_fd=None):
+        return os.readlink(path, dir_fd=dir_fd)
 
     def release(self, path, fh):
+        if self.batcher is not None:
+            return self.batcher.release(fh)
         return os.close(fh)
 
     def rename(self, old, new):
         return os.rename(old, new)
 
-    def rmdir(self, path):
-        os.rmdir(path)
+    def rmdir(self, path, dir_fd=None):
+        os.rmdir(path, dir_fd=dir_fd)
 
     def statfs(self, path):
         stv = os.statvfs(path)
@@ -92,16 +274,24 @@ class Loopback(Operations):
     def symlink(self, target, source):
         return os.symlink(source, target)
 
-    def truncate(self, path, length, fh=None):
-        with open(path, 'r+') as f:
-            f.truncate(length)
+    def truncate(self, path, length, fh=None, dir_fd=None):
+        if fh is not None:
+            os.ftruncate(fh, length)
+            if self.batcher is not None:
+                self.batcher.mark_written(fh)
+            return
+        fd = os.open(path, os.O_WRONLY, dir_fd=dir_fd)
+        try:
+            os.ftruncate(fd, length)
+        finally:
+            os.close(fd)
 
-    def unlink(self, path):
-        os.unlink(path)
+    def unlink(self, path, dir_fd=None):
+        os.unlink(path, dir_fd=dir_fd)
 
     utimens = os.utime
 
     def write(self, path, data, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.write(fh, data)
+        if self.batcher is not None:
+            self.batcher.mark_written(fh)
+        return os.pwrite(fh, data, offset)
@@ -0,0 +1,173 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+from .models import Entity, Tag, tagging
+from .singleton import Singleton
+
+
+def _new_ids() -> array:
+    # Unsigned 64 bits, as rowids of SQLite
+    return array("Q")
+
+
+def _remove(ids: array, id_: int) -> None:
+    i = bisect_left(ids, id_)
+    if i < len(ids) and ids[i] == id_:
+        del ids[i]
+
+
+class TagIndex(metaclass=Singleton):
+    """
+    In-memory inverted index of tag id -> sorted array of entity ids.
+
+    It is loaded from the database at mount time and then updated by the
+    callers after their transaction commits. Every update is idempotent, so
+    updates committed while loading are simply replayed on the new index.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.loaded = False
+        self._loading = False
+        self._replay: List[Callable[[], None]] = []
+        self._tag_ids: Dict[str, int] = {}
+        self._entity_ids: Dict[int, array] = {}
+        # Entities which exist, whose ids may still be in the arrays
+        # until they are removed from them
+        self._entities: Set[int] = set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.loaded = False
+            self._tag_ids = {}
+            self._entity_ids = {}
+            self._entities = set()
+
+    def load(self, session) -> None:
+        with self._lock:
+            self._loading = True
+            self._replay = []
+
+        try:
+            tag_ids = {name: id_ for id_, name in
+                       session.query(Tag.id, Tag.name)}
+            entity_ids: Dict[int, array] = \
+                {id_: _new_ids() for id_ in tag_ids.values()}
+            entities = {id_ for id_, in session.query(Entity.id)}
+            rows = session.query(tagging.c.tag_id, tagging.c.entity_id)\
+                .order_by(tagging.c.tag_id, tagging.c.entity_id)
+            for tag_id, entity_id in rows:
+                entity_ids.setdefault(tag_id, _new_ids()).append(entity_id)
+        except:  # noqa: E722
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self._tag_ids = tag_ids
+            self._entity_ids = entity_ids
+            self._entities = entities
+            for update in self._replay:
+                update()
+            self._replay = []
+            self._loading = False
+            self.loaded = True
+
+    def ensure_loaded(self, session) -> None:
+        if not self.loaded:
+            self.load(session)
+
+    def list_entity_ids(self, tag_names: List[str], after: int = 0,
+                        limit: Optional[int] = None) -> Optional[List[int]]:
+        """
+        Return ids greater than after of entities having all of the tags,
+        in ascending order and at most limit of them,
+        or None if some of the tags do not exist.
+        """
+        with self._lock:
+            return self._list_entity_ids(tag_names, after, limit)
+
+    def _list_entity_ids(self, tag_names: List[str], after: int,
+                         limit: Optional[int]) -> Optional[List[int]]:
+        # Called with the lock held
+        try:
+            tag_ids = [self._tag_ids[name] for name in tag_names]
+        except KeyError:
+            return None
+
+        # Walk the smallest array from after, and look each candidate up in
+        # the others by binary search, from where the previous one was found
+        # as candidates only grow. Only the result is materialized.
+        smallest, *others = sorted(
+            (self._entity_ids[id_] for id_ in set(tag_ids)), key=len)
+        los = [bisect_right(ids, after) for ids in others]
+        entities = self._entities
+        result: List[int] = []
+
+        for i in range(bisect_right(smallest, after), len(smallest)):
+            entity_id = smallest[i]
+            for j, ids in enumerate(others):
+                lo = los[j] = bisect_left(ids, entity_id, los[j])
+                if lo == len(ids):
+                    return result
+                if ids[lo] != entity_id:
+                    break
+            else:
+                if entity_id in entities:
+                    result.append(entity_id)
+                    if len(result) == limit:
+                        break
+        return result
+
+    # Updates. They must be called after the change is committed.
+
+    def add_tag(self, tag_id: int, name: str) -> None:
+        def update():
+            self._tag_ids[name] = tag_id
+            self._entity_ids.setdefault(tag_id, _new_ids())
+        self._update(update)
+
+    def remove_tag(self, tag_id: int, name: str) -> None:
+        def update():
+            if self._tag_ids.get(name) == tag_id:
+                del self._tag_ids[name]
+            self._entity_ids.pop(tag_id, None)
+        self._update(update)
+
+    def add_entity(self, entity_id: int) -> None:
+        def update():
+            self._entities.add(entity_id)
+        self._update(update)
+
+    def remove_entity(self, entity_id: int, tag_ids: List[int]) -> None:
+        def update():
+            self._entities.discard(entity_id)
+            for tag_id in tag_ids:
+                ids = self._entity_ids.get(tag_id)
+                if ids is not None:
+                    _remove(ids, entity_id)
+        self._update(update)
+
+    def add_tagging(self, tag_id: int, entity_id: int) -> None:
+        def update():
+            ids = self._entity_ids.setdefault(tag_id, _new_ids())
+            i = bisect_left(ids, entity_id)
+            if i == len(ids) or ids[i] != entity_id:
+                insort(ids, entity_id)
+        self._update(update)
+
+    def remove_tagging(self, tag_id: int, entity_id: int) -> None:
+        def update():
+            ids = self._entity_ids.get(tag_id)
+            if ids is not None:
+                _remove(ids, entity_id)
+        self._update(update)
+
+    def _update(self, update: Callable[[], None]) -> None:
+        with self._lock:
+            if self._loading:
+                self._replay.append(update)
+            if self.loaded:
+                update()
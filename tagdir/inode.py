@@ -0,0 +1,65 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+from .singleton import Singleton
+
+# Layout of inode numbers reported as st_ino:
+# - 1 << 63 | attrs.id for the root, tags, entities and the entinfo file
+# - a real inode number of the first device seen as it is
+# - 1 << 62 | device index << 56 | a real inode number of another device
+# - 1 << 62 | a serial number for anything which does not fit the above
+VIRTUAL = 1 << 63
+FOREIGN = 1 << 62
+DEV_SHIFT = 56
+MAX_DEVICES = FOREIGN >> DEV_SHIFT
+
+
+def virtual_ino(attr_id: int) -> int:
+    """
+    Inode number of the node whose attrs row has attr_id, which is stable
+    across mounts as the row is.
+    """
+    return VIRTUAL | attr_id
+
+
+class InodeMap(metaclass=Singleton):
+    """
+    Map (st_dev, st_ino) of backing content to inode numbers which never
+    collide with each other or with those of virtual nodes, so that hard
+    links of the same file share one. Real inode numbers are kept as far
+    as possible, and the mapping is stable while mounted.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._primary: Optional[int] = None
+        self._devices: Dict[int, int] = {}
+        self._serials: Dict[Tuple[int, int], int] = {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._primary = None
+            self._devices.clear()
+            self._serials.clear()
+
+    def backing_ino(self, st_dev: int, st_ino: int) -> int:
+        with self._lock:
+            if self._primary is None:
+                self._primary = st_dev
+
+            if st_dev == self._primary:
+                if st_ino < FOREIGN:
+                    return st_ino
+            else:
+                index = self._devices.get(st_dev)
+                if index is None and len(self._devices) < MAX_DEVICES - 1:
+                    # Index 0 is left for serial numbers
+                    index = self._devices[st_dev] = len(self._devices) + 1
+                if index is not None and st_ino < 1 << DEV_SHIFT:
+                    return FOREIGN | index << DEV_SHIFT | st_ino
+
+            key = (st_dev, st_ino)
+            serial = self._serials.get(key)
+            if serial is None:
+                serial = self._serials[key] = len(self._serials) + 1
+            return FOREIGN | serial
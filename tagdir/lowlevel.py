@@ -0,0 +1,449 @@
+from errno import EACCES, EBADF, ENOENT, ENOTSUP, EPERM
+import itertools
+import os
+from os.path import join
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from . import ENTINFO_PATH
+from .config import CacheConfig
+from .db import lazy_session_scope
+from .fusepy.exceptions import FuseOSError
+from .fusepy.fusell import FUSE_ROOT_ID, LLOperations
+from .fusepy.loopback import stat_to_attrs
+from .tagdir import parse_path, parse_path_for_tagging, Tagdir
+
+# Kinds of nodes
+ROOT = "root"
+ENTINFO = "entinfo"
+TAGS = "tags"          # /@tag_1/.../@tag_n
+ENTITY = "entity"      # /@tag_1/.../@tag_n/ent_name
+BACKING = "backing"    # anything below an entity directory
+TAGGING = "tagging"    # /@tag_1/.../@tag_n/%%encoded source, just made
+
+
+class Node:
+    def __init__(self, ino: int, kind: str, key,
+                 path: Optional[str] = None, fd: Optional[int] = None) -> None:
+        self.ino = ino
+        self.kind = kind
+        self.key = key
+        # Path in the mount, only for virtual nodes
+        self.path = path
+        # O_PATH fd of the real file, only for entities and backing nodes
+        self.fd = fd
+        self.nlookup = 0
+
+    @property
+    def virtual_path(self) -> str:
+        if self.path is None:
+            raise FuseOSError(EPERM)
+        return self.path
+
+    @property
+    def real_fd(self) -> int:
+        if self.fd is None:
+            raise FuseOSError(EPERM)
+        return self.fd
+
+    @property
+    def proc_path(self) -> str:
+        """
+        Path reopening the real file, which also works for operations which
+        take no fd such as chmod of an O_PATH fd.
+        """
+        return "/proc/self/fd/{}".format(self.real_fd)
+
+
+class InodeTable:
+    """
+    Nodes the kernel knows by inode number, with the number of lookups
+    which the kernel has not forgotten yet.
+
+    Virtual nodes are keyed by their path in the mount, and backing nodes by
+    (st_dev, st_ino) of the real file, so that hard links share a node.
+    Backing nodes hold an O_PATH fd of the real file, which their children
+    are looked up relative to without walking or resolving any path.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._next_ino = itertools.count(FUSE_ROOT_ID + 1)
+        self._nodes: Dict[int, Node] = {}
+        self._by_key: Dict[tuple, Node] = {}
+        root = Node(FUSE_ROOT_ID, ROOT, (ROOT, "/"), path="/")
+        # The root is never forgotten
+        root.nlookup = 1
+        self._nodes[root.ino] = root
+        self._by_key[root.key] = root
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get(self, ino: int) -> Node:
+        try:
+            return self._nodes[ino]
+        except KeyError:
+            raise FuseOSError(EBADF)
+
+    def add(self, kind: str, key: tuple, path: Optional[str] = None,
+            fd: Optional[int] = None) -> Node:
+        """
+        Return the node of key, creating it if it is new, and count a lookup.
+        fd is closed if the node already has one.
+        """
+        with self._lock:
+            node = self._by_key.get(key)
+            if node is None:
+                node = Node(next(self._next_ino), kind, key, path, fd)
+                self._nodes[node.ino] = node
+                self._by_key[key] = node
+                fd = None
+            node.nlookup += 1
+
+        if fd is not None:
+            os.close(fd)
+        return node
+
+    def forget(self, ino: int, nlookup: int) -> None:
+        with self._lock:
+            node = self._nodes.get(ino)
+            if node is None or node.kind == ROOT:
+                return
+            node.nlookup -= nlookup
+            if node.nlookup > 0:
+                return
+            del self._nodes[ino]
+            del self._by_key[node.key]
+
+        if node.fd is not None:
+            os.close(node.fd)
+
+    def clear(self) -> None:
+        with self._lock:
+            nodes = [node for node in self._nodes.values()
+                     if node.kind != ROOT]
+            for node in nodes:
+                del self._nodes[node.ino]
+                del self._by_key[node.key]
+
+        for node in nodes:
+            if node.fd is not None:
+                os.close(node.fd)
+
+    def lookup(self, path: str) -> Optional[int]:
+        """
+        Return the inode number of the virtual node at path if the kernel
+        knows it.
+        """
+        for kind in (ROOT, ENTINFO, TAGS, ENTITY):
+            node = self._by_key.get((kind, path))
+            if node is not None:
+                return node.ino
+        return None
+
+    def tag_dirs(self, within: Optional[Set[str]],
+                 touching: Set[str]) -> Iterable[str]:
+        """
+        Return paths of known tag directories /@t_1/.../@t_n such that
+        {t_1, ..., t_n} is a subset of within (unless it is None) and
+        shares a tag with touching.
+        """
+        with self._lock:
+            paths = [node.virtual_path for node in self._nodes.values()
+                     if node.kind == TAGS]
+
+        result = []
+        for path in paths:
+            tag_names = set(parse_path(path)[0])
+            if within is not None and not tag_names <= within:
+                continue
+            if tag_names & touching:
+                result.append(path)
+        return result
+
+
+class TagdirLL(LLOperations):
+    """
+    Operations of Tagdir on the low-level API.
+
+    The root, tag directories and entities are served by Tagdir with their
+    paths as the high-level API does, while everything below an entity
+    directory is served relative to fds of its parents, so that deep trees
+    cost neither path parsing nor queries per component. Entries and
+    attributes are cached by the kernel as long as CacheConfig tells for
+    each kind of node.
+    """
+
+    def __init__(self, tagdir: Tagdir, cache_config: CacheConfig) -> None:
+        self.tagdir = tagdir
+        self.cache_config = cache_config
+        self.keep_cache = cache_config.kernel_cache
+        self.table = InodeTable()
+        # directory handle -> entries of a backing directory
+        self._dirs: Dict[int, List[Tuple[str, Optional[dict], int]]] = {}
+        self._dir_handles = itertools.count(1)
+        self._taggings = itertools.count(1)
+
+    def _timeout(self, kind: str) -> float:
+        if kind == TAGGING:
+            return 0.0
+        if kind in (ROOT, ENTINFO):
+            return self.cache_config.root
+        if kind == TAGS:
+            return self.cache_config.tag
+        if kind == ENTITY:
+            return self.cache_config.entity
+        return self.cache_config.content
+
+    def _entry(self, node: Node, attrs: dict) -> dict:
+        timeout = self._timeout(node.kind)
+        return {"ino": node.ino, "attr": attrs,
+                "attr_timeout": timeout, "entry_timeout": timeout}
+
+    def _backing_attrs(self, st: os.stat_result) -> dict:
+        return self.tagdir.map_backing_ino(stat_to_attrs(st))
+
+    def _fd_node(self, ino: int) -> Node:
+        """
+        Return the node of ino if it has a real file, or raise EPERM
+        """
+        node = self.table.get(ino)
+        if node.fd is None:
+            raise FuseOSError(EPERM)
+        return node
+
+    def _lookup_backing(self, parent: Node, name: str) -> dict:
+        st = os.stat(name, dir_fd=parent.fd, follow_symlinks=False)
+        fd = os.open(name, os.O_PATH | os.O_NOFOLLOW, dir_fd=parent.fd)
+        node = self.table.add(BACKING, (BACKING, st.st_dev, st.st_ino),
+                              fd=fd)
+        return self._entry(node, self._backing_attrs(st))
+
+    def _lookup_virtual(self, path: str) -> dict:
+        attrs = self.tagdir("getattr", path)
+
+        if path == ENTINFO_PATH:
+            return self._entry(self.table.add(ENTINFO, (ENTINFO, path),
+                                              path), attrs)
+
+        tag_names, ent_name, _ = parse_path(path)
+        if ent_name is None:
+            return self._entry(self.table.add(TAGS, (TAGS, path), path),
+                               attrs)
+
+        with lazy_session_scope() as session:
+            resolved = self.tagdir.resolve_entity(session, tag_names,
+                                                  ent_name)
+        fd = os.open(resolved.entity_path, os.O_PATH | os.O_DIRECTORY)
+        return self._entry(self.table.add(ENTITY, (ENTITY, path), path, fd),
+                           attrs)
+
+    def _lookup(self, parent: Node, name: str) -> dict:
+        if parent.fd is not None:
+            return self._lookup_backing(parent, name)
+        if parent.kind == ENTINFO:
+            raise FuseOSError(ENOENT)
+        return self._lookup_virtual(join(parent.virtual_path, name))
+
+    def init(self, chan):
+        self.tagdir("init", "/", chan, self.table)
+
+    def destroy(self):
+        self.tagdir("destroy", "/")
+        self.table.clear()
+
+    def lookup(self, parent, name):
+        try:
+            return self._lookup(self.table.get(parent), name)
+        except OSError as e:
+            if e.errno != ENOENT or self.cache_config.negative <= 0:
+                raise
+            # Cache the absence
+            return {"ino": 0, "entry_timeout": self.cache_config.negative}
+
+    def forget(self, ino, nlookup):
+        self.table.forget(ino, nlookup)
+
+    def getattr(self, ino, fh):
+        node = self.table.get(ino)
+        if node.kind == BACKING:
+            attrs = self._backing_attrs(os.stat(node.real_fd))
+        else:
+            attrs = self.tagdir("getattr", node.path)
+        return attrs, self._timeout(node.kind)
+
+    def setattr(self, ino, changes, fh):
+        node = self._fd_node(ino)
+        path = node.proc_path
+
+        if "st_mode" in changes:
+            os.chmod(path, changes["st_mode"])
+        if "st_uid" in changes or "st_gid" in changes:
+            os.chown(path, changes.get("st_uid", -1),
+                     changes.get("st_gid", -1))
+        if "st_size" in changes:
+            if fh is not None:
+                self.tagdir.truncate(None, changes["st_size"], fh)
+            else:
+                os.truncate(path, changes["st_size"])
+        if "st_atime" in changes or "st_mtime" in changes:
+            st = os.stat(node.real_fd)
+            now = time.time_ns()
+            atime = changes.get("st_atime", st.st_atime_ns)
+            mtime = changes.get("st_mtime", st.st_mtime_ns)
+            os.utime(path, ns=(now if atime is None else atime,
+                               now if mtime is None else mtime))
+
+        return self.getattr(ino, fh)
+
+    def readlink(self, ino):
+        node = self._fd_node(ino)
+        return os.readlink("", dir_fd=node.fd)
+
+    def mknod(self, parent, name, mode, rdev):
+        node = self._fd_node(parent)
+        os.mknod(name, mode, rdev, dir_fd=node.fd)
+        return self._lookup_backing(node, name)
+
+    def mkdir(self, parent, name, mode):
+        node = self.table.get(parent)
+        if node.fd is not None:
+            os.mkdir(name, mode, dir_fd=node.fd)
+            return self._lookup_backing(node, name)
+
+        path = join(node.virtual_path, name)
+        self.tagdir("mkdir", path, mode)
+
+        _, source = parse_path_for_tagging(path)
+        if source is None:
+            return self._lookup_virtual(path)
+
+        # Tagging, where name is the encoded source path. Reply a node of its
+        # own for name, which the kernel drops at the next lookup, since an
+        # alias of the entity directory cached by the kernel may fail.
+        ent_path = join(node.virtual_path, os.path.basename(source))
+        attrs = self.tagdir("getattr", ent_path)
+        tagging = self.table.add(TAGGING, (TAGGING, next(self._taggings)),
+                                 ent_path)
+        return self._entry(tagging, attrs)
+
+    def unlink(self, parent, name):
+        os.unlink(name, dir_fd=self._fd_node(parent).fd)
+
+    def rmdir(self, parent, name):
+        node = self.table.get(parent)
+        if node.fd is not None:
+            os.rmdir(name, dir_fd=node.fd)
+        else:
+            self.tagdir("rmdir", join(node.virtual_path, name))
+
+    def symlink(self, link, parent, name):
+        node = self._fd_node(parent)
+        os.symlink(link, name, dir_fd=node.fd)
+        return self._lookup_backing(node, name)
+
+    def rename(self, parent, name, newparent, newname):
+        os.rename(name, newname, src_dir_fd=self._fd_node(parent).fd,
+                  dst_dir_fd=self._fd_node(newparent).fd)
+
+    def link(self, ino, newparent, newname):
+        node = self._fd_node(newparent)
+        os.link(self._fd_node(ino).proc_path, newname, dst_dir_fd=node.fd)
+        return self._lookup_backing(node, newname)
+
+    def open(self, ino, flags):
+        node = self.table.get(ino)
+        if node.kind != BACKING:
+            raise FuseOSError(ENOENT)
+        return os.open(node.proc_path, flags)
+
+    def create(self, parent, name, mode, flags):
+        node = self._fd_node(parent)
+        fh = os.open(name, flags | os.O_CREAT, mode, dir_fd=node.fd)
+        try:
+            return self._lookup_backing(node, name), fh
+        except OSError:
+            os.close(fh)
+            raise
+
+    # Data-plane operations go through Loopback, which keeps durability
+
+    def read(self, ino, size, offset, fh):
+        return self.tagdir.read(None, size, offset, fh)
+
+    def readinto(self, ino, buf, offset, fh):
+        return self.tagdir.readinto(None, buf, offset, fh)
+
+    def write(self, ino, data, offset, fh):
+        return self.tagdir.write(None, data, offset, fh)
+
+    use_write_memoryview = True
+
+    def flush(self, ino, fh):
+        self.tagdir.flush(None, fh)
+
+    def release(self, ino, fh):
+        self.tagdir.release(None, fh)
+
+    def fsync(self, ino, datasync, fh):
+        self.tagdir.fsync(None, datasync, fh)
+
+    def opendir(self, ino):
+        node = self.table.get(ino)
+        if node.fd is None:
+            return 0
+
+        # Entries are listed at once, so that offsets stay valid
+        entries: List[Tuple[str, Optional[dict], int]] = \
+            [(".", None, 1), ("..", None, 2)]
+        fd = os.open(node.proc_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, attrs, _ in self.tagdir._scandir(fd):
+                if attrs is not None:
+                    attrs = self.tagdir.map_backing_ino(attrs)
+                entries.append((name, attrs, len(entries) + 1))
+        finally:
+            os.close(fd)
+
+        fh = next(self._dir_handles)
+        self._dirs[fh] = entries
+        return fh
+
+    def readdir(self, ino, offset, fh):
+        if fh in self._dirs:
+            return self._dirs[fh][offset:]
+
+        node = self.table.get(ino)
+        # Offsets 1 and 2 are . and .., and the others are those of Tagdir
+        # shifted by 2
+        entries = [(".", None, 1), ("..", None, 2)][offset:]
+        entries.extend(
+            (name, attrs, entry_offset + 2)
+            for name, attrs, entry_offset in self.tagdir(
+                "readdir", node.path, fh, max(offset - 2, 0)))
+        return entries
+
+    def releasedir(self, ino, fh):
+        self._dirs.pop(fh, None)
+
+    def statfs(self, ino):
+        return self.tagdir("statfs", "/")
+
+    def getxattr(self, ino, name):
+        node = self.table.get(ino)
+        if node.kind != ENTINFO:
+            raise FuseOSError(ENOTSUP)
+        return self.tagdir("getxattr", node.path, name)
+
+    def listxattr(self, ino):
+        node = self.table.get(ino)
+        if node.kind != ENTINFO:
+            raise FuseOSError(ENOTSUP)
+        return self.tagdir("listxattr", node.path)
+
+    def access(self, ino, mask):
+        node = self.table.get(ino)
+        if node.fd is not None and not os.access(node.proc_path, mask):
+            raise FuseOSError(EACCES)
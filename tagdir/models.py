@@ -2,20 +2,27 @@ from __future__ import annotations
 import os
 import stat
 import time
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Table
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm import backref, joinedload, relationship
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.session import Session
 
+from .inode import virtual_ino
+
 Base = declarative_base()
 
+# Bound parameters per IN clause, well below SQLITE_MAX_VARIABLE_NUMBER
+IN_CHUNK_SIZE = 500
+
 tagging = Table("tagging", Base.metadata,
                 Column('entity_id', ForeignKey('entities.id'),
                        primary_key=True),
-                Column('tag_id', ForeignKey('tags.id'), primary_key=True))
+                Column('tag_id', ForeignKey('tags.id'), primary_key=True),
+                # The primary key only serves lookups by entity
+                Index("ix_tagging_tag_id_entity_id", "tag_id", "entity_id"))
 
 
 class Attr(Base):  # type: ignore
@@ -60,7 +67,9 @@ class Attr(Base):  # type: ignore
 
     def as_dict(self):
         from .fusepy.fuse import c_timespec
-        return {"st_mode": self.st_mode, "st_uid": self.st_uid,
+        # The attr of the entinfo file is never saved
+        return {"st_ino": virtual_ino(self.id or 0),
+                "st_mode": self.st_mode, "st_uid": self.st_uid,
                 "st_gid": self.st_gid,
                 "st_atimespec": c_timespec(self.st_atimespec, 0),
                 "st_mtimespec": c_timespec(self.st_mtimespec, 0),
@@ -73,7 +82,8 @@ class NodeMixIn:
 
     @declared_attr
     def attr_id(cls):
-        return Column(Integer, ForeignKey('attrs.id'))
+        # Looked up by the backref of attr when a node is deleted
+        return Column(Integer, ForeignKey('attrs.id'), index=True)
 
     @declared_attr
     def attr(cls):
@@ -88,6 +98,9 @@ class NodeMixIn:
 class Entity(NodeMixIn, Base):  # type: ignore
     __tablename__ = "entities"
     path = Column(String, unique=True)
+    # Fingerprint of the directory at path, to find it once it is moved
+    st_dev = Column(Integer)
+    st_ino = Column(Integer)
     tags = relationship("Tag", secondary=tagging, back_populates="entities")
 
     def __init__(self, name: str, attr: Attr,
@@ -116,6 +129,22 @@ class Entity(NodeMixIn, Base):  # type: ignore
 
         return entity
 
+    @staticmethod
+    def get_names_and_attrs(session: Session,
+                            ids: List[int]) -> List[Tuple[int, str, Attr]]:
+        """
+        Fetch (id, name, attr) of entities of ids ordered by id, in one query
+        per IN_CHUNK_SIZE ids which must be sorted.
+        """
+        result: List[Tuple[int, str, Attr]] = []
+        for i in range(0, len(ids), IN_CHUNK_SIZE):
+            query = session.query(Entity.id, Entity.name, Attr)\
+                .join(Entity.attr)\
+                .filter(Entity.id.in_(ids[i:i + IN_CHUNK_SIZE]))\
+                .order_by(Entity.id)
+            result.extend(query)
+        return result
+
     def has_tags(self, tags: List[Tag]) -> bool:
         for tag in tags:
             if tag not in self.tags:
@@ -134,6 +163,39 @@ class Tag(NodeMixIn, Base):  # type: ignore
     def __str__(self):
         return "@" + self.name
 
+    @staticmethod
+    def get_by_names(session: Session,
+                     names: List[str]) -> Tuple[List[Tag], List[str]]:
+        """
+        Fetch tags with their attrs in one query.
+        Return found tags in the order of names, and names not found.
+        """
+        query = session.query(Tag).options(joinedload(Tag.attr))
+        if len(names) == 1:
+            # The common path with one tag, by the unique index of name
+            try:
+                tag = query.filter(Tag.name == names[0]).one()
+            except NoResultFound:
+                return [], names
+            return [tag], []
+
+        found = {tag.name: tag for tag in
+                 query.filter(Tag.name.in_(set(names)))}
+        tags = [found[name] for name in names if name in found]
+        missing = [name for name in names if name not in found]
+        return tags, missing
+
+    @staticmethod
+    def get_names_and_attrs(session: Session, after: int = 0,
+                            limit: Optional[int] = None) \
+            -> List[Tuple[int, str, Attr]]:
+        """
+        Fetch (id, name, attr) of at most limit tags with ids greater than
+        after, ordered by id, in one query.
+        """
+        return session.query(Tag.id, Tag.name, Attr).join(Tag.attr)\
+            .filter(Tag.id > after).order_by(Tag.id).limit(limit).all()
+
     def remove(self, session: Session) -> None:
         """
         remove redundant entities, too
@@ -142,3 +204,9 @@ class Tag(NodeMixIn, Base):  # type: ignore
         for entity in self.entities:
             if not entity.tags:
                 session.delete(entity)
+
+
+# Tag.get_by_names reads whole rows from this without touching the table, as
+# id is the rowid which every index holds. Entities are looked up by a single
+# name, for which SQLite always takes the unique index of name.
+Index("ix_tags_name_covering", Tag.name, Tag.attr_id)
@@ -0,0 +1,121 @@
+from errno import ENOENT
+import logging
+import os
+import queue
+import threading
+from typing import Callable, Iterable, List, Optional, Set, TYPE_CHECKING
+
+from .db import after_commit
+from .singleton import Singleton
+
+if TYPE_CHECKING:
+    # Not imported at runtime, which needs libfuse
+    from .fusepy.fuse import KernelNotifier
+
+FUSE_ROOT_ID = 1
+
+
+class RootOnlyNodes:
+    """
+    Nodes known to the kernel as far as the high-level API tells us:
+    only the root has a fixed node id, so only entries of tags in the root
+    are invalidated, and entries of entities are left to time out.
+    """
+
+    def lookup(self, path: str) -> Optional[int]:
+        return FUSE_ROOT_ID if path == "/" else None
+
+    def tag_dirs(self, within: Optional[Set[str]],
+                 touching: Set[str]) -> Iterable[str]:
+        """
+        Return paths of known tag directories /@t_1/.../@t_n such that
+        {t_1, ..., t_n} is a subset of within (unless it is None) and
+        shares a tag with touching.
+        """
+        return []
+
+
+class KernelCacheInvalidator(metaclass=Singleton):
+    """
+    Tell the kernel to drop entries and attributes it caches for nodes
+    changed by tagdir itself or by the watcher.
+
+    Notifications are queued after the change commits and sent from a
+    worker thread, because sending them from inside the operation which
+    caused the change may deadlock.
+    """
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.notifier: Optional["KernelNotifier"] = None
+        self.nodes = RootOnlyNodes()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, notifier: "KernelNotifier", nodes=None) -> None:
+        self.notifier = notifier
+        if nodes is not None:
+            self.nodes = nodes
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            notify = self._queue.get()
+            try:
+                notify()
+            except Exception:
+                self.logger.exception("Failed to invalidate kernel cache")
+
+    def _on_commit(self, session, notify: Callable[[], None]) -> None:
+        if self.notifier is not None:
+            after_commit(session, lambda: self._queue.put(notify))
+
+    def _inval_entry(self, path: str) -> None:
+        parent = self.nodes.lookup(os.path.dirname(path))
+        if parent is None or self.notifier is None:
+            return
+        err = self.notifier.inval_entry(parent, os.path.basename(path))
+        if err and err != -ENOENT:
+            self.logger.debug("inval_entry {} returned {}".format(path, err))
+
+    def _inval_inode(self, path: str) -> None:
+        ino = self.nodes.lookup(path)
+        if ino is not None and self.notifier is not None:
+            self.notifier.inval_inode(ino)
+
+    def tags_changed(self, session, tag_names: List[str]) -> None:
+        """
+        Tags were created or removed
+        """
+        def notify():
+            self._inval_inode("/")
+            # Known tag directories of the tags include /@tag themselves
+            paths = ["/@" + tag_name for tag_name in tag_names]
+            known = set(paths)
+            paths.extend(path for path in
+                         self.nodes.tag_dirs(None, set(tag_names))
+                         if path not in known)
+            for path in paths:
+                self._inval_entry(path)
+        self._on_commit(session, notify)
+
+    def entity_changed(self, session, ent_names: List[str],
+                       tag_names: List[str],
+                       changed_tag_names: Optional[List[str]] = None) -> None:
+        """
+        Entries ent_names appeared or disappeared in tag directories which
+        only consist of tag_names and include some of changed_tag_names
+        (all of tag_names if it is None).
+        """
+        within = set(tag_names)
+        touching = within if changed_tag_names is None \
+            else set(changed_tag_names)
+
+        def notify():
+            for path in self.nodes.tag_dirs(within, touching):
+                self._inval_inode(path)
+                for ent_name in ent_names:
+                    self._inval_entry(os.path.join(path, ent_name))
+        self._on_commit(session, notify)
@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import bindparam
+
+from .db import session_scope, Writer
+from .models import Entity
+
+# Threads stating entity paths, which mostly wait for the disk unless its
+# metadata is cached
+STAT_WORKERS = 32
+# Directories read at most in all trees searched for moved entities at once
+MAX_SCAN = 100000
+
+# (st_dev, st_ino) of a directory
+Fingerprint = Tuple[int, int]
+
+
+def stat_all(paths: List[str], workers: int = STAT_WORKERS) \
+        -> Tuple[Dict[str, Fingerprint], Set[str]]:
+    """
+    Stat paths by workers threads. Return fingerprints of existing paths,
+    and missing paths. Paths which cannot be stated for other reasons are
+    in neither.
+    """
+    size = max(1, -(-len(paths) // workers))
+    chunks = [paths[i:i + size] for i in range(0, len(paths), size)]
+    found: Dict[str, Fingerprint] = {}
+    missing: Set[str] = set()
+    with ThreadPoolExecutor(workers) as executor:
+        for chunk_found, chunk_missing in executor.map(_stat, chunks):
+            found.update(chunk_found)
+            missing |= chunk_missing
+    return found, missing
+
+
+def _stat(paths: List[str]) -> Tuple[Dict[str, Fingerprint], Set[str]]:
+    found = {}
+    missing = set()
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            missing.add(path)
+        except OSError:
+            pass
+        else:
+            found[path] = (st.st_dev, st.st_ino)
+    return found, missing
+
+
+def relocate(lost: Dict[str, Fingerprint], taken: Set[str],
+             searched: Optional[Set[str]] = None) -> Dict[str, str]:
+    """
+    Look for the directories of fingerprints of lost paths in the whole
+    tree of the nearest existing ancestor of each path, deepest trees
+    first, reading MAX_SCAN directories at most. Return the new path of
+    each lost path which is found.
+
+    Lost paths which are not found are left out, as they may have been
+    moved out of the tree, and so are those on a filesystem which is not
+    mounted now, and those found at paths in taken. If searched is given,
+    lost paths whose tree is read are added to it.
+    """
+    logger = logging.getLogger(__name__)
+    devs: Dict[str, Optional[int]] = {}
+
+    def dev_of(path: str) -> Optional[int]:
+        if path not in devs:
+            try:
+                devs[path] = os.stat(path).st_dev
+            except OSError:
+                devs[path] = None
+        return devs[path]
+
+    # ancestor -> ino -> lost path of lost paths in it
+    trees: Dict[str, Dict[int, str]] = {}
+    for path, (dev, ino) in lost.items():
+        ancestor = os.path.dirname(path)
+        while dev_of(ancestor) is None:
+            ancestor = os.path.dirname(ancestor)
+        if dev_of(ancestor) != dev:
+            continue
+        trees.setdefault(ancestor, {})[ino] = path
+
+    moves: Dict[str, str] = {}
+    budget = MAX_SCAN
+    for ancestor in sorted(trees, key=lambda path: -path.count(os.sep)):
+        wanted = trees[ancestor]
+        if not budget:
+            logger.warning("Left {} lost entities in {} to look for "
+                           "later".format(len(wanted), ancestor))
+            continue
+        found, scanned, complete = _scan(ancestor, dev_of(ancestor),
+                                         set(wanted), budget)
+        budget -= scanned
+        if not complete:
+            logger.warning(
+                "Stopped looking for {} lost entities in {} after {} "
+                "directories".format(len(wanted) - len(found), ancestor,
+                                     MAX_SCAN))
+        if searched is not None:
+            searched.update(wanted.values())
+        for ino, path in wanted.items():
+            new_path = found.get(ino)
+            if new_path is None:
+                logger.warning("Lost entity {} is not found".format(path))
+            elif new_path in taken:
+                logger.warning("Lost entity {} is found at {} of another "
+                               "entity".format(path, new_path))
+            else:
+                moves[path] = new_path
+    return moves
+
+
+def _scan(root: str, dev: Optional[int], inos: Set[int],
+          limit: int) -> Tuple[Dict[int, str], int, bool]:
+    # Paths of directories of inos on dev in the tree of root, the number
+    # of directories read, and whether the tree was read up to limit
+    # directories
+    found: Dict[int, str] = {}
+    level = [root]
+    scanned = 0
+    while level:
+        next_level = []
+        for path in level:
+            if scanned == limit:
+                return found, scanned, False
+            scanned += 1
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    if entry.inode() in inos and \
+                            entry.stat(follow_symlinks=False).st_dev == dev:
+                        found[entry.inode()] = entry.path
+                        if len(found) == len(inos):
+                            return found, scanned, True
+                except OSError:
+                    continue
+                next_level.append(entry.path)
+        level = next_level
+    return found, scanned, True
+
+
+def reconcile(workers: int = STAT_WORKERS) -> Dict[str, str]:
+    """
+    Catch up with moves of entity directories made while Tagdir was not
+    mounted. Stat all entity paths, record fingerprints of existing ones,
+    and move missing ones found by their fingerprints as the watcher would.
+    Return the new path of each lost path which is found.
+
+    Missing ones which are not found are left as they are, as a directory
+    which is not found is not necessarily deleted, but their fingerprints
+    are cleared so that later mounts do not look for them again. A path
+    which exists with another fingerprint is looked for the same way first,
+    as the directory may have been moved and another one made in its place.
+    """
+    from .watch import EntityPathChangeObserver
+
+    logger = logging.getLogger(__name__)
+
+    with session_scope() as session:
+        rows = session.query(Entity.id, Entity.path, Entity.st_dev,
+                             Entity.st_ino).all()
+    found, missing = stat_all([path for _, path, _, _ in rows], workers)
+
+    lost = {}
+    for _, path, st_dev, st_ino in rows:
+        if st_dev is None:
+            # Entities recorded by older versions or looked for before
+            # cannot be found
+            continue
+        if path in missing or path in found and \
+                found[path] != (st_dev, st_ino):
+            lost[path] = (st_dev, st_ino)
+    searched: Set[str] = set()
+    moves = relocate(lost, set(found), searched)
+
+    fingerprints = []
+    not_found = 0
+    for id_, path, st_dev, st_ino in rows:
+        fingerprint = found.get(path)
+        if path in moves:
+            continue
+        if fingerprint is not None and fingerprint != (st_dev, st_ino):
+            fingerprints.append({"id_": id_, "st_dev": fingerprint[0],
+                                 "st_ino": fingerprint[1]})
+        elif path in missing and path in searched:
+            fingerprints.append({"id_": id_, "st_dev": None,
+                                 "st_ino": None})
+            not_found += 1
+
+    def update(session) -> None:
+        if fingerprints:
+            table = Entity.__table__
+            session.execute(table.update()
+                            .where(table.c.id == bindparam("id_"))
+                            .values(st_dev=bindparam("st_dev"),
+                                    st_ino=bindparam("st_ino")),
+                            fingerprints)
+        if moves:
+            handler = EntityPathChangeObserver.get_instance().handler
+            handler.apply(session, moves)
+
+    with session_scope() as session:
+        Writer.get_instance().run(session, update)
+
+    logger.info("Reconciled {} entities: {} fingerprinted, {} moved and "
+                "{} not found".format(len(rows),
+                                      len(fingerprints) - not_found,
+                                      len(moves), not_found))
+    return moves
@@ -3,6 +3,13 @@ class Session:
     This class is dummy for static analysis. This should be dynamically
     overridden by sessionmaker(bind=engine).
     """
+    @property
+    def info(self):
+        return {}
+
+    def begin_nested(self):
+        pass
+
     def commit(self):
         pass
 
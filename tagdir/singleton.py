@@ -0,0 +1,17 @@
+import threading
+
+
+class Singleton(type):
+    _lock = threading.Lock()
+    _instance = None
+
+    def __call__(cls, *args, **kwargs):
+        if cls._instance is None:
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = \
+                        super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instance
+
+    def get_instance(cls):
+        return cls()
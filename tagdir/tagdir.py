@@ -1,24 +1,42 @@
+from contextlib import contextmanager
 from errno import EINVAL, ENODATA, ENOENT, ENOTDIR
+from functools import partial
 import logging
 import os
 from os.path import join
 import pathlib
-from typing import cast, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import ENTINFO_PATH
-from .db import session_scope
-from .fusepy.fuse import ENOTSUP
+from .cache import DirFdCache, NegativeCache, ResolvedPath, ResolvedPathCache
+from .db import after_commit, lazy_session_scope, session_scope, Writer
+from .fusepy.fuse import ENOTSUP, KernelNotifier
 from .fusepy.exceptions import FuseOSError
-from .fusepy.loopback import Loopback
+from .fusepy.loopback import Loopback, STRICT
+from .index import TagIndex
+from .inode import InodeMap
 from .models import Attr, Entity, Tag
+from .notify import KernelCacheInvalidator
 from .watch import EntityPathChangeObserver
 
 
 DELIMITER = "%%"
 
+# Operations on an open file, whose file handle is the last argument
+FH_OPS = ("read", "readinto", "write", "flush", "fsync", "release")
+
+# Number of entries of the root or a tag directory returned per readdir
+READDIR_CHUNK = 256
+
+# Operations specific to tagdir which never query the database
+SESSIONLESS_OPS = ("statfs", "destroy")
+
+# Passthrough operations of Loopback which take dir_fd
+ANCHORED_OPS = ("chmod", "chown", "mknod", "readlink", "truncate", "unlink",
+                "utimens")
+
 
 def encode_path(path):
     return path.replace("/", DELIMITER)
@@ -80,9 +98,65 @@ def parse_path_for_tagging(raw_path: str) -> Tuple[List[str], Optional[str]]:
     return tag_names, source
 
 
+def get_tags(session, tag_names: List[str]) -> List[Tag]:
+    """
+    Return tags of tag_names, or raise ENOENT if some of them do not exist.
+    """
+    negative_cache = NegativeCache.get_instance()
+    keys = [NegativeCache.tag_key(tag_name) for tag_name in tag_names]
+    if not all(negative_cache.might_exist(key) for key in keys):
+        raise FuseOSError(ENOENT)
+
+    generation = negative_cache.generation
+    tags, missing = Tag.get_by_names(session, tag_names)
+    if missing:
+        for tag_name in missing:
+            negative_cache.record_miss(NegativeCache.tag_key(tag_name),
+                                       generation)
+        raise FuseOSError(ENOENT)
+    return tags
+
+
+def get_entity(session, ent_name: str, tags: List[Tag]) -> Entity:
+    """
+    Return the entity only if it has all of the tags, otherwise raise ENOENT.
+    """
+    negative_cache = NegativeCache.get_instance()
+    if not negative_cache.might_exist(ent_name):
+        raise FuseOSError(ENOENT)
+
+    generation = negative_cache.generation
+    try:
+        entity = Entity.get_by_name(session, ent_name)
+    except NoResultFound:
+        negative_cache.record_miss(ent_name, generation)
+        raise FuseOSError(ENOENT)
+
+    if not entity.has_tags(tags):
+        raise FuseOSError(ENOENT)
+    return entity
+
+
 class Tagdir(Loopback):
-    def __init__(self):
+    use_readdir_offset = True
+
+    def __init__(self, durability: str = STRICT,
+                 fsync_interval: float = 1.0):
         self.logger = logging.getLogger(__name__)
+        self.path_cache = ResolvedPathCache.get_instance()
+        self.path_cache.clear()
+        self.index = TagIndex.get_instance()
+        self.index.clear()
+        self.negative_cache = NegativeCache.get_instance()
+        self.negative_cache.clear()
+        self.invalidator = KernelCacheInvalidator.get_instance()
+        self.dir_fds = DirFdCache.get_instance()
+        self.dir_fds.clear()
+        self.inodes = InodeMap.get_instance()
+        self.inodes.clear()
+        self.writer = Writer.get_instance()
+        # file handle -> real path of files opened by open/create
+        self.handles: Dict[int, str] = {}
 
         with session_scope() as session:
             # Create root attr
@@ -90,45 +164,143 @@ class Tagdir(Loopback):
             if not root_attr:
                 session.add(Attr.new_root_attr())
 
-        super().__init__()
+        super().__init__(durability, fsync_interval)
 
     def __call__(self, op, path, *args):
-        self.logger.debug("{} {} {}".format(op, path, args))
+        self.logger.debug("%s %s %s", op, path, args)
+
+        # Data-plane operations on a file opened through tagdir
+        if op in FH_OPS and args[-1] in self.handles:
+            fh = args[-1]
+            real_path = self.handles[fh]
+            if op == "release":
+                # Forget fh before it is closed and reused by another open
+                del self.handles[fh]
+            return super().__call__(op, real_path, *args)
+
+        if op in SESSIONLESS_OPS:
+            return getattr(self, op)(None, path, *args)
+
+        # Meaningless operations
+        if op not in Tagdir.__dict__ and op not in Loopback.__dict__:
+            return super().__call__(op, path, *args)
 
-        with session_scope() as session:
+        # A session is begun only when a query is issued, so that e.g. a hit
+        # of the path cache costs no transaction
+        with lazy_session_scope() as session:
 
             # Operations specific to tagdir
             if op in Tagdir.__dict__:
                 return getattr(self, op)(session, path, *args)
 
-            # Meaningless operations
-            if op not in Loopback.__dict__:
-                return super().__call__(op, path, *args)
+            # TODO: Investigate whether pass through is appropriate
+            if op in ANCHORED_OPS:
+                with self.anchored(session, path) as (path, dir_fd):
+                    return getattr(self, op)(path, *args, dir_fd=dir_fd)
 
-            # Pass through
-            tag_names, ent_name, rest_path = parse_path(path)
+            path = self.resolve_passthrough(session, path)
+            return super().__call__(op, path, *args)
 
-            if not tag_names:
-                raise FuseOSError(ENOENT)
+    def resolve_passthrough(self, session, path: str) -> str:
+        """
+        Return the real path of /@tag_1/.../@tag_n/ent_name/(rest_path)?
+        """
+        tag_names, ent_name, rest_path = parse_path(path)
 
-            try:
-                tags = [Tag.get_by_name(session, tag_name)
-                        for tag_name in tag_names]
-            except NoResultFound:
-                raise FuseOSError(ENOENT)
+        if not tag_names or ent_name is None:
+            raise FuseOSError(ENOENT)
 
-            if ent_name is None:
-                raise FuseOSError(ENOENT)
+        real_path = self.resolve_entity(session, tag_names, ent_name)\
+            .entity_path
+        if rest_path is not None:
+            real_path = join(real_path, rest_path)
+        return real_path
 
-            entity = Entity.get_if_valid(session, ent_name, tags)
-            if entity is None:
-                raise FuseOSError(ENOENT)
+    @contextmanager
+    def anchored(self, session,
+                 path: str) -> Iterator[Tuple[str, Optional[int]]]:
+        """
+        Yield (path, dir_fd) for /@tag_1/.../@tag_n/ent_name/(rest_path)?,
+        where path is relative to an fd of the entity directory, or the real
+        path and None if the directory cannot be opened.
+        """
+        tag_names, ent_name, rest_path = parse_path(path)
 
-            # TODO: Investigate whether pass through is appropriate
-            path = entity.path
-            if rest_path is not None:
-                path = join(path, rest_path)
-            return super().__call__(op, path, *args)
+        if not tag_names or ent_name is None:
+            raise FuseOSError(ENOENT)
+
+        resolved = self.resolve_entity(session, tag_names, ent_name)
+        with self.dir_fds.acquire(resolved.entity_id,
+                                  resolved.entity_path) as dir_fd:
+            if dir_fd is not None:
+                yield rest_path or ".", dir_fd
+            elif rest_path is not None:
+                yield join(resolved.entity_path, rest_path), None
+            else:
+                yield resolved.entity_path, None
+
+    def resolve_entity(self, session, tag_names: List[str],
+                       ent_name: str) -> ResolvedPath:
+        """
+        Resolve /@tag_1/.../@tag_n/ent_name through the path cache.
+        Raise ENOENT if a tag does not exist or the entity is not valid.
+        """
+        key = (tuple(tag_names), ent_name)
+        resolved = self.path_cache.get(key)
+        if resolved is not None:
+            return resolved
+
+        generation = self.path_cache.generation
+
+        # Probes of names of no entity, like .git, are answered before tags
+        # are looked up
+        if not self.negative_cache.might_exist(ent_name):
+            raise FuseOSError(ENOENT)
+
+        tags = get_tags(session, tag_names)
+
+        entity = get_entity(session, ent_name, tags)
+
+        resolved = ResolvedPath(tuple(tag.id for tag in tags),
+                                entity.id, entity.path)
+        self.path_cache.put(key, resolved, generation)
+        return resolved
+
+    def map_backing_ino(self, attrs: dict) -> dict:
+        """
+        Replace st_dev and st_ino of backing content with an inode number
+        which never collides with the others.
+        """
+        attrs["st_ino"] = self.inodes.backing_ino(attrs.pop("st_dev"),
+                                                  attrs["st_ino"])
+        return attrs
+
+    def init(self, session, path, chan=None, nodes=None):
+        """
+        chan and nodes are given by the low-level API, whose channel the
+        kernel is notified through, and whose nodes are known by path.
+        """
+        self.index.load(session)
+        self.negative_cache.load(
+            [NegativeCache.tag_key(name) for name, in session.query(Tag.name)]
+            + [name for name, in session.query(Entity.name)])
+
+        notifier = KernelNotifier()
+        notifier.attach(chan)
+        if notifier.attached:
+            self.invalidator.start(notifier, nodes)
+
+    def open(self, session, path, flags):
+        with self.anchored(session, path) as (rel_path, dir_fd):
+            fh = os.open(rel_path, flags, dir_fd=dir_fd)
+        self.handles[fh] = self.resolve_passthrough(session, path)
+        return fh
+
+    def create(self, session, path, mode):
+        with self.anchored(session, path) as (rel_path, dir_fd):
+            fh = super().create(rel_path, mode, dir_fd=dir_fd)
+        self.handles[fh] = self.resolve_passthrough(session, path)
+        return fh
 
     def access(self, session, path, mode):
         # TODO: change st_atim
@@ -140,24 +312,16 @@ class Tagdir(Loopback):
         if not tag_names:
             raise FuseOSError(ENOENT)
 
-        try:
-            tags = [Tag.get_by_name(session, tag_name)
-                    for tag_name in tag_names]
-        except NoResultFound:
-            raise FuseOSError(ENOENT)
-
         if ent_name is None:
+            get_tags(session, tag_names)
             return 0
 
-        entity = Entity.get_if_valid(session, ent_name, tags)
-
-        if entity is None:
-            raise FuseOSError(ENOENT)
-
         if rest_path is None:
+            self.resolve_entity(session, tag_names, ent_name)
             return 0
-        else:
-            return super().access(join(entity.path, rest_path), mode)
+
+        with self.anchored(session, path) as (rel_path, dir_fd):
+            return super().access(rel_path, mode, dir_fd=dir_fd)
 
     def getattr(self, session, path, fh=None):
         """
@@ -174,25 +338,24 @@ class Tagdir(Loopback):
         if not tag_names:
             raise FuseOSError(ENOENT)
 
-        try:
-            tags = [Tag.get_by_name(session, tag_name)
-                    for tag_name in tag_names]
-        except NoResultFound:
+        if rest_path is not None:
+            with self.anchored(session, path) as (rel_path, dir_fd):
+                attrs = super().getattr(rel_path, fh, dir_fd=dir_fd)
+            return self.map_backing_ino(attrs)
+
+        if ent_name is not None and \
+                not self.negative_cache.might_exist(ent_name):
             raise FuseOSError(ENOENT)
 
+        tags = get_tags(session, tag_names)
+
         if ent_name is None:
             return tags[-1].attr.as_dict()
 
-        entity = Entity.get_if_valid(session, ent_name, tags)
-
-        if entity is None:
-            raise FuseOSError(ENOENT)
+        entity = get_entity(session, ent_name, tags)
 
-        if rest_path is None:
-            # Return attribute for an entity
-            return entity.attr.as_dict()
-        else:
-            return super().getattr(join(entity.path, rest_path), fh)
+        # Return attribute for an entity
+        return entity.attr.as_dict()
 
     def getxattr(self, session, path, name, position=0):
         # TODO: Implement pass through
@@ -223,36 +386,7 @@ class Tagdir(Loopback):
 
         # Do tagging
         if source:
-            try:
-                tags = [Tag.get_by_name(session, tag_name)
-                        for tag_name in tag_names]
-            except NoResultFound:
-                raise FuseOSError(ENOENT)
-
-            source = pathlib.Path(source)
-
-            if not source.exists():
-                raise FuseOSError(ENOENT)
-
-            if not source.is_dir():
-                raise FuseOSError(ENOTDIR)
-
-            try:
-                entity = Entity.get_by_name(session, source.name)
-                if entity.path != str(source):
-                    # Cannot create multiple links for one directory
-                    raise FuseOSError(EINVAL)
-            except NoResultFound:
-                attr = Attr.new_entity_attr()
-                entity = Entity(source.name, attr, str(source), [])
-                observer = EntityPathChangeObserver.get_instance()
-                observer.schedule_if_new_path(entity.path)
-                session.add_all([entity, attr])
-
-            for tag in tags:
-                if tag not in entity.tags:
-                    entity.tags.append(tag)
-            return None
+            return self.writer.run(session, self.tag, tag_names, source)
 
         tag_names, ent_name, rest_path = parse_path(path)
 
@@ -262,28 +396,82 @@ class Tagdir(Loopback):
 
         # Create new tags
         if ent_name is None:
-            for tag_name in tag_names:
-                try:
-                    Tag.get_by_name(session, tag_name)
-                except NoResultFound:
-                    attr = Attr.new_tag_attr()
-                    tag = Tag(tag_name, attr)
-                    session.add_all([tag, attr])
-            return None
+            return self.writer.run(session, self.create_tags, tag_names)
 
         # Pass through
-        try:
-            tags = [Tag.get_by_name(session, tag_name)
-                    for tag_name in tag_names]
-        except NoResultFound:
-            raise FuseOSError(ENOENT)
+        with self.anchored(session, path) as (rel_path, dir_fd):
+            return super().mkdir(rel_path, mode=mode, dir_fd=dir_fd)
+
+    def tag(self, session, tag_names: List[str], source: str) -> None:
+        """
+        Tag the directory at source with tag_names
+        """
+        tags = get_tags(session, tag_names)
+
+        source_path = pathlib.Path(source)
 
-        entity = Entity.get_if_valid(session, ent_name, tags)
-        if entity is None:
+        if not source_path.exists():
             raise FuseOSError(ENOENT)
 
-        _rest_path = cast(pathlib.Path, rest_path)  # Never be None
-        return super().mkdir(join(entity.path, _rest_path), mode=mode)
+        if not source_path.is_dir():
+            raise FuseOSError(ENOTDIR)
+
+        try:
+            entity = Entity.get_by_name(session, source_path.name)
+            if entity.path != str(source_path):
+                # Cannot create multiple links for one directory
+                raise FuseOSError(EINVAL)
+        except NoResultFound:
+            attr = Attr.new_entity_attr()
+            entity = Entity(source_path.name, attr, str(source_path), [])
+            # Found by reconcile even if moved while not mounted
+            st = source_path.stat()
+            entity.st_dev, entity.st_ino = st.st_dev, st.st_ino
+            self.negative_cache.add_on_commit(session, [entity.name])
+            observer = EntityPathChangeObserver.get_instance()
+            after_commit(session,
+                         partial(observer.add_entity_path, entity.path))
+            session.add_all([entity, attr])
+
+        for tag in tags:
+            if tag not in entity.tags:
+                entity.tags.append(tag)
+
+        self.invalidator.entity_changed(
+            session, [entity.name], [tag.name for tag in entity.tags],
+            [tag.name for tag in tags])
+        session.flush()
+        entity_id = entity.id
+        tag_ids = [tag.id for tag in tags]
+
+        def update_index():
+            self.index.add_entity(entity_id)
+            for tag_id in tag_ids:
+                self.index.add_tagging(tag_id, entity_id)
+        after_commit(session, update_index)
+
+    def create_tags(self, session, tag_names: List[str]) -> None:
+        """
+        Create tags of tag_names which do not exist
+        """
+        _, missing = Tag.get_by_names(session, tag_names)
+        self.negative_cache.add_on_commit(
+            session, [NegativeCache.tag_key(name) for name in missing])
+        self.invalidator.tags_changed(session, missing)
+        new_tags = []
+        for tag_name in dict.fromkeys(missing):
+            attr = Attr.new_tag_attr()
+            tag = Tag(tag_name, attr)
+            session.add_all([tag, attr])
+            new_tags.append(tag)
+
+        session.flush()
+        ids_names = [(tag.id, tag.name) for tag in new_tags]
+
+        def update_index():
+            for tag_id, tag_name in ids_names:
+                self.index.add_tag(tag_id, tag_name)
+        after_commit(session, update_index)
 
     def rmdir(self, session, path):
         """
@@ -294,80 +482,102 @@ class Tagdir(Loopback):
         if not tag_names:
             raise FuseOSError(EINVAL)
 
-        try:
-            tags = [Tag.get_by_name(session, tag_name)
-                    for tag_name in tag_names]
-        except NoResultFound:
-            raise FuseOSError(ENOENT)
+        # Pass through
+        if ent_name is not None and rest_path is not None:
+            with self.anchored(session, path) as (rel_path, dir_fd):
+                return super().rmdir(rel_path, dir_fd=dir_fd)
 
         # Remove tags
         if ent_name is None:
-            for tag in tags:
-                tag.remove(session)
-            return None
+            return self.writer.run(session, self.remove_tags, tag_names)
 
-        # Untagging
-        if rest_path is None:
-            entity = Entity.get_if_valid(session, ent_name, tags)
-            if entity is None:
-                raise FuseOSError(ENOENT)
+        return self.writer.run(session, self.untag, tag_names, ent_name)
 
-            for tag in tags:
-                entity.tags.remove(tag)
+    def remove_tags(self, session, tag_names: List[str]) -> None:
+        tags = get_tags(session, tag_names)
 
-            if not entity.tags:
-                session.delete(entity)
-                observer = EntityPathChangeObserver.get_instance()
-                observer.unschedule_redundant_handlers()
-            return None
+        self.path_cache.invalidate_on_commit(
+            session, tag_ids=[tag.id for tag in tags])
+        ids_names = [(tag.id, tag.name) for tag in tags]
+        self.invalidator.tags_changed(session, tag_names)
+        for tag in tags:
+            tag.remove(session)
 
-        # Pass through
-        entity = Entity.get_if_valid(session, ent_name, tags)
-        if entity is None:
-            raise FuseOSError(ENOENT)
+        def update_index():
+            for tag_id, tag_name in ids_names:
+                self.index.remove_tag(tag_id, tag_name)
+        after_commit(session, update_index)
 
-        _rest_path = cast(pathlib.Path, rest_path)
-        return super().rmdir(join(entity.path, _rest_path))
-
-    def readdir(self, session, path, fh):
+    def untag(self, session, tag_names: List[str], ent_name: str) -> None:
+        """
+        Remove tag_names from the entity, which is deleted if no tags remain
+        """
+        tags = get_tags(session, tag_names)
+        entity = get_entity(session, ent_name, tags)
+
+        self.path_cache.invalidate_on_commit(session, entity_ids=[entity.id])
+        self.invalidator.entity_changed(
+            session, [entity.name], [tag.name for tag in entity.tags],
+            tag_names)
+        for tag in tags:
+            entity.tags.remove(tag)
+
+        entity_id = entity.id
+        tag_ids = [tag.id for tag in tags]
+        deleted = not entity.tags
+
+        if deleted:
+            session.delete(entity)
+            after_commit(session,
+                         lambda: self.dir_fds.invalidate([entity_id]))
+            observer = EntityPathChangeObserver.get_instance()
+            after_commit(session,
+                         partial(observer.remove_entity_path, entity.path))
+
+        def update_index():
+            for tag_id in tag_ids:
+                self.index.remove_tagging(tag_id, entity_id)
+            if deleted:
+                self.index.remove_entity(entity_id, [])
+        after_commit(session, update_index)
+
+    def readdir(self, session, path, fh, offset=0):
         """
         If path is
         - /, then list all tags,
         - /@tag_1/../@tag_n, then list all entities filtered by the tags.
+        Every entry is returned as (name, attrs, offset).
+
+        Tags and entities are listed by READDIR_CHUNK in order of id, and
+        the offset of each entry is its id, from which the kernel resumes.
         """
         if path == "/":
-            return ["@" + name[0] for name in session.query(Tag.name)]
+            return [("@" + name, attr.as_dict(), id_) for id_, name, attr
+                    in Tag.get_names_and_attrs(session, offset,
+                                               READDIR_CHUNK)]
 
         tag_names, ent_name, rest_path = parse_path(path)
 
         if not tag_names:
             raise FuseOSError(EINVAL)
 
-        try:
-            tags = [Tag.get_by_name(session, tag_name)
-                    for tag_name in tag_names]
-        except NoResultFound:
-            raise FuseOSError(ENOENT)
-
         # Filter entity by tags
         if ent_name is None:
-            tag_names = [tag.name for tag in tags]
-            res = session.query(Entity.name).join(Entity.tags)\
-                .filter(Tag.name.in_(tag_names))\
-                .group_by(Entity.name)\
-                .having(func.count(Entity.name) == len(tag_names))
-            return [e for e, in res]
+            self.index.ensure_loaded(session)
+            ids = self.index.list_entity_ids(tag_names, offset,
+                                             READDIR_CHUNK)
+            if ids is None:
+                raise FuseOSError(ENOENT)
+            return [(name, attr.as_dict(), id_) for id_, name, attr
+                    in Entity.get_names_and_attrs(session, ids)]
 
         # Pass through
-        _ent_name = cast(str, ent_name)  # Never be None
-        entity = Entity.get_if_valid(session, _ent_name, tags)
-        if entity is None:
-            raise FuseOSError(ENOENT)
-
-        path = entity.path
-        if rest_path:
-            path = join(path, rest_path)
-        return super().readdir(path, fh)
+        with self.anchored(session, path) as (rel_path, dir_fd):
+            entries = super().readdir(rel_path, fh, dir_fd=dir_fd)
+        return [entry if isinstance(entry, str)
+                else (entry[0], entry[1] and self.map_backing_ino(entry[1]),
+                      entry[2])
+                for entry in entries]
 
     def statfs(self, _, path):
         """
@@ -379,3 +589,7 @@ class Tagdir(Loopback):
         return dict((key, getattr(stv, key)) for key in (
             'f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail',
             'f_ffree', 'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
+
+    def destroy(self, _, path):
+        # Sync files whose fsync is still pending before unmounting
+        super().destroy(path)
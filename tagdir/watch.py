@@ -1,112 +1,799 @@
+from collections import Counter
+import ctypes
+import ctypes.util
+from functools import partial
 import logging
+import os
 import pathlib
+import select
+import struct
 import threading
+import time
+from typing import Any, Callable, Container, Dict, List, Optional, Set, \
+    Tuple
 
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import and_, func, literal, or_
+from sqlalchemy.orm import selectinload
 from watchdog import events
 from watchdog.observers import Observer
 
-from .db import session_scope
-from .models import Entity
+from .cache import DirFdCache, NegativeCache, ResolvedPathCache
+from .db import after_commit, session_scope, Writer
+from .index import TagIndex
+from .models import Entity, IN_CHUNK_SIZE
+from .notify import KernelCacheInvalidator
+from .singleton import Singleton
 
+# Backends watching directories
+WATCHDOG = "watchdog"
+INOTIFY = "inotify"
+WATCHERS = (WATCHDOG, INOTIFY)
 
-class Singleton(type):
-    _lock = threading.Lock()
-    _instance = None
 
-    def __call__(cls, *args, **kwargs):
-        if cls._instance is None:
-            with cls._lock:
-                if not cls._instance:
-                    cls._instance = \
-                        super(Singleton, cls).__call__(*args, **kwargs)
-        return cls._instance
+class WatchdogBackend:
+    """
+    Watch directories by watchdog, which runs an emitter thread and, with
+    inotify, an inotify instance per directory, so that a move between
+    directories is reported as a move to "" from one and a move from ""
+    to the other where watchdog generates full events, and as a deletion
+    elsewhere.
+    """
 
-    def get_instance(cls):
-        return cls()
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        try:
+            self.observer = Observer(  # type: ignore[call-arg]
+                generate_full_events=True)
+        except TypeError:
+            # Other than inotify
+            self.observer = Observer()
 
+    def schedule(self, path: str):
+        return self.observer.schedule(self.handler, path)
+
+    def unschedule(self, watch) -> None:
+        self.observer.unschedule(watch)
+
+    def move(self, watch, path: str):
+        """
+        Return the watch of the directory moved to path
+        """
+        self.unschedule(watch)
+        return self.schedule(path)
+
+    def start(self) -> None:
+        self.observer.start()
+
+    def stop(self) -> None:
+        self.observer.stop()
+
+    def join(self) -> None:
+        self.observer.join()
+
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifyBackend:
+    """
+    Watch every directory on one inotify fd read by one thread, which maps
+    watch descriptors back to directories and dispatches moves and
+    deletions of subdirectories to handler as watchdog events.
+
+    A directory moved out of the watched ones is reported as moved to ""
+    once its destination is not seen for MOVE_TIMEOUT seconds, and one
+    moved into them as moved from "", as watchdog does with full events.
+    on_overflow is called when events are lost because the queue
+    of the kernel overflowed. Linux only.
+    """
+
+    MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_ONLYDIR
+    BUFSIZE = 64 * 1024
+    # As the delay of the inotify buffer of watchdog, since both halves of
+    # a move may be read apart
+    MOVE_TIMEOUT = 0.5
+
+    def __init__(self, handler,
+                 on_overflow: Optional[Callable[[], None]] = None) -> None:
+        self.handler = handler
+        self.on_overflow = on_overflow
+        self.logger = logging.getLogger(__name__)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._check(self._libc.inotify_init1(IN_CLOEXEC))
+        # Written to wake up the reader to stop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._lock = threading.Lock()
+        # watch descriptor -> directory
+        self._paths: Dict[int, str] = {}
+        # cookie -> (source path, deadline) of a move whose destination is
+        # not seen yet, only used by the reader
+        self._moved_from: Dict[int, Tuple[str, float]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _check(ret: int) -> int:
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ret
+
+    def schedule(self, path: str) -> int:
+        wd = self._check(self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), self.MASK))
+        with self._lock:
+            self._paths[wd] = path
+        return wd
+
+    def unschedule(self, wd: int) -> None:
+        with self._lock:
+            self._paths.pop(wd, None)
+        # Fails if the directory is already gone, which removed the watch
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def move(self, wd: int, path: str) -> int:
+        """
+        Return the watch of the directory moved to path, which is the same
+        one as it follows the inode
+        """
+        with self._lock:
+            if wd in self._paths:
+                self._paths[wd] = path
+        return wd
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        os.write(self._wakeup_w, b"x")
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in [self._fd, self._wakeup_r, self._wakeup_w]:
+            os.close(fd)
+
+    def _run(self) -> None:
+        poll = select.poll()
+        poll.register(self._fd, select.POLLIN)
+        poll.register(self._wakeup_r, select.POLLIN)
+
+        while True:
+            timeout = None
+            if self._moved_from:
+                deadline = min(d for _, d in self._moved_from.values())
+                timeout = max(0, (deadline - time.monotonic()) * 1000)
+            fds = [fd for fd, _ in poll.poll(timeout)]
+            if self._wakeup_r in fds:
+                return
+            try:
+                if self._fd in fds:
+                    self._dispatch(
+                        self._parse(os.read(self._fd, self.BUFSIZE)))
+                self._expire()
+            except Exception:
+                self.logger.exception("Failed to handle inotify events")
+
+    def _parse(self, buf: bytes):
+        """
+        Yield (watched directory, mask, cookie, name) of events in buf, or
+        None as the directory of an overflow of the queue
+        """
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                yield None, mask, cookie, name
+                continue
+            with self._lock:
+                if mask & IN_IGNORED:
+                    self._paths.pop(wd, None)
+                    continue
+                parent = self._paths.get(wd)
+            if parent is not None and mask & IN_ISDIR:
+                yield parent, mask, cookie, name
+
+    def _dispatch(self, parsed) -> None:
+        for parent, mask, cookie, name in parsed:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("Inotify events are lost by overflow")
+                # Their destinations may be lost as well
+                self._moved_from.clear()
+                if self.on_overflow is not None:
+                    self.on_overflow()
+                continue
+
+            path = os.path.join(parent, name)
+            if mask & IN_MOVED_FROM:
+                self._moved_from[cookie] = (
+                    path, time.monotonic() + self.MOVE_TIMEOUT)
+            elif mask & IN_MOVED_TO:
+                src_path, _ = self._moved_from.pop(cookie, ("", 0.0))
+                self.handler.dispatch(events.DirMovedEvent(src_path, path))
+            elif mask & IN_DELETE:
+                self.handler.dispatch(events.DirDeletedEvent(path))
+
+    def _expire(self) -> None:
+        # Moved out of the watched directories
+        now = time.monotonic()
+        for cookie, (src_path, deadline) in list(self._moved_from.items()):
+            if deadline <= now:
+                del self._moved_from[cookie]
+                self.handler.dispatch(events.DirMovedEvent(src_path, ""))
+
+
+class EntityPathChangeObserver(metaclass=Singleton):
+    """
+    Watch parent directories of entities, counting the entities under each,
+    so that a watch is added for the first entity and removed with the last
+    one without looking at the others.
+
+    Ancestors of the parents are watched as well, each counting the watched
+    directories in it, so that moves of a directory containing entities at
+    any depth are seen.
+
+    watcher is the backend watching directories, out of WATCHERS.
+    """
+
+    def __init__(self, watcher: str = WATCHDOG) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.handler = EntityPathChangeHandler(self.watches)
+        if watcher == INOTIFY:
+            self.backend: Any = InotifyBackend(self.handler, self.rescan)
+        elif watcher == WATCHDOG:
+            self.backend = WatchdogBackend(self.handler)
+        else:
+            raise ValueError("Unknown watcher {}".format(watcher))
+
+        self._entity_watches_lock = threading.Lock()
+        # parent directory -> paths of entities in it
+        self._entity_watches: Dict[str, Set[str]] = {}
+        # watched directory -> [watch, number of parent directories of
+        # entities it is or is in]
+        self._dirs: Dict[str, List[Any]] = {}
+
+        self._rescan_lock = threading.Lock()
+        self._rescan_pending = False
+        self._rescanning = False
 
-class EntityPathChangeObserver(Observer, metaclass=Singleton):  # type: ignore
-    def __init__(self):
-        super().__init__()
-        path_set = set()
         with session_scope() as session:
             for path, in session.query(Entity.path):
-                path_set.add(pathlib.Path(path))
+                self.add_entity_path(path)
 
-        for path in path_set:
-            self.schedule_if_new_path(path)
+    def start(self) -> None:
+        self.backend.start()
 
-    def schedule(self, event_handler, path, recursive=False):
-        logger = logging.getLogger(__name__)
-        logger.debug("Add handler for {}".format(path))
-        return super().schedule(event_handler, path, recursive)
+    def stop(self) -> None:
+        self.backend.stop()
 
-    def schedule_if_new_path(self, path):
-        parent = str(pathlib.Path(path).parent)
-        path_set = set(em.watch.path for em in self.emitters)
-        if parent not in path_set:
-            event_handler = EntityPathChangeHandler()
-            self.schedule(event_handler, parent)
+    def join(self) -> None:
+        self.backend.join()
+        # Apply changes which are still gathered
+        self.handler.flush()
+
+    def rescan(self) -> None:
+        """
+        Catch up with changes whose events are lost by reconciling entities
+        in a thread, again once it is done if asked meanwhile
+        """
+        with self._rescan_lock:
+            self._rescan_pending = True
+            if self._rescanning:
+                return
+            self._rescanning = True
+        threading.Thread(target=self._rescan, daemon=True).start()
+
+    def _rescan(self) -> None:
+        from .reconcile import reconcile
+
+        while True:
+            with self._rescan_lock:
+                if not self._rescan_pending:
+                    self._rescanning = False
+                    return
+                self._rescan_pending = False
+            self.handler.flush()
+            try:
+                reconcile()
+            except Exception:
+                self.logger.exception("Failed to reconcile entities")
+
+    def add_entity_path(self, path) -> None:
+        path = str(path)
+        parent = os.path.dirname(path)
+        with self._entity_watches_lock:
+            if parent not in self._entity_watches:
+                self.logger.debug("Add handler for {}".format(parent))
+                self._ref(parent)
+                self._entity_watches[parent] = set()
+            self._entity_watches[parent].add(path)
+
+    def remove_entity_path(self, path) -> None:
+        path = str(path)
+        parent = os.path.dirname(path)
+        with self._entity_watches_lock:
+            if parent not in self._entity_watches:
+                return
+            paths = self._entity_watches[parent]
+            paths.discard(path)
+            if paths:
+                return
+            del self._entity_watches[parent]
+            self._unref(parent)
+
+    def move_entity_path(self, src_path, dest_path) -> None:
+        # Add first, so that the watch of a common parent is kept
+        self.add_entity_path(dest_path)
+        self.remove_entity_path(src_path)
+
+    def apply_moves(self, deleted: List[str],
+                    dir_moves: List[Tuple[str, str]],
+                    entity_moves: List[Tuple[str, str]]) -> None:
+        """
+        Update watches for changes of entity paths committed together,
+        given by their original paths: remove deleted entities, move
+        directories innermost first, and then move entities from where the
+        moves of directories took them.
+        """
+        for path in deleted:
+            self.remove_entity_path(path)
+        for src_path, dest_path in dir_moves:
+            self.move_dir(src_path, dest_path)
+        dests = dict(dir_moves)
+        for src_path, dest_path in entity_moves:
+            moved_by = _moved_by(dests, src_path)
+            if moved_by is not None:
+                src_path = dests[moved_by] + src_path[len(moved_by):]
+            self.move_entity_path(src_path, dest_path)
+
+    def move_dir(self, src_path, dest_path) -> None:
+        """
+        Move watches of src_path and directories in it to dest_path at once
+        """
+        src_path = str(src_path)
+        dest_path = str(dest_path)
+        with self._entity_watches_lock:
+            moved = [path for path in self._dirs
+                     if path == src_path or
+                     path.startswith(src_path + os.sep)]
+            if not moved:
+                return
+
+            entries = [(path, self._dirs.pop(path)) for path in moved]
+            for path, entry in entries:
+                new_path = dest_path + path[len(src_path):]
+                self.logger.debug("Move handler for {} to {}".format(
+                    path, new_path))
+                if entry[0] is not None:
+                    entry[0] = self.backend.move(entry[0], new_path)
+                self._dirs[new_path] = entry
+
+                paths = self._entity_watches.pop(path, None)
+                if paths is not None:
+                    self._entity_watches[new_path] = \
+                        {dest_path + p[len(src_path):] for p in paths}
+
+            # Referred from the new parent instead of the old one
+            self._ref(os.path.dirname(dest_path))
+            self._unref(os.path.dirname(src_path))
+
+    def watches(self, path: str) -> bool:
+        """
+        Return whether path is of an entity or a directory containing one
+        """
+        with self._entity_watches_lock:
+            return path in self._dirs or \
+                path in self._entity_watches.get(os.path.dirname(path), ())
+
+    def watched_paths(self) -> Dict[str, int]:
+        """
+        Return the number of entities in each parent directory
+        """
+        with self._entity_watches_lock:
+            return {parent: len(paths)
+                    for parent, paths in self._entity_watches.items()}
+
+    def _ref(self, path: str) -> None:
+        # Watch path, and its parent as well if it is newly watched
+        while path not in self._dirs:
+            try:
+                watch = self.backend.schedule(path)
+            except OSError:
+                self.logger.warning("Cannot watch {}".format(path))
+                watch = None
+            self._dirs[path] = [watch, 1]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            path = parent
+        self._dirs[path][1] += 1
+
+    def _unref(self, path: str) -> None:
+        # Unwatch path, and its parent as well if it is no longer referred
+        while True:
+            entry = self._dirs[path]
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._dirs[path]
+            if entry[0] is not None:
+                self.backend.unschedule(entry[0])
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            path = parent
 
-    def unschedule_redundant_handlers(self):
-        with session_scope() as session:
-            ent_path_set = set(path for path, in session.query(Entity.path))
 
-        delete_candidate = set()
+def coalesce(changes: List[Tuple[str, Optional[str]]]) \
+        -> Dict[str, Optional[str]]:
+    """
+    Fold (src_path, dest_path) of moves, (src_path, "") of moves to unknown
+    destinations and (src_path, None) of deletions, in the order they
+    happened, into the final path of each original path, "" if it is
+    unknown or None if it was deleted. Move chains collapse into one move,
+    a move followed by a deletion into the deletion of the original path,
+    and directories moved back to where they were are left out.
+    Directories in a moved one are moved along with it, and those in one
+    moved to an unknown destination or deleted are at unknown paths, as
+    only a deletion of a directory itself tells it is gone.
+    """
+    final: Dict[str, Optional[str]] = {}
+    # current path -> original path of directories moved so far
+    origins: Dict[str, str] = {}
 
-        for em in self.emitters:
-            if em.watch.path not in ent_path_set:
-                delete_candidate.add(em.watch)
+    for src_path, dest_path in changes:
+        origin = origins.pop(src_path, None)
+        if origin is None:
+            origin = _origin_of(origins, src_path)
+        final[origin] = dest_path
 
-        for watch in delete_candidate:
-            self.unschedule(watch)
+        # Moved or deleted along with src_path
+        for path in [path for path in origins
+                     if path.startswith(src_path + os.sep)]:
+            inner_origin = origins.pop(path)
+            inner_dest = dest_path + path[len(src_path):] if dest_path \
+                else ""
+            final[inner_origin] = inner_dest
+            if inner_dest:
+                origins[inner_dest] = inner_origin
 
+        if dest_path:
+            origins[dest_path] = origin
 
-class EntityPathChangeHandler(events.FileSystemEventHandler):  # type: ignore
-    def __init__(self):
+    return {src_path: dest_path for src_path, dest_path in final.items()
+            if src_path != dest_path}
+
+
+def _origin_of(origins: Dict[str, str], path: str) -> str:
+    # The original path of path, which may be in a directory moved so far
+    ancestor = path
+    while True:
+        parent = os.path.dirname(ancestor)
+        if parent == ancestor:
+            return path
+        ancestor = parent
+        if ancestor in origins:
+            return origins[ancestor] + path[len(ancestor):]
+
+
+def _moved_by(moves: Container[str], path: str) -> Optional[str]:
+    # The innermost directory moved or deleted which path is in, if any
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+        if path in moves:
+            return path
+
+
+def _under(path: str):
+    # Entity paths in the directory at path, as a range of the unique index
+    return and_(Entity.path > path + os.sep,
+                Entity.path < path + chr(ord(os.sep) + 1))
+
+
+class EntityPathChangeHandler(events.FileSystemEventHandler):
+    """
+    Gather moves and deletions of directories for DEBOUNCE seconds from the
+    first one, and apply them to entities in one transaction, so that a
+    `mv` or `rm -rf` of many tagged directories costs one write.
+
+    Changes of directories for which watches returns False are dropped,
+    unless they are in a directory moved by changes not applied yet.
+    """
+
+    DEBOUNCE = 0.05
+    # Prefix of paths of entities being moved, which are never relative
+    MOVING = "moving:"
+
+    def __init__(self,
+                 watches: Optional[Callable[[str], bool]] = None) -> None:
         self.logger = logging.getLogger(__name__)
+        self.watches = watches
+        self._lock = threading.Lock()
+        self._changes: List[Tuple[str, Optional[str]]] = []
+        # Destinations of moves not applied yet, whose paths are not
+        # watched until then
+        self._pending: Counter = Counter()
+        self._timer: Optional[threading.Timer] = None
         super().__init__()
 
     def on_moved(self, event):
+        # From or to "" if either is not watched
         if not isinstance(event, events.DirMovedEvent):
             return
+        self._queue(os.fsdecode(event.src_path),
+                    os.fsdecode(event.dest_path))
 
-        src_path = pathlib.Path(event.src_path)
-        with session_scope() as session:
-            try:
-                entity = session.query(Entity).filter(
-                    Entity.name == src_path.name,
-                    Entity.path == str(src_path)).one()
-            except NoResultFound:
+    def on_deleted(self, event):
+        if not isinstance(event, events.DirDeletedEvent):
+            return
+        self._queue(os.fsdecode(event.src_path), None)
+
+    def _queue(self, src_path: str, dest_path: Optional[str]) -> None:
+        with self._lock:
+            if src_path and not self._concerns(src_path):
                 return
+            self._changes.append((src_path, dest_path))
+            if src_path and dest_path:
+                self._pending[dest_path] += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.DEBOUNCE, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
 
-            dest_path = pathlib.Path(event.dest_path)
-            entity.name = dest_path.name
-            entity.path = str(dest_path)
-            observer = EntityPathChangeObserver.get_instance()
-            observer.schedule_if_new_path(dest_path)
+    def _concerns(self, path: str) -> bool:
+        # Called with the lock held
+        if self.watches is None or self.watches(path):
+            return True
+        while True:
+            if path in self._pending:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
 
-            msg = "Destination of {} is changed from {} to {}".format(
-                entity.name, event.src_path, event.dest_path)
-            self.logger.debug(msg)
+    def _release(self, dest_paths: List[str]) -> None:
+        with self._lock:
+            for path in dest_paths:
+                self._pending[path] -= 1
+                if not self._pending[path]:
+                    del self._pending[path]
 
-    def on_deleted(self, event):
-        if not isinstance(event, events.DirDeletedEvent):
+    def flush(self) -> None:
+        """
+        Apply changes gathered so far
+        """
+        with self._lock:
+            changes = self._changes
+            self._changes = []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        held = [dest_path for src_path, dest_path in changes
+                if src_path and dest_path]
+
+        # Directories moved in from unknown sources, which may be where
+        # those moved to unknown destinations are
+        arrivals = [dest_path for src_path, dest_path in changes
+                    if not src_path and dest_path]
+        moves = coalesce([(src_path, dest_path)
+                          for src_path, dest_path in changes if src_path])
+        if not all(moves.values()):
+            moves.update(self.locate(moves, arrivals))
+        moves = {src_path: dest_path for src_path, dest_path in moves.items()
+                 if dest_path != ""}
+        if not moves:
+            self._release(held)
             return
 
-        src_path = pathlib.Path(event.src_path)
+        # Including destinations of entities found, until watched
+        dest_paths = [dest_path for dest_path in moves.values() if dest_path]
+        with self._lock:
+            self._pending.update(dest_paths)
+        self._release(held)
+        # Nobody waits for the result, so a failure is logged here,
+        # whether the writer is started or not
+        future = Writer.get_instance().submit(self.apply, moves)
+        future.add_done_callback(self._log_failure)
+        future.add_done_callback(lambda _: self._release(dest_paths))
+
+    def _log_failure(self, future) -> None:
+        e = future.exception()
+        if e is not None:
+            self.logger.error("Failed to apply moves of entities",
+                              exc_info=e)
+
+    def locate(self, moves: Dict[str, Optional[str]],
+               arrivals: List[str]) -> Dict[str, str]:
+        """
+        Look for entities at paths of moves to unknown destinations, and
+        those in them or in deleted directories without being deleted
+        themselves, at directories in arrivals and then in the tree of
+        their nearest existing ancestor. Return the new path of each one
+        found. The others are left where they were.
+        """
+        from .reconcile import relocate
+
+        # lost path -> key of moves it is lost by
+        lost_by: Dict[str, str] = {}
+        lost: Dict[str, Tuple[int, int]] = {}
         with session_scope() as session:
-            try:
-                entity = session.query(Entity).filter(
-                    Entity.name == src_path.name,
-                    Entity.path == str(src_path)).one()
-            except NoResultFound:
-                return
-            session.delete(entity)
-            observer = EntityPathChangeObserver.get_instance()
-            observer.unschedule_redundant_handlers()
+            query = session.query(Entity.path, Entity.st_dev, Entity.st_ino)
+            for key, dest_path in moves.items():
+                if dest_path is None:
+                    rows = query.filter(_under(key))
+                elif dest_path == "":
+                    rows = query.filter(or_(Entity.path == key, _under(key)))
+                else:
+                    continue
+                for path, st_dev, st_ino in rows:
+                    if path != key and (path in moves or
+                                        _moved_by(moves, path) != key):
+                        continue
+                    if st_dev is None:
+                        self.logger.warning(
+                            "Lost entity {} has no fingerprint".format(path))
+                        continue
+                    lost_by[path] = key
+                    lost[path] = (st_dev, st_ino)
+
+        found: Dict[str, str] = {}
+        for path, fingerprint in lost.items():
+            for dest_path in arrivals:
+                candidate = dest_path + path[len(lost_by[path]):]
+                try:
+                    st = os.stat(candidate)
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) == fingerprint:
+                    found[path] = candidate
+                    break
+        found.update(relocate(
+            {path: fingerprint for path, fingerprint in lost.items()
+             if path not in found}, set()))
+
+        # Not at paths of other entities
+        new_paths = list(found.values())
+        taken: Set[str] = set()
+        with session_scope() as session:
+            for i in range(0, len(new_paths), IN_CHUNK_SIZE):
+                taken.update(path for path, in session.query(Entity.path)
+                             .filter(Entity.path.in_(
+                                 new_paths[i:i + IN_CHUNK_SIZE])))
+        for path in taken:
+            self.logger.warning(
+                "Lost entity is found at {} of another entity".format(path))
+        return {src_path: dest_path for src_path, dest_path in found.items()
+                if dest_path not in taken}
+
+    def apply(self, session, moves: Dict[str, Optional[str]]) -> None:
+        """
+        Move entities whose paths are keys of moves, or in the directories
+        at them, or delete those whose paths are keys of deletions, but not
+        ones in the deleted directories
+        """
+        # Loaded with what move and delete touch, not one by one
+        query = session.query(Entity).options(selectinload(Entity.tags),
+                                              selectinload(Entity.attr))
+        src_paths = list(moves)
+        entities = []
+        for i in range(0, len(src_paths), IN_CHUNK_SIZE):
+            entities.extend(query.filter(
+                Entity.path.in_(src_paths[i:i + IN_CHUNK_SIZE])))
+
+        # Deleted first, so that their paths are free to move into. Flushed
+        # once at the end rather than by every deletion
+        deleted = []
+        with session.no_autoflush:
+            for entity in entities:
+                if moves[entity.path] is None:
+                    deleted.append(entity.path)
+                    self.delete(session, entity)
+        session.flush()
+
+        # Entities in moved directories are moved aside, innermost first so
+        # that each directory takes only ones not in another moved one, and
+        # then to their destinations, so that no entity is moved twice
+        dir_moves = [(src_path, dest_path) for src_path, dest_path
+                     in sorted(moves.items(), reverse=True)
+                     if dest_path is not None]
+        aside = len(dir_moves) > 1
+        moved = []
+        for i, (src_path, dest_path) in enumerate(dir_moves):
+            path = "{}{}".format(self.MOVING, i) if aside else dest_path
+            if self.move_dir(session, src_path, path):
+                moved.append((src_path, dest_path, path))
+        for src_path, dest_path, path in moved:
+            if aside:
+                self.move_dir(session, path, dest_path)
+
+        entity_moves = []
+        for entity in entities:
+            new_path = moves[entity.path]
+            if new_path is not None:
+                entity_moves.append((entity.path, new_path))
+                self.move(session, entity, pathlib.Path(new_path))
+
+        # Watches are updated from the final paths at once, as a directory
+        # moved takes the watches of entities moved out of it as well
+        observer = EntityPathChangeObserver.get_instance()
+        after_commit(session, partial(
+            observer.apply_moves, deleted,
+            [(src_path, dest_path) for src_path, dest_path, _ in moved],
+            entity_moves))
+
+    def move_dir(self, session, src_path: str, dest_path: str) -> int:
+        """
+        Rewrite paths of entities in src_path to be in dest_path by a
+        single update of the range of the index, and return the number of
+        entities moved
+        """
+        entities = session.query(Entity).filter(_under(src_path))
+        entity_ids = [entity_id for entity_id, in
+                      entities.with_entities(Entity.id)]
+        if not entity_ids:
+            return 0
+        ResolvedPathCache.get_instance().invalidate_on_commit(
+            session, entity_ids=entity_ids)
+        count = entities.update(
+            {Entity.path: literal(dest_path) +
+             func.substr(Entity.path, len(src_path) + 1)},
+            synchronize_session=False)
+
+        msg = "Destinations of {} entities are moved from {} to {}".format(
+            count, src_path, dest_path)
+        self.logger.debug(msg)
+        return count
+
+    def move(self, session, entity: Entity, dest_path: pathlib.Path) -> None:
+        src_path = entity.path
+        ResolvedPathCache.get_instance().invalidate_on_commit(
+            session, entity_ids=[entity.id])
+        NegativeCache.get_instance().add_on_commit(session, [dest_path.name])
+        KernelCacheInvalidator.get_instance().entity_changed(
+            session, [entity.name, dest_path.name],
+            [tag.name for tag in entity.tags])
+        entity.name = dest_path.name
+        entity.path = str(dest_path)
+
+        msg = "Destination of {} is changed from {} to {}".format(
+            entity.name, src_path, dest_path)
+        self.logger.debug(msg)
+
+    def delete(self, session, entity: Entity) -> None:
+        src_path = entity.path
+        ResolvedPathCache.get_instance().invalidate_on_commit(
+            session, entity_ids=[entity.id])
+        KernelCacheInvalidator.get_instance().entity_changed(
+            session, [entity.name], [tag.name for tag in entity.tags])
+        index = TagIndex.get_instance()
+        after_commit(session, partial(index.remove_entity, entity.id,
+                                      [tag.id for tag in entity.tags]))
+        after_commit(session, partial(DirFdCache.get_instance().invalidate,
+                                      [entity.id]))
+        session.delete(entity)
 
-            msg = "{} is deleted because its destination {} is deleted".format(
-                src_path.name, event.src_path)
-            self.logger.debug(msg)
+        msg = "{} is deleted because its destination {} is deleted".format(
+            entity.name, src_path)
+        self.logger.debug(msg)
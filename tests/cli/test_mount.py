@@ -0,0 +1,34 @@
+import sys
+
+import pytest
+
+from tagdir.cli import _main
+
+
+@pytest.fixture
+def mount(mocker):
+    mocker.patch("tagdir.cli.get_mountpoint", return_value=None)
+    return mocker.patch("tagdir.cli.mount", return_value=0)
+
+
+def run(mocker, *options):
+    mocker.patch.object(sys, "argv", ["tagdir", "mount"] + list(options) +
+                        ["name", "/tmp/tagdir.db", "/mnt"])
+    return _main()
+
+
+def test_kernel_cache(mount, mocker):
+    run(mocker)
+    assert mount.call_args[0][0].kernel_cache is None
+    run(mocker, "--kernel-cache")
+    assert mount.call_args[0][0].kernel_cache is True
+    run(mocker, "--no-kernel-cache")
+    assert mount.call_args[0][0].kernel_cache is False
+
+
+def test_timeouts_without_lowlevel(mount, mocker):
+    for option in ["--root-timeout", "--tag-timeout"]:
+        with pytest.raises(SystemExit):
+            run(mocker, option, "120")
+        assert run(mocker, "--lowlevel", option, "120") == 0
+    assert run(mocker, "--entity-timeout", "10") == 0
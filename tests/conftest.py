@@ -7,3 +7,8 @@ def pytest_sessionstart(session):
     sys.modules["tagdir.fusepy.fuse"] = mock_module
     mock_module.Operations = type("Dummy", (object,), {})
     mock_module.ENOTSUP = 100000  # Dummy value
+
+    mock_ll_module = MagicMock()
+    sys.modules["tagdir.fusepy.fusell"] = mock_ll_module
+    mock_ll_module.LLOperations = type("DummyLL", (object,), {})
+    mock_ll_module.FUSE_ROOT_ID = 1
@@ -0,0 +1,128 @@
+import ctypes
+import importlib.util
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import tagdir.fusepy
+
+
+def load(name):
+    spec = importlib.util.spec_from_file_location(
+        "tagdir.fusepy." + name,
+        os.path.join(os.path.dirname(tagdir.fusepy.__file__), name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def fusell():
+    # The real bindings, whose replies and libfuse helpers are mocks, in
+    # place of the mocked modules while loaded
+    mocked = {name: sys.modules[name] for name in
+              ("tagdir.fusepy.fuse", "tagdir.fusepy.fusell")}
+    try:
+        with patch("ctypes.CDLL"), \
+                patch.dict(os.environ, {"FUSE_LIBRARY_PATH": "libfuse"}):
+            load("fuse")
+            yield load("fusell")
+    finally:
+        sys.modules.update(mocked)
+
+
+@pytest.fixture
+def ll(fusell):
+    fusell._libfuse.reset_mock()
+    ll = fusell.FUSELL.__new__(fusell.FUSELL)
+    ll.encoding = "utf-8"
+    ll.operations = MagicMock()
+    return ll
+
+
+def test_fill_entry(fusell, ll):
+    e = ll._fill_entry({"ino": 2, "generation": 1,
+                        "attr": {"st_mode": 0o40755, "st_size": 4096,
+                                 "st_mtime": 1.5, "st_unknown": 0},
+                        "attr_timeout": 1.0, "entry_timeout": 2.0})
+    assert isinstance(e, fusell.fuse_entry_param)
+    assert (e.ino, e.generation) == (2, 1)
+    assert (e.attr.st_mode, e.attr.st_size) == (0o40755, 4096)
+    assert fusell._time_ns(e.attr.st_mtimespec) == 1500000000
+    assert (e.attr_timeout, e.entry_timeout) == (1.0, 2.0)
+
+    e = ll._fill_entry({"ino": 0})
+    assert (e.ino, e.generation, e.attr.st_mode) == (0, 0, 0)
+    assert (e.attr_timeout, e.entry_timeout) == (0.0, 0.0)
+
+
+def test_reply_attr(fusell, ll):
+    ll._reply_attr("req", {"st_mode": 0o100644, "st_nlink": 1}, 3.0)
+
+    req, stp, timeout = fusell._libfuse.fuse_reply_attr.call_args[0]
+    assert (req, timeout) == ("req", 3.0)
+    assert (stp._obj.st_mode, stp._obj.st_nlink) == (0o100644, 1)
+
+
+def test_reply_sized(fusell, ll):
+    libfuse = fusell._libfuse
+    ll._reply_sized("req", b"value", 0)
+    libfuse.fuse_reply_xattr.assert_called_once_with("req", 5)
+    ll._reply_sized("req", b"value", 4)
+    libfuse.fuse_reply_err.assert_called_once_with("req", fusell.errno.ERANGE)
+    ll._reply_sized("req", b"value", 5)
+    libfuse.fuse_reply_buf.assert_called_once_with("req", b"value", 5)
+
+
+@pytest.fixture
+def direntries(fusell):
+    # Packs entries as fuse_add_direntry does, but with fixed size records
+    # of the name, the mode and the offset
+    entries = []
+
+    def add_direntry(req, addr, size, name, stp, offset):
+        record = "{}:{:o}:{};".format(
+            name.decode(), stp._obj.st_mode, offset).encode()
+        if len(record) <= size:
+            ctypes.memmove(addr, record, len(record))
+            entries.append(record)
+        return len(record)
+
+    fusell._libfuse.fuse_add_direntry.side_effect = add_direntry
+    yield entries
+    fusell._libfuse.fuse_add_direntry.side_effect = None
+
+
+def fip(fusell, fh):
+    info = fusell.fuse_file_info()
+    info.fh = fh
+    return ctypes.pointer(info)
+
+
+def test_readdir(fusell, ll, direntries):
+    ll.operations.readdir.return_value = [
+        (".", {"st_mode": 0o40755}, 1),
+        ("..", None, 2),
+        ("été", {"st_mode": 0o100644}, 3)]
+
+    ll.readdir("req", 1, 4096, 0, fip(fusell, 7))
+
+    ll.operations.readdir.assert_called_once_with(1, 0, 7)
+    req, buf, pos = fusell._libfuse.fuse_reply_buf.call_args[0]
+    assert req == "req"
+    # Attributes of the previous entry are not left for one without them
+    assert buf.raw[:pos] == b"".join(direntries) == \
+        ".:40755:1;..:0:2;été:100644:3;".encode()
+
+
+def test_readdir_full(fusell, ll, direntries):
+    ll.operations.readdir.return_value = [
+        ("a", {"st_mode": 0o40755}, 1), ("b", {"st_mode": 0o40755}, 2)]
+
+    ll.readdir("req", 1, 14, 0, fip(fusell, 7))
+
+    _, buf, pos = fusell._libfuse.fuse_reply_buf.call_args[0]
+    assert buf.raw[:pos] == b"a:40755:1;"
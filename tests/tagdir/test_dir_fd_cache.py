@@ -0,0 +1,102 @@
+import os
+import stat
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.cache import DirFdCache, ResolvedPath
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr2, "/path1", [tag1])
+    session.add_all([attr1, attr2, tag1, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def cache(tagdir):
+    cache = tagdir.dir_fds
+    cache.clear()
+    yield cache
+    cache.clear()
+    cache.maxsize = DirFdCache.DEFAULT_MAXSIZE
+
+
+def is_open(fd):
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+def test_reuse(cache, tmp_path):
+    with cache.acquire(1, str(tmp_path)) as fd1:
+        pass
+    with cache.acquire(1, str(tmp_path)) as fd2:
+        assert fd2 == fd1
+    assert len(cache) == 1
+    assert is_open(fd1)
+
+
+def test_path_changed(cache, tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    with cache.acquire(1, str(tmp_path / "a")) as fd1:
+        pass
+    with cache.acquire(1, str(tmp_path / "b")) as fd2:
+        assert fd2 != fd1
+        assert not is_open(fd1)
+    assert len(cache) == 1
+
+
+def test_lru(cache, tmp_path):
+    cache.maxsize = 2
+    with cache.acquire(1, str(tmp_path)) as fd1:
+        pass
+    with cache.acquire(2, str(tmp_path)):
+        pass
+    with cache.acquire(3, str(tmp_path)):
+        pass
+    assert len(cache) == 2
+    assert not is_open(fd1)
+
+
+def test_close_after_use(cache, tmp_path):
+    with cache.acquire(1, str(tmp_path)) as fd:
+        cache.invalidate([1])
+        assert is_open(fd)
+    assert not is_open(fd)
+    assert len(cache) == 0
+
+
+def test_cannot_open(cache, tmp_path):
+    with cache.acquire(1, str(tmp_path / "nonexistent")) as fd:
+        assert fd is None
+    assert len(cache) == 0
+
+
+def test_anchored_passthrough(tagdir, cache, tmp_path, mocker):
+    entity_path = tmp_path / "parent" / "entity1"
+    entity_path.mkdir(parents=True)
+    (entity_path / "file").write_bytes(b"data")
+    mocker.patch.object(tagdir, "resolve_entity", return_value=ResolvedPath(
+        (1,), 1, str(entity_path)))
+
+    attrs = tagdir.getattr(tagdir.session, "/@tag1/entity1/file")
+    assert attrs["st_size"] == 4
+
+    # The anchor keeps working after an ancestor is renamed
+    (tmp_path / "parent").rename(tmp_path / "renamed")
+    attrs = tagdir.getattr(tagdir.session, "/@tag1/entity1/file")
+    assert attrs["st_size"] == 4
+    entries = tagdir.readdir(tagdir.session, "/@tag1/entity1", None)
+    assert ("file", {"st_ino": attrs["st_ino"], "st_mode": stat.S_IFREG},
+            0) in entries
@@ -0,0 +1,44 @@
+from errno import ENOENT
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.fusepy.exceptions import FuseOSError
+from tagdir.models import Attr, Tag
+from tagdir.tagdir import get_tags
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    attr2 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    tag2 = Tag("tag2", attr2)
+    session.add_all([attr1, attr2, tag1, tag2])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+def test_get_by_names(tagdir):
+    tags, missing = Tag.get_by_names(tagdir.session,
+                                     ["tag2", "tag3", "tag1", "tag4"])
+    assert [tag.name for tag in tags] == ["tag2", "tag1"]
+    assert missing == ["tag3", "tag4"]
+
+
+def test_get_tags(tagdir):
+    tags = get_tags(tagdir.session, ["tag2", "tag1"])
+    assert [tag.name for tag in tags] == ["tag2", "tag1"]
+
+
+def test_get_tags_nonexistent(tagdir):
+    with pytest.raises(FuseOSError) as exc:
+        get_tags(tagdir.session, ["tag1", "tag3"])
+    assert exc.value.errno == ENOENT
+
+
+def test_get_by_single_name(tagdir):
+    tags, missing = Tag.get_by_names(tagdir.session, ["tag1"])
+    assert [tag.name for tag in tags] == ["tag1"] and missing == []
+    assert Tag.get_by_names(tagdir.session, ["tag3"]) == ([], ["tag3"])
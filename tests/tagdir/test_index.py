@@ -0,0 +1,114 @@
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr_tag = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr_tag)
+    tag2 = Tag("tag2", attr_tag)
+    tag3 = Tag("tag3", attr_tag)
+    attr_ent = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr_ent, "/path1", [tag1, tag2, tag3])
+    entity2 = Entity("entity2", attr_ent, "/path2", [tag1, tag3])
+    entity3 = Entity("entity3", attr_ent, "/path3", [tag1])
+    session.add_all([attr_tag, tag1, tag2, tag3,
+                     attr_ent, entity1, entity2, entity3])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def index(tagdir):
+    tagdir.index.load(tagdir.session)
+    yield tagdir.index
+    tagdir.index.clear()
+
+
+def ids(session, cls, *names):
+    return [cls.get_by_name(session, name).id for name in names]
+
+
+def entity_names(session, index, tag_names):
+    ids = index.list_entity_ids(tag_names)
+    if ids is None:
+        return None
+    return sorted(session.query(Entity).get(id_).name for id_ in ids)
+
+
+def test_intersection(tagdir, index):
+    session = tagdir.session
+    assert entity_names(session, index, ["tag1"]) == \
+        ["entity1", "entity2", "entity3"]
+    assert entity_names(session, index, ["tag3", "tag1"]) == \
+        ["entity1", "entity2"]
+    assert entity_names(session, index, ["tag1", "tag2", "tag3"]) == \
+        ["entity1"]
+    assert index.list_entity_ids(["tag1", "tag1"]) is not None
+
+
+def test_keyset(tagdir, index):
+    all_ids = sorted(ids(tagdir.session, Entity, "entity1", "entity2",
+                         "entity3"))
+    both_ids = sorted(ids(tagdir.session, Entity, "entity1", "entity2"))
+    assert index.list_entity_ids(["tag1"]) == all_ids
+    assert index.list_entity_ids(["tag1"], limit=2) == all_ids[:2]
+    assert index.list_entity_ids(["tag1"], all_ids[0], 1) == all_ids[1:2]
+    assert index.list_entity_ids(["tag3", "tag1"], both_ids[0]) == \
+        both_ids[1:]
+    assert index.list_entity_ids(["tag3", "tag1"], both_ids[1]) == []
+
+
+def test_nonexistent_tag(index):
+    assert index.list_entity_ids(["tag1", "tag4"]) is None
+
+
+def test_large_ids(index):
+    # Rowids of SQLite are 64 bits
+    index.add_tag(100, "tag4")
+    index.add_entity(2 ** 40)
+    index.add_tagging(100, 2 ** 40)
+    assert index.list_entity_ids(["tag4"]) == [2 ** 40]
+
+
+def test_tagging(tagdir, index):
+    tag2, = ids(tagdir.session, Tag, "tag2")
+    entity2, entity3 = ids(tagdir.session, Entity, "entity2", "entity3")
+
+    index.add_tagging(tag2, entity3)
+    index.add_tagging(tag2, entity3)
+    index.remove_tagging(tag2, entity2)
+    assert entity_names(tagdir.session, index, ["tag2"]) == \
+        ["entity1", "entity3"]
+
+
+def test_tags_and_entities(tagdir, index):
+    tag1, tag3 = ids(tagdir.session, Tag, "tag1", "tag3")
+    entity2, = ids(tagdir.session, Entity, "entity2")
+
+    index.add_tag(100, "tag4")
+    assert index.list_entity_ids(["tag4"]) == []
+    index.remove_tag(tag1, "tag1")
+    assert index.list_entity_ids(["tag1"]) is None
+
+    index.remove_entity(entity2, [tag3])
+    assert entity_names(tagdir.session, index, ["tag3"]) == ["entity1"]
+
+
+def test_updates_while_loading(tagdir, index, mocker):
+    tag2, = ids(tagdir.session, Tag, "tag2")
+    entity2, = ids(tagdir.session, Entity, "entity2")
+    session = tagdir.session
+    query = session.query
+
+    def racing_query(*args):
+        # Committed by another thread while the index is being loaded
+        index.add_tagging(tag2, entity2)
+        return query(*args)
+
+    mocker.patch.object(session, "query", side_effect=racing_query)
+    index.load(session)
+    assert entity_names(session, index, ["tag2"]) == ["entity1", "entity2"]
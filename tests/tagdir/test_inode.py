@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.cache import ResolvedPath
+from tagdir.inode import FOREIGN, VIRTUAL
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr2, "/path1", [tag1])
+    session.add_all([attr1, attr2, tag1, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def inodes(tagdir):
+    tagdir.inodes.clear()
+    yield tagdir.inodes
+    tagdir.inodes.clear()
+
+
+def test_virtual(tagdir):
+    inos = [tagdir.getattr(tagdir.session, path)["st_ino"]
+            for path in ["/", "/.entinfo", "/@tag1", "/@tag1/entity1"]]
+    assert len(set(inos)) == 4
+    assert all(ino & VIRTUAL for ino in inos)
+
+    entries = tagdir.readdir(tagdir.session, "/@tag1", None)
+    assert [attrs["st_ino"] for _, attrs, _ in entries] == inos[3:]
+
+
+def test_backing(inodes):
+    assert inodes.backing_ino(10, 5) == 5
+    assert inodes.backing_ino(10, 5) == 5
+
+    # Same inode numbers on other devices do not collide
+    ino1 = inodes.backing_ino(11, 5)
+    ino2 = inodes.backing_ino(12, 5)
+    assert len({5, ino1, ino2}) == 3
+    assert ino1 & FOREIGN and not ino1 & VIRTUAL
+    assert inodes.backing_ino(11, 5) == ino1
+
+    # Too large to be kept
+    ino3 = inodes.backing_ino(10, VIRTUAL | 5)
+    assert ino3 not in {5, ino1, ino2}
+    assert inodes.backing_ino(10, VIRTUAL | 5) == ino3
+
+
+def test_hard_links(tagdir, inodes, tmp_path, mocker):
+    (tmp_path / "file").write_bytes(b"data")
+    os.link(str(tmp_path / "file"), str(tmp_path / "link"))
+    mocker.patch.object(tagdir, "resolve_entity", return_value=ResolvedPath(
+        (1,), 1, str(tmp_path)))
+
+    ino = tagdir.getattr(tagdir.session, "/@tag1/entity1/file")["st_ino"]
+    assert ino == os.stat(str(tmp_path / "file")).st_ino
+    assert tagdir.getattr(tagdir.session,
+                          "/@tag1/entity1/link")["st_ino"] == ino
+
+    entries = tagdir.readdir(tagdir.session, "/@tag1/entity1", None)
+    attrs = {entry[0]: entry[1] for entry in entries[2:]}
+    assert attrs["file"]["st_ino"] == attrs["link"]["st_ino"] == ino
+    assert "st_dev" not in attrs["file"]
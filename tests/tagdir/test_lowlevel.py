@@ -0,0 +1,156 @@
+from errno import ENOENT, EPERM
+import os
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.cache import ResolvedPath
+from tagdir.config import CacheConfig
+from tagdir.fusepy.exceptions import FuseOSError
+from tagdir.lowlevel import TAGGING, TagdirLL
+from tagdir.models import Attr, Entity, Tag
+from tagdir.tagdir import encode_path
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_tag_attr()
+    tag2 = Tag("tag2", attr2)
+    attr3 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr3, "/path1", [tag1, tag2])
+    session.add_all([attr1, attr2, attr3, tag1, tag2, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def ll(tagdir, tmp_path, mocker):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_bytes(b"data")
+    mocker.patch.object(tagdir, "resolve_entity", return_value=ResolvedPath(
+        (1,), 1, str(tmp_path)))
+    ll = TagdirLL(tagdir, CacheConfig(tag=60.0, entity=5.0, content=1.0))
+    yield ll
+    ll.table.clear()
+
+
+def lookup_path(ll, path):
+    ino = 1
+    for name in path.split("/")[1:]:
+        ino = ll.lookup(ino, name)["ino"]
+    return ino
+
+
+def test_lookup(ll):
+    entry = ll.lookup(1, "@tag1")
+    assert entry["entry_timeout"] == 60.0
+    assert ll.lookup(1, "@tag1")["ino"] == entry["ino"]
+    assert ll.table.lookup("/@tag1") == entry["ino"]
+
+    entry = ll.lookup(entry["ino"], "entity1")
+    assert entry["entry_timeout"] == 5.0
+    assert ll.table.lookup("/@tag1/entity1") == entry["ino"]
+
+    entry = ll.lookup(entry["ino"], "dir")
+    assert entry["entry_timeout"] == 1.0
+    assert ll.table.lookup("/@tag1/entity1/dir") is None
+
+
+def test_lookup_missing(ll):
+    with pytest.raises(FuseOSError) as e:
+        ll.lookup(1, "@tag3")
+    assert e.value.errno == ENOENT
+
+    ll.cache_config = ll.cache_config._replace(negative=3.0)
+    assert ll.lookup(1, "@tag3") == {"ino": 0, "entry_timeout": 3.0}
+
+
+def test_backing_by_inode(ll, tmp_path):
+    ino = lookup_path(ll, "/@tag1/@tag2/entity1/dir/file")
+    attrs, timeout = ll.getattr(ino, None)
+    assert attrs["st_size"] == 4 and timeout == 1.0
+
+    # The same real file is the same node wherever it is looked up
+    assert lookup_path(ll, "/@tag2/entity1/dir/file") == ino
+
+    fh = ll.open(ino, os.O_RDONLY)
+    assert ll.read(ino, 4, 0, fh) == b"data"
+    ll.release(ino, fh)
+
+    # Renaming an ancestor does not matter
+    os.rename(str(tmp_path / "dir"), str(tmp_path / "moved"))
+    assert ll.getattr(ino, None)[0]["st_size"] == 4
+
+
+def test_create_in_tag_dir(ll):
+    ino = lookup_path(ll, "/@tag1")
+    with pytest.raises(FuseOSError) as e:
+        ll.create(ino, "file", 0o644, os.O_WRONLY)
+    assert e.value.errno == EPERM
+
+
+def test_mkdir_tagging(ll, tmp_path, mocker):
+    ino = lookup_path(ll, "/@tag1")
+    entity_ino = lookup_path(ll, "/@tag1/entity1")
+    source = tmp_path / "entity1"
+    source.mkdir()
+    mocker.patch.object(ll, "tagdir", side_effect=lambda op, *args: (
+        {"st_mode": 0o40755} if op == "getattr" else None))
+
+    name = encode_path(str(source))
+    entry = ll.mkdir(ino, name, 0o755)
+    ll.tagdir.assert_any_call("mkdir", "/@tag1/" + name, 0o755)
+    # Not an alias of the entity, and dropped at the next lookup
+    assert entry["ino"] != entity_ino
+    assert entry["entry_timeout"] == entry["attr_timeout"] == 0.0
+    node = ll.table.get(entry["ino"])
+    assert node.kind == TAGGING and node.path == "/@tag1/entity1"
+    assert ll.mkdir(ino, name, 0o755)["ino"] != entry["ino"]
+
+    ll.forget(entry["ino"], 1)
+    with pytest.raises(FuseOSError):
+        ll.table.get(entry["ino"])
+
+
+def test_forget(ll):
+    ino = lookup_path(ll, "/@tag1/entity1/dir")
+    ll.lookup(ino, "file")
+    file_ino = ll.lookup(ino, "file")["ino"]
+    size = len(ll.table)
+
+    ll.forget(file_ino, 1)
+    assert len(ll.table) == size
+    ll.forget(file_ino, 1)
+    assert len(ll.table) == size - 1
+
+    # The root is never forgotten
+    ll.forget(1, 1)
+    assert ll.table.get(1).path == "/"
+
+
+def test_readdir(ll):
+    ino = lookup_path(ll, "/@tag1/entity1/dir")
+    fh = ll.opendir(ino)
+    entries = ll.readdir(ino, 0, fh)
+    assert [name for name, _, _ in entries] == [".", "..", "file"]
+    assert ll.readdir(ino, entries[1][2], fh) == entries[2:]
+    ll.releasedir(ino, fh)
+
+    # Tag directories resume from offsets of Tagdir shifted by 2
+    entries = ll.readdir(1, 0, ll.opendir(1))
+    names = [name for name, _, _ in entries]
+    assert names[:2] == [".", ".."]
+    assert sorted(names[2:]) == ["@tag1", "@tag2"]
+    assert ll.readdir(1, entries[2][2], 0) == entries[3:]
+    assert ll.readdir(1, entries[-1][2], 0) == []
+
+
+def test_tag_dirs(ll):
+    for path in ["/@tag1", "/@tag2", "/@tag1/@tag2"]:
+        lookup_path(ll, path)
+    assert sorted(ll.table.tag_dirs({"tag1"}, {"tag1"})) == ["/@tag1"]
+    assert sorted(ll.table.tag_dirs(None, {"tag2"})) == \
+        ["/@tag1/@tag2", "/@tag2"]
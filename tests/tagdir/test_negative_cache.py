@@ -0,0 +1,103 @@
+from errno import ENOENT
+
+import pytest
+from sqlalchemy import event
+
+from .conftest import setup_tagdir_test
+from tagdir.cache import BloomFilter, NegativeCache
+from tagdir.fusepy.exceptions import FuseOSError
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr2, "/path1", [tag1])
+    session.add_all([attr1, attr2, tag1, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def cache(tagdir):
+    tagdir.init(tagdir.session, "/")
+    yield tagdir.negative_cache
+    tagdir.negative_cache.clear()
+    tagdir.index.clear()
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    names = ["name{}".format(i) for i in range(1000)]
+    for name in names:
+        bloom.add(name)
+    assert all(name in bloom for name in names)
+    false_positives = sum("other{}".format(i) in bloom for i in range(1000))
+    assert false_positives < 50
+
+
+def test_not_loaded(tagdir):
+    assert tagdir.negative_cache.might_exist("anything")
+
+
+def test_load(cache):
+    assert cache.might_exist("@tag1")
+    assert cache.might_exist("entity1")
+    assert not cache.might_exist("tag1")
+    assert not cache.might_exist(".DS_Store")
+
+
+def test_getattr_without_query(tagdir, cache):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = tagdir.session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        for path in ["/@tag1/.git", "/@tag1/.DS_Store", "/@tag1/.git/HEAD"]:
+            for op in ["getattr", "access"]:
+                with pytest.raises(FuseOSError) as exc:
+                    getattr(tagdir, op)(tagdir.session, path, 0)
+                assert exc.value.errno == ENOENT
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+
+
+def test_record_miss(tagdir, cache):
+    # Pretend that they passed the Bloom filter
+    cache.add("@tag2")
+    cache.add("entity2")
+
+    with pytest.raises(FuseOSError):
+        tagdir.access(tagdir.session, "/@tag2", 0)
+    with pytest.raises(FuseOSError):
+        tagdir.getattr(tagdir.session, "/@tag1/entity2")
+    assert not cache.might_exist("@tag2")
+    assert not cache.might_exist("entity2")
+
+
+def test_miss_expires(cache, mocker):
+    mocker.patch.object(NegativeCache, "MISS_TTL", 0)
+    cache.add("entity2")
+    cache.record_miss("entity2", cache.generation)
+    assert cache.might_exist("entity2")
+
+
+def test_stale_miss_is_discarded(cache):
+    generation = cache.generation
+    cache.add("entity2")
+    cache.record_miss("entity2", generation)
+    assert cache.might_exist("entity2")
+
+
+def test_mkdir_tag(tagdir, cache):
+    assert not cache.might_exist(NegativeCache.tag_key("tag2"))
+    tagdir.mkdir(tagdir.session, "/@tag2")
+    assert cache.might_exist(NegativeCache.tag_key("tag2"))
+    assert tagdir.getattr(tagdir.session, "/@tag2")
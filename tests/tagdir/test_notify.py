@@ -0,0 +1,79 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.models import Attr, Entity, Tag
+from tagdir.notify import FUSE_ROOT_ID, KernelCacheInvalidator
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    attr2 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    tag2 = Tag("tag2", attr2)
+    attr3 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr3, "/path1", [tag1, tag2])
+    session.add_all([attr1, attr2, attr3, tag1, tag2, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+class Nodes:
+    inos = {"/": FUSE_ROOT_ID, "/@tag1": 2, "/@tag2": 3, "/@tag1/@tag2": 4,
+            "/@tag3": 5}
+
+    def lookup(self, path):
+        return self.inos.get(path)
+
+    def tag_dirs(self, within, touching):
+        for path in self.inos:
+            tags = set(path.split("/@")[1:])
+            if not tags or not tags & touching:
+                continue
+            if within is None or tags <= within:
+                yield path
+
+
+@pytest.fixture
+def notifier(tagdir):
+    invalidator = KernelCacheInvalidator.get_instance()
+    notifier = MagicMock()
+    notifier.inval_entry.return_value = 0
+    invalidator.notifier = notifier
+    invalidator.nodes = Nodes()
+    # Send notifications synchronously
+    invalidator._queue = MagicMock()
+    invalidator._queue.put.side_effect = lambda notify: notify()
+    yield notifier
+    invalidator.notifier = None
+
+
+def commit(session):
+    session.dispatch.after_commit(session)
+
+
+def test_untagging(tagdir, notifier):
+    tagdir.rmdir(tagdir.session, "/@tag2/entity1")
+    notifier.inval_entry.assert_not_called()
+
+    commit(tagdir.session)
+    entries = sorted(call[0] for call in notifier.inval_entry.call_args_list)
+    assert entries == [(3, "entity1"), (4, "entity1")]
+
+
+def test_remove_tags(tagdir, notifier):
+    tagdir.rmdir(tagdir.session, "/@tag1")
+    commit(tagdir.session)
+    notifier.inval_inode.assert_called_with(FUSE_ROOT_ID)
+    entries = sorted(call[0] for call in notifier.inval_entry.call_args_list)
+    assert entries == [(1, "@tag1"), (2, "@tag2")]
+
+
+def test_create_tags(tagdir, notifier):
+    tagdir.mkdir(tagdir.session, "/@tag1/@tag3")
+    commit(tagdir.session)
+    entries = sorted(call[0] for call in notifier.inval_entry.call_args_list)
+    assert entries == [(1, "@tag3")]
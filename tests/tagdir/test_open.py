@@ -0,0 +1,105 @@
+from errno import ENOENT
+import os
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.fusepy.exceptions import FuseOSError
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr2, "/path1", [tag1])
+    session.add_all([attr1, attr2, tag1, entity1])
+
+
+FH = 42
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture(autouse=True)
+def clear_handles(tagdir):
+    tagdir.handles.clear()
+
+
+@pytest.fixture(autouse=True)
+def os_open(mocker):
+    # Files are opened as FH, and directories anchoring them for real
+    real_open = os.open
+
+    def fake_open(path, flags, *args, **kwargs):
+        if flags & os.O_DIRECTORY:
+            return real_open(path, flags, *args, **kwargs)
+        return FH
+
+    return mocker.patch("os.open", side_effect=fake_open)
+
+
+def test_open(tagdir, os_open):
+    assert tagdir.open(tagdir.session, "/@tag1/entity1/file", 0) == FH
+    os_open.assert_called_with("/path1/file", 0, dir_fd=None)
+    assert tagdir.handles == {FH: "/path1/file"}
+
+
+def test_nonexistent_entity(tagdir):
+    with pytest.raises(FuseOSError) as exc:
+        tagdir.open(tagdir.session, "/@tag1/entity2/file", 0)
+    assert exc.value.errno == ENOENT
+    assert not tagdir.handles
+
+
+def test_create(tagdir, mocker):
+    from tagdir.fusepy.loopback import Loopback
+    mock = mocker.patch.object(Loopback, "create", return_value=FH)
+    assert tagdir.create(tagdir.session, "/@tag1/entity1/new", 0o644) == FH
+    mock.assert_called_with("/path1/new", 0o644, dir_fd=None)
+    assert tagdir.handles == {FH: "/path1/new"}
+
+
+def test_data_plane_without_session(tagdir, mocker):
+    from tagdir.fusepy.loopback import Loopback
+    call = mocker.patch.object(Loopback, "__call__", create=True)
+    scope = mocker.patch("tagdir.tagdir.session_scope")
+    tagdir.handles[FH] = "/path1/file"
+
+    tagdir("read", "/@tag1/entity1/file", 10, 0, FH)
+    call.assert_called_with("read", "/path1/file", 10, 0, FH)
+
+    tagdir("release", "/@tag1/entity1/file", FH)
+    call.assert_called_with("release", "/path1/file", FH)
+    assert not tagdir.handles
+    scope.assert_not_called()
+
+
+def test_cache_hit_without_session(tagdir, mocker):
+    from tagdir.fusepy.loopback import Loopback
+    mocker.patch.object(Loopback, "getattr",
+                        return_value={"st_dev": 1, "st_ino": 2})
+    tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+
+    session = mocker.patch("tagdir.session.Session")
+    assert "st_ino" in tagdir("getattr", "/@tag1/entity1/file", None)
+    assert tagdir("open", "/@tag1/entity1/file", 0) == FH
+    session.assert_not_called()
+
+
+def test_session_on_query(tagdir, mocker):
+    session = mocker.patch("tagdir.session.Session")
+    tagdir.path_cache.clear()
+    tagdir("open", "/@tag1/entity1/file", 0)
+    session.assert_called_once()
+    session.return_value.commit.assert_called_once()
+    session.return_value.close.assert_called_once()
+
+
+def test_session_on_root_query(tagdir, mocker):
+    session = mocker.patch("tagdir.session.Session")
+    tagdir("getattr", "/", None)
+    session.assert_called_once()
+    session.return_value.commit.assert_called_once()
+    session.return_value.close.assert_called_once()
@@ -1,4 +1,5 @@
 from errno import EINVAL, ENOENT
+import stat
 
 import pytest
 
@@ -19,27 +20,65 @@ def setup_func(session):
                      attr_ent, entity1, entity2, entity3])
 
 
-RETVAL = "retval"
+RETVAL = [".", "..", ("file", None, 0)]
 
 # Dynamically define tagdir fixture
 setup_tagdir_test(setup_func, "readdir", RETVAL)
 
 
+def names(entries):
+    offsets = [offset for _, _, offset in entries]
+    assert offsets == sorted(set(offsets)) and 0 not in offsets
+    for _, attrs, _ in entries:
+        assert stat.S_ISDIR(attrs["st_mode"])
+    return [name for name, _, _ in entries]
+
+
+def list_by_chunk(tagdir, path):
+    entries = []
+    offset = 0
+    while True:
+        chunk = tagdir.readdir(tagdir.session, path, None, offset)
+        if not chunk:
+            return entries
+        entries.extend(chunk)
+        offset = chunk[-1][2]
+
+
 def test_root(tagdir):
-    res = sorted(tagdir.readdir(tagdir.session, "/", None))
+    res = sorted(names(tagdir.readdir(tagdir.session, "/", None)))
     assert res == ["@tag1", "@tag2"]
 
 
 def test_filter1(tagdir):
-    res = sorted(tagdir.readdir(tagdir.session, "/@tag1", None))
+    res = names(tagdir.readdir(tagdir.session, "/@tag1", None))
     assert res == ["entity1", "entity2"]
 
 
 def test_filter2(tagdir):
-    res = sorted(tagdir.readdir(tagdir.session, "/@tag1/@tag2", None))
+    res = names(tagdir.readdir(tagdir.session, "/@tag1/@tag2", None))
     assert res == ["entity1"]
 
 
+def test_root_by_chunk(tagdir, mocker):
+    mocker.patch("tagdir.tagdir.READDIR_CHUNK", 1)
+    res = sorted(names(list_by_chunk(tagdir, "/")))
+    assert res == ["@tag1", "@tag2"]
+
+
+def test_filter_by_chunk(tagdir, mocker):
+    mocker.patch("tagdir.tagdir.READDIR_CHUNK", 1)
+    res = names(list_by_chunk(tagdir, "/@tag1"))
+    assert res == ["entity1", "entity2"]
+
+
+def test_resume(tagdir):
+    first, second = tagdir.readdir(tagdir.session, "/@tag1", None)
+    assert tagdir.readdir(tagdir.session, "/@tag1", None, first[2]) == \
+        [second]
+    assert tagdir.readdir(tagdir.session, "/@tag1", None, second[2]) == []
+
+
 def test_nonexistent_tag(tagdir):
     with pytest.raises(FuseOSError) as exc:
         tagdir.readdir(tagdir.session, "/@non_tag", None)
@@ -55,4 +94,4 @@ def test_no_tag(tagdir):
 def test_entity(tagdir, method_mock):
     ret = tagdir.readdir(tagdir.session, "/@tag1/entity2", None)
     assert ret == RETVAL
-    method_mock.assert_called_with("/path2", None)
+    method_mock.assert_called_with("/path2", None, dir_fd=None)
@@ -0,0 +1,186 @@
+import os
+
+import pytest
+from watchdog import events
+
+from tagdir.db import session_scope, setup_db
+from tagdir.models import Attr, Entity
+from tagdir import reconcile as reconcile_module
+from tagdir.reconcile import reconcile, relocate, stat_all
+from tagdir.watch import EntityPathChangeHandler
+
+
+@pytest.fixture
+def fs(tmp_path):
+    setup_db("sqlite:///" + str(tmp_path / "tagdir.db"))
+    fs = tmp_path / "fs"
+    for path in ["a", "b", "c", "p/d", "e", "f", "g"]:
+        (fs / path).mkdir(parents=True)
+
+    with session_scope() as session:
+        for path in ["a", "b", "c", "p/d", "e", "f", "g"]:
+            attr = Attr.new_entity_attr()
+            entity = Entity(os.path.basename(path), attr, str(fs / path), [])
+            if path not in ["b", "f"]:
+                st = os.stat(str(fs / path))
+                entity.st_dev, entity.st_ino = st.st_dev, st.st_ino
+            if path == "g":
+                # On a filesystem which is not mounted
+                entity.st_dev += 1
+            session.add_all([attr, entity])
+    return fs
+
+
+def test_stat_all(fs):
+    paths = [str(fs / "a"), str(fs / "x"), str(fs / "a" / "x")]
+    found, missing = stat_all(paths, workers=2)
+    st = os.stat(paths[0])
+    assert found == {paths[0]: (st.st_dev, st.st_ino)}
+    assert missing == set(paths[1:])
+
+
+def test_relocate(fs):
+    st = os.stat(str(fs / "c"))
+    os.rename(str(fs / "c"), str(fs / "p" / "c"))
+    # Looked for in the whole tree of the nearest existing ancestor
+    assert relocate({str(fs / "c"): (st.st_dev, st.st_ino)}, set()) == \
+        {str(fs / "c"): str(fs / "p" / "c")}
+    assert relocate({str(fs / "x" / "c"): (st.st_dev, st.st_ino)},
+                    set()) == {str(fs / "x" / "c"): str(fs / "p" / "c")}
+    # Left alone unless found at a path of no other entity
+    assert relocate({str(fs / "x" / "c"): (st.st_dev, st.st_ino)},
+                    {str(fs / "p" / "c")}) == {}
+    os.rmdir(str(fs / "p" / "c"))
+    assert relocate({str(fs / "c"): (st.st_dev, st.st_ino)}, set()) == {}
+
+
+def test_relocate_sibling(fs):
+    (fs / "a" / "proj").mkdir()
+    (fs / "a" / "archive").mkdir()
+    st = os.stat(str(fs / "a" / "proj"))
+    os.rename(str(fs / "a" / "proj"), str(fs / "a" / "archive" / "proj"))
+    assert relocate({str(fs / "a" / "proj"): (st.st_dev, st.st_ino)},
+                    set()) == \
+        {str(fs / "a" / "proj"): str(fs / "a" / "archive" / "proj")}
+
+
+def test_relocate_cut_short(fs, mocker):
+    mocker.patch("tagdir.reconcile.MAX_SCAN", 1)
+    st = os.stat(str(fs / "c"))
+    os.rename(str(fs / "c"), str(fs / "p" / "d" / "c"))
+    assert relocate({str(fs / "c"): (st.st_dev, st.st_ino)}, set()) == {}
+
+
+def test_relocate_budget(fs, mocker):
+    mocker.patch("tagdir.reconcile.MAX_SCAN", 2)
+    (fs / "a" / "proj").mkdir()
+    (fs / "a" / "archive").mkdir()
+    proj = os.stat(str(fs / "a" / "proj"))
+    c = os.stat(str(fs / "c"))
+    os.rename(str(fs / "a" / "proj"), str(fs / "a" / "archive" / "proj"))
+    os.rename(str(fs / "c"), str(fs / "p" / "c"))
+
+    # The deeper tree takes up the directories of all trees
+    searched = set()
+    assert relocate({str(fs / "a" / "proj"): (proj.st_dev, proj.st_ino),
+                     str(fs / "c"): (c.st_dev, c.st_ino)},
+                    set(), searched) == \
+        {str(fs / "a" / "proj"): str(fs / "a" / "archive" / "proj")}
+    assert searched == {str(fs / "a" / "proj")}
+
+
+def test_reconcile(fs, mocker):
+    os.rename(str(fs / "c"), str(fs / "c2"))
+    os.rename(str(fs / "p"), str(fs / "q"))
+    for path in ["e", "f", "g"]:
+        os.rmdir(str(fs / path))
+
+    assert reconcile(workers=4) == {str(fs / "c"): str(fs / "c2"),
+                                    str(fs / "p" / "d"): str(fs / "q" / "d")}
+
+    with session_scope() as session:
+        entities = {entity.name: entity for entity in session.query(Entity)}
+        assert {name: entity.path for name, entity in entities.items()} == \
+            {"a": str(fs / "a"), "b": str(fs / "b"), "c2": str(fs / "c2"),
+             "d": str(fs / "q" / "d"), "e": str(fs / "e"),
+             "f": str(fs / "f"), "g": str(fs / "g")}
+        st = os.stat(str(fs / "b"))
+        assert (entities["b"].st_dev, entities["b"].st_ino) == \
+            (st.st_dev, st.st_ino)
+
+        # Not looked for again, unless on a filesystem not mounted now
+        assert entities["e"].st_dev is None
+        assert entities["g"].st_dev is not None
+
+    # Nothing to do any more
+    scan = mocker.spy(reconcile_module, "_scan")
+    assert reconcile() == {}
+    scan.assert_not_called()
+
+
+def test_reconcile_recreated(fs):
+    os.rename(str(fs / "a"), str(fs / "p" / "a"))
+    (fs / "a").mkdir()
+    os.rmdir(str(fs / "c"))
+    (fs / "c").mkdir()
+
+    assert reconcile() == {str(fs / "a"): str(fs / "p" / "a")}
+    paths = entity_paths()
+    assert (paths["a"], paths["c"]) == (str(fs / "p" / "a"), str(fs / "c"))
+    with session_scope() as session:
+        entity = session.query(Entity).filter_by(name="c").one()
+        st = os.stat(str(fs / "c"))
+        assert (entity.st_dev, entity.st_ino) == (st.st_dev, st.st_ino)
+
+
+def entity_paths():
+    with session_scope() as session:
+        return {name: path for name, path in
+                session.query(Entity.name, Entity.path)}
+
+
+def test_lost_entities(fs, tmp_path):
+    handler = EntityPathChangeHandler()
+    handler.DEBOUNCE = 60
+    (fs / "archive").mkdir()
+    (tmp_path / "elsewhere").mkdir()
+    os.rename(str(fs / "p"), str(fs / "archive" / "p"))
+    os.rename(str(fs / "c"), str(tmp_path / "elsewhere" / "c"))
+    os.rename(str(fs / "a"), str(tmp_path / "elsewhere" / "a"))
+    os.rmdir(str(fs / "e"))
+
+    # Into an unwatched directory
+    handler.on_moved(events.DirMovedEvent(str(fs / "p"), ""))
+    # Out of the tree, into a watched directory
+    handler.on_moved(events.DirMovedEvent(str(fs / "c"), ""))
+    handler.on_moved(events.DirMovedEvent(
+        "", str(tmp_path / "elsewhere" / "c")))
+    # Out of the tree, into an unwatched directory
+    handler.on_moved(events.DirMovedEvent(str(fs / "a"), ""))
+    handler.on_deleted(events.DirDeletedEvent(str(fs / "e")))
+    handler.flush()
+
+    paths = entity_paths()
+    assert paths["d"] == str(fs / "archive" / "p" / "d")
+    assert paths["c"] == str(tmp_path / "elsewhere" / "c")
+    assert paths["a"] == str(fs / "a")
+    assert "e" not in paths
+
+
+def test_deleted_ancestor(fs):
+    handler = EntityPathChangeHandler()
+    handler.DEBOUNCE = 60
+    (fs / "archive").mkdir()
+    os.rename(str(fs / "p"), str(fs / "archive" / "p"))
+
+    # Reported by watchdog without full events, which only tells that the
+    # directory is gone from there
+    handler.on_deleted(events.DirDeletedEvent(str(fs / "p")))
+    handler.flush()
+    assert entity_paths()["d"] == str(fs / "archive" / "p" / "d")
+
+    os.rmdir(str(fs / "archive" / "p" / "d"))
+    os.rmdir(str(fs / "archive" / "p"))
+    handler.on_deleted(events.DirDeletedEvent(str(fs / "archive")))
+    handler.flush()
+    assert entity_paths()["d"] == str(fs / "archive" / "p" / "d")
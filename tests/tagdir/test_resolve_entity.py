@@ -0,0 +1,85 @@
+from errno import ENOENT
+
+import pytest
+
+from .conftest import setup_tagdir_test
+from tagdir.cache import ResolvedPath, ResolvedPathCache
+from tagdir.fusepy.exceptions import FuseOSError
+from tagdir.models import Attr, Entity, Tag
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    attr2 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    tag2 = Tag("tag2", attr2)
+    attr3 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr3, "/path1", [tag1, tag2])
+    session.add_all([attr1, attr2, attr3, tag1, tag2, entity1])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture(autouse=True)
+def cache(tagdir):
+    cache = tagdir.path_cache
+    cache.clear()
+    yield cache
+    cache.maxsize = ResolvedPathCache.DEFAULT_MAXSIZE
+
+
+def test_cache_hit(tagdir):
+    res1 = tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+    assert res1.entity_path == "/path1"
+    assert len(tagdir.path_cache) == 1
+
+    # Served from the cache even if the database changes behind it
+    Entity.get_by_name(tagdir.session, "entity1").path = "/moved"
+    res2 = tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+    assert res2 == res1
+
+
+def test_nonexistent_not_cached(tagdir):
+    with pytest.raises(FuseOSError) as exc:
+        tagdir.resolve_entity(tagdir.session, ["tag1"], "entity2")
+    assert exc.value.errno == ENOENT
+    assert len(tagdir.path_cache) == 0
+
+
+def test_invalidate_by_rmdir_tag(tagdir):
+    tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+    tagdir.resolve_entity(tagdir.session, ["tag2"], "entity1")
+    tagdir.rmdir(tagdir.session, "/@tag1")
+    assert len(tagdir.path_cache) == 1
+    with pytest.raises(FuseOSError):
+        tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+
+
+def test_invalidate_by_untagging(tagdir):
+    tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+    tagdir.rmdir(tagdir.session, "/@tag1/entity1")
+    assert len(tagdir.path_cache) == 0
+    with pytest.raises(FuseOSError):
+        tagdir.resolve_entity(tagdir.session, ["tag1"], "entity1")
+
+
+def test_lru_eviction(cache):
+    cache.maxsize = 2
+    for i in range(3):
+        cache.put(((), str(i)), ResolvedPath((1,), i, "/" + str(i)),
+                  cache.generation)
+    assert cache.get(((), "0")) is None
+    assert cache.get(((), "2")).entity_id == 2
+
+    cache.invalidate(entity_ids=[1])
+    assert cache.get(((), "1")) is None
+    assert len(cache) == 1
+
+
+def test_stale_put_is_discarded(cache):
+    generation = cache.generation
+    cache.invalidate(tag_ids=[1])
+    cache.put(((), "e"), ResolvedPath((1,), 1, "/e"), generation)
+    assert cache.get(((), "e")) is None
@@ -0,0 +1,338 @@
+import os
+import time
+
+import pytest
+from watchdog import events
+
+from .conftest import setup_tagdir_test
+from tagdir.models import Attr, Entity, Tag
+from tagdir.watch import coalesce, EntityPathChangeHandler, \
+    EntityPathChangeObserver, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, \
+    IN_Q_OVERFLOW, INOTIFY_EVENT, InotifyBackend
+
+
+def setup_func(session):
+    attr1 = Attr.new_tag_attr()
+    tag1 = Tag("tag1", attr1)
+    attr2 = Attr.new_entity_attr()
+    entity1 = Entity("entity1", attr2, "/path1", [tag1])
+    attr3 = Attr.new_entity_attr()
+    entity2 = Entity("entity2", attr3, "/path2", [tag1])
+    session.add_all([attr1, attr2, attr3, tag1, entity1, entity2])
+
+
+# Dynamically define tagdir fixture
+setup_tagdir_test(setup_func)
+
+
+@pytest.fixture
+def observer(tagdir):
+    return EntityPathChangeObserver.get_instance()
+
+
+def watched(observer, path):
+    return observer.watched_paths().get(str(path), 0)
+
+
+def test_refcount(observer, tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+
+    observer.add_entity_path(tmp_path / "a")
+    observer.add_entity_path(tmp_path / "b")
+    # Added twice, but counted once
+    observer.add_entity_path(tmp_path / "b")
+    assert watched(observer, tmp_path) == 2
+
+    observer.remove_entity_path(tmp_path / "a")
+    assert watched(observer, tmp_path) == 1
+    observer.remove_entity_path(tmp_path / "b")
+    assert watched(observer, tmp_path) == 0
+    # Not watched
+    observer.remove_entity_path(tmp_path / "b")
+
+
+def test_move(observer, tmp_path):
+    (tmp_path / "x").mkdir()
+    (tmp_path / "y").mkdir()
+
+    observer.add_entity_path(tmp_path / "x" / "a")
+    observer.move_entity_path(tmp_path / "x" / "a", tmp_path / "y" / "a")
+    assert watched(observer, tmp_path / "x") == 0
+    assert watched(observer, tmp_path / "y") == 1
+
+    # Renamed in the same directory
+    observer.move_entity_path(tmp_path / "y" / "a", tmp_path / "y" / "b")
+    assert watched(observer, tmp_path / "y") == 1
+    observer.remove_entity_path(tmp_path / "y" / "b")
+
+
+def test_coalesce():
+    assert coalesce([("/a", "/b"), ("/b", "/c"), ("/x", "/y"),
+                     ("/y", None), ("/d", None), ("/d", None),
+                     ("/e", "/f"), ("/f", "/e")]) == \
+        {"/a": "/c", "/x": None, "/d": None}
+    # Deleted, and replaced by another directory
+    assert coalesce([("/a", None), ("/b", "/a")]) == {"/a": None, "/b": "/a"}
+    # Moved in a moved directory, and with the directory it is moved into
+    assert coalesce([("/a", "/b"), ("/b/x", "/b/y"), ("/c", "/b/z"),
+                     ("/b", "/a")]) == {"/a/x": "/a/y", "/c": "/a/z"}
+    # Only a deletion of a directory itself tells it is gone
+    assert coalesce([("/x", "/a/x"), ("/a", None)]) == {"/x": "",
+                                                        "/a": None}
+    assert coalesce([("/a", "/b"), ("/b", ""), ("/x", "/c/x"),
+                     ("/c", "")]) == {"/a": "", "/x": "", "/c": ""}
+
+
+def test_debounce(tagdir, mocker):
+    handler = EntityPathChangeHandler()
+    # Flushed only explicitly
+    handler.DEBOUNCE = 60
+    apply = mocker.patch.object(handler, "apply")
+    handler.on_moved(events.DirMovedEvent("/a", "/b"))
+    handler.on_moved(events.FileMovedEvent("/file1", "/file2"))
+    handler.on_deleted(events.DirDeletedEvent("/b"))
+    handler.on_moved(events.DirMovedEvent("/c", "/d"))
+    # Paths of watches scheduled by bytes
+    handler.on_moved(events.DirMovedEvent(b"/e", b"/f"))
+    assert not apply.called
+
+    handler.flush()
+    apply.assert_called_once_with(mocker.ANY, {"/a": None, "/c": "/d",
+                                               "/e": "/f"})
+    handler.flush()
+    assert apply.call_count == 1
+
+
+def test_apply_failure(tagdir, mocker, caplog):
+    handler = EntityPathChangeHandler()
+    handler.DEBOUNCE = 60
+    mocker.patch.object(handler, "apply", side_effect=RuntimeError("failed"))
+    handler.on_deleted(events.DirDeletedEvent("/a"))
+
+    handler.flush()
+    assert "Failed to apply moves of entities" in caplog.text
+    assert "RuntimeError: failed" in caplog.text
+
+
+def test_move_dir(observer, mocker):
+    backend = mocker.patch.object(observer, "backend")
+    backend.schedule.side_effect = lambda path: path
+    backend.move.side_effect = lambda watch, path: path
+
+    observer.add_entity_path("/a/x/e1")
+    observer.add_entity_path("/a/x/y/e2")
+    # Ancestors are watched once
+    assert sorted(call[0][0] for call in backend.schedule.call_args_list) \
+        == ["/a", "/a/x", "/a/x/y"]
+
+    observer.move_dir("/a", "/b/c")
+    assert watched(observer, "/b/c/x") == 1
+    assert watched(observer, "/b/c/x/y") == 1
+    assert watched(observer, "/a/x") == 0
+    assert sorted(call[0][1] for call in backend.move.call_args_list) == \
+        ["/b/c", "/b/c/x", "/b/c/x/y"]
+    # The new parent is watched instead
+    backend.schedule.assert_called_with("/b")
+    assert not backend.unschedule.called
+
+    observer.remove_entity_path("/b/c/x/e1")
+    observer.remove_entity_path("/b/c/x/y/e2")
+    assert sorted(call[0][0] for call in backend.unschedule.call_args_list) \
+        == ["/b", "/b/c", "/b/c/x", "/b/c/x/y"]
+
+
+def test_apply_moves(observer, mocker):
+    backend = mocker.patch.object(observer, "backend")
+    backend.schedule.side_effect = lambda path: path
+    backend.move.side_effect = lambda watch, path: path
+    for path in ["/a/x/e1", "/a/x/e2", "/a/x/e3"]:
+        observer.add_entity_path(path)
+
+    # An entity moved out of a moved directory, and one deleted in it
+    observer.apply_moves(["/a/x/e3"], [("/a", "/b")],
+                         [("/a/x/e1", "/c/e1")])
+    watched = observer.watched_paths()
+    assert [watched.get(path) for path in ["/a/x", "/b/x", "/c"]] \
+        == [None, 1, 1]
+
+    observer.remove_entity_path("/b/x/e2")
+    observer.remove_entity_path("/c/e1")
+    assert not {"/a/x", "/b/x", "/c"} & set(observer.watched_paths())
+    unscheduled = {call[0][0] for call in backend.unschedule.call_args_list}
+    assert {"/b", "/b/x", "/c"} <= unscheduled
+    assert not {"/a", "/a/x"} & unscheduled
+
+
+def test_unwatched_changes(observer, mocker):
+    backend = mocker.patch.object(observer, "backend")
+    backend.schedule.side_effect = lambda path: path
+    observer.add_entity_path("/a/x/e1")
+    handler = EntityPathChangeHandler(observer.watches)
+    handler.DEBOUNCE = 60
+    apply = mocker.patch.object(handler, "apply")
+
+    handler.on_deleted(events.DirDeletedEvent("/a/y"))
+    handler.on_moved(events.DirMovedEvent("/tmp/x", "/tmp/y"))
+    handler.on_moved(events.DirMovedEvent("/a/x", "/b/x"))
+    # Watched once the move is applied
+    handler.on_deleted(events.DirDeletedEvent("/b/x/e1"))
+    handler.on_deleted(events.DirDeletedEvent("/b/y"))
+    assert handler._changes == [("/a/x", "/b/x"), ("/b/x/e1", None)]
+
+    handler.flush()
+    apply.assert_called_once_with(mocker.ANY, {"/a/x": "/b/x",
+                                               "/a/x/e1": None})
+    assert not handler._pending
+    observer.remove_entity_path("/a/x/e1")
+
+
+def test_apply(tagdir, observer):
+    handler = EntityPathChangeHandler()
+    handler.apply(tagdir.session, {"/path1": "/moved/renamed",
+                                   "/path2": None, "/path3": None})
+    tagdir.session.flush()
+
+    entities = tagdir.session.query(Entity).all()
+    assert [(entity.name, entity.path) for entity in entities] == \
+        [("renamed", "/moved/renamed")]
+
+
+def test_apply_dir(tagdir, observer):
+    session = tagdir.session
+    tag1 = session.query(Tag).filter_by(name="tag1").one()
+    for name, path in [("x", "/a/x"), ("y", "/a/x/y"), ("z", "/a/z/z"),
+                       ("w", "/a/w"), ("ab", "/ab"), ("c", "/c")]:
+        attr = Attr.new_entity_attr()
+        session.add_all([attr, Entity(name, attr, path, [tag1])])
+    session.flush()
+
+    handler = EntityPathChangeHandler()
+    handler.apply(session, coalesce([("/a", "/b"), ("/b/x", "/b/v"),
+                                     ("/c", "/a"), ("/b/w", None)]))
+    session.flush()
+    session.expire_all()
+
+    paths = {entity.name: entity.path
+             for entity in session.query(Entity)}
+    assert paths == {"entity1": "/path1", "entity2": "/path2",
+                     "v": "/b/v", "y": "/b/v/y", "z": "/b/z/z",
+                     "ab": "/ab", "a": "/a"}
+
+
+class Recorder(events.FileSystemEventHandler):
+    def __init__(self):
+        self.events = []
+
+    def on_any_event(self, event):
+        self.events.append((event.event_type, event.src_path,
+                            getattr(event, "dest_path", "")))
+
+
+def wait_for(recorder, n):
+    for _ in range(200):
+        if len(recorder.events) >= n:
+            return recorder.events
+        time.sleep(0.01)
+    return recorder.events
+
+
+def test_inotify(tmp_path):
+    watched_dir = tmp_path / "watched"
+    other_dir = tmp_path / "other"
+    for path in ["a", "b", "c", "d"]:
+        (watched_dir / path).mkdir(parents=True)
+    other_dir.mkdir()
+    (other_dir / "file").write_bytes(b"")
+
+    recorder = Recorder()
+    backend = InotifyBackend(recorder)
+    wd = backend.schedule(str(watched_dir))
+    backend.schedule(str(other_dir))
+    backend.start()
+    try:
+        os.rename(str(watched_dir / "a"), str(watched_dir / "e"))
+        os.rmdir(str(watched_dir / "b"))
+        # Out of the watched directories
+        os.rename(str(watched_dir / "c"), str(tmp_path / "c"))
+        # Not a directory
+        os.rename(str(other_dir / "file"), str(watched_dir / "file"))
+        assert wait_for(recorder, 3) == [
+            ("moved", str(watched_dir / "a"), str(watched_dir / "e")),
+            ("deleted", str(watched_dir / "b"), ""),
+            ("moved", str(watched_dir / "c"), "")]
+        # Into the watched directories
+        os.rename(str(tmp_path / "c"), str(watched_dir / "c"))
+        assert wait_for(recorder, 4)[3] == \
+            ("moved", "", str(watched_dir / "c"))
+        os.rmdir(str(watched_dir / "c"))
+        assert wait_for(recorder, 5)[4] == \
+            ("deleted", str(watched_dir / "c"), "")
+        del recorder.events[3:]
+
+        # Watches follow moved directories
+        os.rename(str(watched_dir), str(tmp_path / "moved"))
+        backend.move(wd, str(tmp_path / "moved"))
+        os.rmdir(str(tmp_path / "moved" / "e"))
+        assert wait_for(recorder, 4)[3] == \
+            ("deleted", str(tmp_path / "moved" / "e"), "")
+
+        backend.unschedule(wd)
+        os.rmdir(str(tmp_path / "moved" / "d"))
+        time.sleep(0.1)
+        assert len(recorder.events) == 4
+    finally:
+        backend.stop()
+        backend.join()
+
+
+def inotify_event(wd, mask, cookie=0, name=b""):
+    name = name.ljust(16, b"\0") if name else b""
+    return INOTIFY_EVENT.pack(wd, mask, cookie, len(name)) + name
+
+
+def test_inotify_split(mocker):
+    monotonic = mocker.patch("tagdir.watch.time.monotonic", return_value=0)
+    recorder = Recorder()
+    on_overflow = mocker.Mock()
+    backend = InotifyBackend(recorder, on_overflow)
+    backend._paths = {1: "/a", 2: "/b"}
+
+    def read(buf):
+        backend._dispatch(backend._parse(buf))
+        backend._expire()
+
+    try:
+        read(inotify_event(1, IN_MOVED_FROM | IN_ISDIR, 7, b"x"))
+        assert recorder.events == []
+        # The destination is read later
+        read(inotify_event(2, IN_MOVED_TO | IN_ISDIR, 7, b"y") +
+             inotify_event(1, IN_MOVED_FROM | IN_ISDIR, 8, b"z"))
+        assert recorder.events == [("moved", "/a/x", "/b/y")]
+
+        monotonic.return_value = backend.MOVE_TIMEOUT
+        read(b"")
+        assert recorder.events[1:] == [("moved", "/a/z", "")]
+
+        # Moves whose destination may be lost are left to on_overflow
+        read(inotify_event(1, IN_MOVED_FROM | IN_ISDIR, 9, b"w") +
+             inotify_event(-1, IN_Q_OVERFLOW))
+        on_overflow.assert_called_once_with()
+        monotonic.return_value = 2 * backend.MOVE_TIMEOUT
+        read(b"")
+        assert len(recorder.events) == 2
+    finally:
+        backend.join()
+
+
+def test_rescan(observer, mocker):
+    reconcile = mocker.patch("tagdir.reconcile.reconcile")
+    flush = mocker.patch.object(observer.handler, "flush")
+
+    observer.rescan()
+    for _ in range(200):
+        if not observer._rescanning:
+            break
+        time.sleep(0.01)
+    flush.assert_called_once_with()
+    reconcile.assert_called_once_with()
@@ -0,0 +1,44 @@
+import pytest
+
+from tagdir.config import CacheConfig, load_cache_config
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "tagdir.ini"
+    path.write_text("[timeouts]\nroot = 120\nentity = 2.5\n"
+                    "kernel_cache = yes\n")
+    return str(path)
+
+
+def test_default():
+    assert load_cache_config() == CacheConfig()
+
+
+def test_file(config_path):
+    config = load_cache_config(config_path)
+    assert config.root == 120.0
+    assert config.entity == 2.5
+    assert config.tag == CacheConfig().tag
+    assert config.kernel_cache is True
+
+
+def test_overrides(config_path):
+    config = load_cache_config(config_path, root=None, entity=10.0)
+    assert config.root == 120.0
+    assert config.entity == 10.0
+
+
+def test_unknown_key(tmp_path):
+    path = tmp_path / "tagdir.ini"
+    path.write_text("[timeouts]\nfoo = 1\n")
+    with pytest.raises(ValueError):
+        load_cache_config(str(path))
+
+
+def test_fuse_options():
+    config = CacheConfig(root=60.0, tag=30.0, entity=5.0, content=1.0,
+                         negative=0.5, kernel_cache=False)
+    assert config.fuse_options() == {
+        "entry_timeout": 1.0, "attr_timeout": 1.0,
+        "negative_timeout": 0.5, "kernel_cache": False}
@@ -0,0 +1,147 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from tagdir.db import after_commit, ensure_schema, session_scope, setup_db, \
+    Writer
+from tagdir.models import Attr, Tag, Base
+
+INDEXES = ["ix_entities_attr_id", "ix_tagging_tag_id_entity_id",
+           "ix_tags_attr_id", "ix_tags_name_covering"]
+COLUMNS = ["entities.st_dev", "entities.st_ino"]
+
+
+def query_plan(engine, sql):
+    with engine.connect() as conn:
+        return " ".join(row[-1] for row in
+                        conn.execute("EXPLAIN QUERY PLAN " + sql))
+
+
+def test_ensure_schema(tmp_path):
+    engine = create_engine("sqlite:///" + str(tmp_path / "tagdir.db"))
+    Base.metadata.create_all(engine)
+    assert ensure_schema(engine) == []
+
+    # A database made before the indexes existed
+    with engine.connect() as conn:
+        for name in INDEXES:
+            conn.execute("DROP INDEX " + name)
+
+    assert sorted(ensure_schema(engine)) == INDEXES
+    assert ensure_schema(engine) == []
+
+    # And before the columns existed
+    with engine.connect() as conn:
+        for name in COLUMNS:
+            conn.execute("ALTER TABLE entities DROP COLUMN " +
+                         name.split(".")[1])
+
+    assert ensure_schema(engine) == COLUMNS
+    with engine.connect() as conn:
+        conn.execute("UPDATE entities SET st_dev = 1")
+
+
+def test_query_plans():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+
+    plan = query_plan(engine,
+                      "SELECT entity_id FROM tagging WHERE tag_id = 1")
+    assert "COVERING INDEX ix_tagging_tag_id_entity_id" in plan
+
+    # Chosen over the unique index of name once tags are analyzed
+    with engine.connect() as conn:
+        for i in range(100):
+            conn.execute("INSERT INTO tags (name, attr_id) VALUES (?, ?)",
+                         ("tag{}".format(i), i))
+        conn.execute("ANALYZE")
+    plan = query_plan(engine, "SELECT id, name, attr_id FROM tags "
+                      "WHERE name IN ('a', 'b')")
+    assert "COVERING INDEX ix_tags_name_covering" in plan
+
+
+def test_file_db(tmp_path):
+    setup_db("sqlite:///" + str(tmp_path / "tagdir.db"))
+
+    def connection(session):
+        return session.connection().connection.connection
+
+    with session_scope() as session:
+        conn = connection(session)
+        pragmas = [conn.execute("PRAGMA " + name).fetchone()[0]
+                   for name in ["journal_mode", "synchronous", "busy_timeout"]]
+        assert pragmas == ["wal", 1, 5000]
+
+        # Nested sessions never share a transaction
+        with session_scope() as nested:
+            assert connection(nested) is not conn
+
+    # Connections are kept for reuse
+    from tagdir.session import Session
+    assert Session.kw["bind"].pool.checkedin() == 2
+
+
+@pytest.fixture
+def writer(tmp_path):
+    setup_db("sqlite:///" + str(tmp_path / "tagdir.db"))
+    writer = Writer.get_instance()
+    writer.start()
+    yield writer
+    writer.stop()
+
+
+def add_tag(session, name, called):
+    attr = Attr.new_tag_attr()
+    session.add_all([attr, Tag(name, attr)])
+    session.flush()
+    after_commit(session, lambda: called.append(name))
+    if name == "bad":
+        raise ValueError(name)
+    return name
+
+
+def test_writer(writer):
+    from tagdir.session import Session
+    engine = Session.kw["bind"]
+    commits = []
+    on_commit = commits.append
+    event.listen(engine, "commit", on_commit)
+    called = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(session):
+        started.set()
+        release.wait()
+
+    try:
+        writer.submit(block)
+        started.wait()
+        # Queued while the writer is busy
+        futures = [writer.submit(add_tag, name, called)
+                   for name in ["tag1", "bad", "tag2"]]
+        release.set()
+        assert futures[0].result() == "tag1"
+        with pytest.raises(ValueError):
+            futures[1].result()
+        assert futures[2].result() == "tag2"
+    finally:
+        event.remove(engine, "commit", on_commit)
+
+    # The batch of block committed nothing
+    assert len(commits) == 1
+    assert called == ["tag1", "tag2"]
+    with session_scope() as session:
+        names = [name for name, in session.query(Tag.name)]
+    assert sorted(names) == ["tag1", "tag2"]
+
+
+def test_writer_inline():
+    setup_db("sqlite:///:memory:")
+    called = []
+    with session_scope() as session:
+        assert Writer.get_instance().run(session, add_tag, "tag1",
+                                         called) == "tag1"
+        assert not called
+    assert called == ["tag1"]
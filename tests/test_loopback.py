@@ -0,0 +1,134 @@
+import os
+import stat
+import threading
+
+import pytest
+
+from tagdir.fusepy.loopback import BATCHED, EXPLICIT, Loopback, STRICT
+
+
+@pytest.fixture
+def fh(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"0123456789")
+    fh = os.open(str(path), os.O_RDWR)
+    yield fh
+    os.close(fh)
+
+
+def test_read(fh):
+    assert Loopback().read("/file", 4, 3, fh) == b"3456"
+
+
+def test_readinto(fh):
+    buf = bytearray(4)
+    with memoryview(buf) as view:
+        assert Loopback().readinto("/file", view, 8, fh) == 2
+    assert buf[:2] == b"89"
+
+
+def test_write(fh):
+    loopback = Loopback()
+    assert loopback.write("/file", b"ab", 4, fh) == 2
+    assert loopback.read("/file", 10, 0, fh) == b"0123ab6789"
+
+
+def is_open(fh):
+    try:
+        os.fstat(fh)
+        return True
+    except OSError:
+        return False
+
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        Loopback("never")
+
+
+@pytest.mark.parametrize("durability, synced", [
+    (STRICT, True), (EXPLICIT, False), (BATCHED, False)])
+def test_flush(fh, mocker, durability, synced):
+    fsync = mocker.patch("os.fsync")
+    loopback = Loopback(durability, fsync_interval=3600)
+    loopback.flush("/file", fh)
+    assert fsync.called == synced
+    loopback.destroy("/")
+
+
+def test_batched_release_defers_close(tmp_path, mocker):
+    fsync = mocker.patch("os.fsync")
+    loopback = Loopback(BATCHED, fsync_interval=3600)
+    fh = os.open(str(tmp_path / "file"), os.O_WRONLY | os.O_CREAT)
+    loopback.write("/file", b"data", 0, fh)
+    loopback.flush("/file", fh)
+    loopback.release("/file", fh)
+    assert is_open(fh)
+
+    loopback.destroy("/")
+    fsync.assert_called_once_with(fh)
+    assert not is_open(fh)
+
+
+def test_batched_release_clean(tmp_path):
+    loopback = Loopback(BATCHED, fsync_interval=3600)
+    fh = os.open(str(tmp_path / "file"), os.O_WRONLY | os.O_CREAT)
+    loopback.release("/file", fh)
+    assert not is_open(fh)
+
+
+def test_batched_read_only(fh, mocker):
+    fsync = mocker.patch("os.fsync")
+    loopback = Loopback(BATCHED, fsync_interval=3600)
+    loopback.read("/file", 4, 0, fh)
+    loopback.flush("/file", fh)
+    loopback.destroy("/")
+    assert not fsync.called
+
+
+def test_batched_release_without_flush(tmp_path, mocker):
+    fsync = mocker.patch("os.fsync")
+    loopback = Loopback(BATCHED, fsync_interval=3600)
+    fh = os.open(str(tmp_path / "file"), os.O_WRONLY | os.O_CREAT)
+    loopback.write("/file", b"data", 0, fh)
+    loopback.release("/file", fh)
+    assert is_open(fh)
+    loopback.destroy("/")
+    fsync.assert_called_once_with(fh)
+
+
+def test_batched_explicit_fsync(fh, mocker):
+    fsync = mocker.patch("os.fsync")
+    loopback = Loopback(BATCHED, fsync_interval=3600)
+    loopback.write("/file", b"ab", 0, fh)
+    loopback.flush("/file", fh)
+    loopback.fsync("/file", 0, fh)
+    loopback.destroy("/")
+    fsync.assert_called_once_with(fh)
+
+
+def test_batched_background(fh, mocker):
+    synced = threading.Event()
+    mocker.patch("os.fsync", side_effect=lambda _: synced.set())
+    loopback = Loopback(BATCHED, fsync_interval=0.01)
+    loopback.truncate("/file", 4, fh)
+    loopback.flush("/file", fh)
+    assert synced.wait(5)
+    loopback.destroy("/")
+
+
+def test_readdir(tmp_path, mocker):
+    (tmp_path / "file").write_bytes(b"data")
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "link").symlink_to("dir")
+    # Types are given by the listing
+    mocker.patch("os.DirEntry.stat", side_effect=AssertionError)
+    entries = Loopback().readdir(str(tmp_path), None)
+    assert entries[:2] == [".", ".."]
+
+    attrs = {name: attrs for name, attrs, _ in entries[2:]}
+    st = os.lstat(str(tmp_path / "file"))
+    assert attrs["file"] == {"st_dev": st.st_dev, "st_ino": st.st_ino,
+                             "st_mode": stat.S_IFREG}
+    assert attrs["link"]["st_mode"] == stat.S_IFLNK
+    assert stat.S_ISDIR(attrs["dir"]["st_mode"])